@@ -0,0 +1,46 @@
+"""add batch_jobs
+
+Revision ID: 5e3a9b7c2d14
+Revises: 8d2f4c1a7e90
+Create Date: 2026-10-18 15:40:12.581934
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e3a9b7c2d14'
+down_revision: Union[str, None] = '8d2f4c1a7e90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'batch_jobs',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('batch_name', sa.String(length=255), nullable=False),
+        sa.Column('pd_file_path', sa.String(length=1024), nullable=False),
+        sa.Column('idat_path', sa.String(length=1024), nullable=True),
+        sa.Column('processed_data_path', sa.String(length=1024), nullable=True),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('stages', sa.JSON(), nullable=True),
+        sa.Column('report_count', sa.Integer(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('worker_id', sa.String(length=255), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('started_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('heartbeat_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_batch_jobs_status'), 'batch_jobs', ['status'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_batch_jobs_status'), table_name='batch_jobs')
+    op.drop_table('batch_jobs')
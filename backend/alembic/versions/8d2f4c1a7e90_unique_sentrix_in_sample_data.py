@@ -0,0 +1,31 @@
+"""unique Sentrix_ID + Sentrix_Position in sample_data
+
+Revision ID: 8d2f4c1a7e90
+Revises: c6b59ed5dbc4
+Create Date: 2026-10-18 10:12:41.203518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8d2f4c1a7e90'
+down_revision: Union[str, None] = 'c6b59ed5dbc4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # 先刪除重複的樣本 (保留 id 最小的一筆), 否則無法建立 unique constraint
+    op.execute(
+        'DELETE FROM sample_data a USING sample_data b '
+        'WHERE a."Sentrix_ID" = b."Sentrix_ID" AND a."Sentrix_Position" = b."Sentrix_Position" AND a.id > b.id'
+    )
+    op.create_unique_constraint('uq_sample_data_sentrix', 'sample_data', ['Sentrix_ID', 'Sentrix_Position'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_sample_data_sentrix', 'sample_data', type_='unique')
@@ -0,0 +1,31 @@
+# backend/app/api/endpoints/batch.py
+from fastapi import APIRouter, Depends, HTTPException
+from pathlib import PurePosixPath
+from app.schemas import batch as batch_schema
+from app.services.batch_queue import BatchQueue, get_batch_queue
+
+router = APIRouter()
+
+# 只把工作寫入 batch_jobs, ChAMP / R 由 batch worker (python -m app.services.batch_worker) 執行
+@router.post("/batches", response_model=batch_schema.BatchJob, status_code=202)
+def create_batch(batch: batch_schema.BatchCreate, queue: BatchQueue = Depends(get_batch_queue)):
+    if not batch.idat_path and not batch.processed_data_path:
+        raise HTTPException(status_code=422, detail="Either idat_path or processed_data_path is required")
+    if batch.idat_path:
+        default_name = PurePosixPath(batch.idat_path.rstrip('/')).name
+    else:
+        default_name = PurePosixPath(batch.processed_data_path).stem.removesuffix('_processed')
+    batch_name = batch.batch_name or default_name
+    try:
+        job = queue.enqueue(batch_name, batch.pd_file_path, idat_path=batch.idat_path,
+                            processed_data_path=batch.processed_data_path)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return job
+
+@router.get("/batches/{batch_id}", response_model=batch_schema.BatchJob)
+def get_batch(batch_id: int, queue: BatchQueue = Depends(get_batch_queue)):
+    job = queue.get(batch_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return job
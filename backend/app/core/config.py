@@ -25,6 +25,64 @@ class Settings(BaseSettings):
     EPIDISH_R_SCRIPT_PATH: str
     EPIGENTL_R_SCRIPT_PATH: str
     R_EXECUTABLE: str
+    # R 腳本回傳矩陣的方式: "json" (stdout) 或 "feather" (二進位檔案)
+    R_HANDOFF_FORMAT: str = "json"
+    R_SCRATCH_DIR: str = ""
+    # 常駐 R worker pool (0 = 每次呼叫都啟動新的 Rscript)
+    R_WORKER_POOL_SIZE: int = 0
+    R_WORKER_SCRIPT_PATH: str = ""
+    R_WORKER_STARTUP_TIMEOUT: float = 600
+    R_WORKER_JOB_TIMEOUT: float = 0
+    R_WORKER_HEALTH_INTERVAL: float = 60
+    # ChAMP 分片處理: 每個分片最多幾個樣本 (0 = 整個 Sample Sheet 一次處理), 同時執行幾個分片
+    CHAMP_ARRAY_TYPE: str = "EPICv1"
+    CHAMP_SHARD_SIZE: int = 0
+    CHAMP_MAX_CONCURRENCY: int = 2
+    # 已處理 beta table 的本地快取 (以 IDAT 內容雜湊為鍵), 上限 bytes, 0 = 停用
+    BETA_CACHE_DIR: str = ""
+    BETA_CACHE_MAX_BYTES: int = 20 * 1024 ** 3
+    # data/processed_beta_table 的 Parquet probe store: 每個 row group 的 probe 數與壓縮方式
+    BETA_STORE_ROW_GROUP_SIZE: int = 10000
+    BETA_STORE_COMPRESSION: str = "zstd"
+    # Sample Sheet 匯入時每次讀取/寫入的行數
+    SAMPLE_INGEST_CHUNK_SIZE: int = 5000
+    # save_reports: 每個 IN 查詢 / INSERT 的行數, 以及重跑時是否以新報告取代同 order_ecid 的舊報告
+    REPORT_SAVE_CHUNK_SIZE: int = 1000
+    REPORT_REPLACE_EXISTING: bool = False
+    # batch worker: 每個 worker process 同時執行的批次數, 所有 worker 合計最多執行中的批次數 (避免 R 佔滿記憶體),
+    # 輪詢間隔 (秒), 超過多久沒有 heartbeat 視為 worker 已中斷並重新排入佇列 (秒), 每個批次最多嘗試次數
+    BATCH_WORKER_CONCURRENCY: int = 1
+    BATCH_MAX_RUNNING: int = 2
+    BATCH_POLL_INTERVAL: float = 5
+    BATCH_STALE_SECONDS: float = 900
+    BATCH_MAX_ATTEMPTS: int = 2
+    # POST /batches 可使用的本地目錄 (逗號分隔, 空字串 = backend/data); gs:// 只接受 GCS_BUCKET_NAME
+    BATCH_DATA_ROOTS: str = ""
+    # GCS 傳輸: 同時傳輸的檔案數, resumable chunk 大小 (256 KiB 的倍數), 超過門檻的檔案拆成幾段平行上傳再 compose
+    GCS_TRANSFER_WORKERS: int = 16
+    GCS_CHUNK_SIZE: int = 8 * 1024 * 1024
+    GCS_COMPOSITE_THRESHOLD: int = 150 * 1024 * 1024
+    GCS_COMPOSITE_PARTS: int = 8
+    # 從 GCS 暫存 IDAT 的本地目錄與容量上限 (bytes)
+    IDAT_STAGING_DIR: str = ""
+    IDAT_STAGING_MAX_BYTES: int = 50 * 1024 ** 3
+    # 模型檔 (joblib) 的 mmap_mode, 例如 "r" 讓多個 worker 共用 page cache 中的 numpy 陣列; 空字串 = 不 mmap
+    MODEL_MMAP_MODE: str = ""
+    # biolearn 同時執行的模型數
+    BIOLEARN_MAX_WORKERS: int = 4
+    # ReportGenerator 同時執行的 stage 數 (EpiDISH→SA2BL→PACE, Horvathv2, EpigenTL→MentalHealth 三條分支), 1 = 依序執行
+    PIPELINE_MAX_WORKERS: int = 3
+    # batch worker 啟動時預先載入的 clock (逗號分隔), 是否在啟動時載入, 以及啟動時間預算 (秒, 超過時記錄警告)
+    LINEAR_CLOCK_MODELS: str = "Horvathv2,DunedinPACE,GrimAgeV1"
+    LINEAR_CLOCK_WARMUP: bool = True
+    LINEAR_CLOCK_STARTUP_BUDGET_SECONDS: float = 30
+    # EpigenTL 預處理: 個別樣本的 NaN 也以參考平均值補上 (否則該樣本的結果為 NA)
+    EPIGENTL_IMPUTE_NAN: bool = True
+    # EpigenTL 計算方式: "python" (NumPy, 需要匯出的係數檔), "r" (Rscript / R worker), "auto" (有係數檔時用 python)
+    EPIGENTL_ENGINE: str = "auto"
+    # MentalHealth 分位數轉換的唾液分布: "batch" (批次本身), "reference" (儲存的唾液參考分布), "auto" (樣本數不足時用參考分布)
+    MENTALHEALTH_QUANTILE_MODE: str = "auto"
+    MENTALHEALTH_MIN_BATCH_SAMPLES: int = 30
     DEBUG: bool = False
 
     # Authentication settings (deps.py) 還沒做
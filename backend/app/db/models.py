@@ -1,5 +1,5 @@
 # backend/app/db/models.py
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, text
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, UniqueConstraint, JSON, Text, text
 from sqlalchemy.dialects.postgresql import UUID
 import uuid
 from .base import Base
@@ -43,6 +43,7 @@ class Report(Base):
 
 class SampleData(Base):
     __tablename__ = "sample_data"
+    __table_args__ = (UniqueConstraint('Sentrix_ID', 'Sentrix_Position', name='uq_sample_data_sentrix'),)
 
     id = Column(Integer, unique=True, primary_key=True, autoincrement=True)
     sample_name = Column(String(255))
@@ -54,6 +55,26 @@ class SampleData(Base):
     biolearn_output_path = Column(String(255), nullable=True)
     epigentl_output_path = Column(String(255), nullable=True)
 
+class BatchJob(Base):
+    """報告產生工作 (POST /batches 建立, batch worker 執行)"""
+    __tablename__ = "batch_jobs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    batch_name = Column(String(255), nullable=False)
+    pd_file_path = Column(String(1024), nullable=False)
+    idat_path = Column(String(1024), nullable=True)
+    processed_data_path = Column(String(1024), nullable=True)
+    status = Column(String(20), nullable=False, default='queued', index=True)  # queued / running / succeeded / failed
+    stages = Column(JSON, nullable=True)  # {stage: {status, seconds}}
+    report_count = Column(Integer, nullable=True)
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    worker_id = Column(String(255), nullable=True)
+    created_at = Column(DateTime(timezone=True))
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
 # 初始化數據庫的函數
 def init_db(engine):
     Base.metadata.create_all(engine)
\ No newline at end of file
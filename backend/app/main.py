@@ -4,7 +4,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.utils import get_openapi
 from pydantic import ValidationError
 from sqlalchemy.exc import SQLAlchemyError
-from app.api.endpoints import report, sample, user
+from app.api.endpoints import batch, report, sample, user
 from app.core.config import settings
 import os
 import base64
@@ -107,6 +107,7 @@ async def general_exception_handler(request, exc):
 
 
 app.include_router(report.router)
+app.include_router(batch.router)
 app.include_router(sample.router)
 app.include_router(user.router, prefix="/api/v1")
 
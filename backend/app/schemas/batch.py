@@ -0,0 +1,32 @@
+# backend/app/schemas/batch.py
+from pydantic import BaseModel
+from datetime import datetime
+from typing import Dict, Optional
+
+class BatchCreate(BaseModel):
+    batch_name: Optional[str] = None
+    pd_file_path: str
+    idat_path: Optional[str] = None
+    processed_data_path: Optional[str] = None
+
+class StageProgress(BaseModel):
+    status: str
+    seconds: Optional[float] = None
+
+class BatchJob(BaseModel):
+    id: int
+    batch_name: str
+    pd_file_path: str
+    idat_path: Optional[str] = None
+    processed_data_path: Optional[str] = None
+    status: str
+    stages: Dict[str, StageProgress] = {}
+    report_count: Optional[int] = None
+    error: Optional[str] = None
+    attempts: int
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
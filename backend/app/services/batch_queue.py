@@ -0,0 +1,236 @@
+# app/services/batch_queue.py
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import sessionmaker
+
+from app.core.config import settings
+from app.db.models import BatchJob
+from app.db.session import SessionLocal
+from app.services.beta_store import BACKEND_ROOT, resolve_beta_store_path
+
+# PostgreSQL advisory lock: 同一時間只有一個 worker 在計算執行中的批次數並領取工作
+CLAIM_LOCK_KEY = 725001
+
+
+def batch_data_roots() -> List[Path]:
+    """Local directories batch jobs may read (BATCH_DATA_ROOTS, default backend/data)"""
+    roots = [root.strip() for root in settings.BATCH_DATA_ROOTS.split(',') if root.strip()]
+    return [Path(root).resolve() for root in roots] or [(BACKEND_ROOT / 'data').resolve()]
+
+
+def check_batch_path(path: str, beta_store: bool = False) -> str:
+    """
+    The worker opens these paths and runs ChAMP on them, so only the configured bucket and data roots are accepted.
+
+    :param path: gs:// path, or a local path (relative paths are relative to backend/)
+    :param beta_store: Resolve like a processed beta store (a bare file name is in data/processed_beta_table)
+    :return: The gs:// path unchanged, or the absolute local path
+    :raises ValueError: Another bucket, or a local path outside every data root
+    """
+    if path.startswith('gs://'):
+        if not path.startswith(f"gs://{settings.GCS_BUCKET_NAME}/"):
+            raise ValueError(f"Only gs://{settings.GCS_BUCKET_NAME}/ can be used: {path}")
+        return path
+    local = resolve_beta_store_path(path) if beta_store else Path(path)
+    if not local.is_absolute():
+        local = BACKEND_ROOT / local
+    local = local.resolve()
+    if not any(local == root or root in local.parents for root in batch_data_roots()):
+        raise ValueError(f"Path is outside the batch data directories: {path}")
+    return str(local)
+
+
+class BatchQueue:
+    """
+    Report generation jobs kept in the batch_jobs table, so queued and running batches survive
+    restarts of both the API and the workers.
+
+    Workers claim the oldest queued job with SELECT ... FOR UPDATE SKIP LOCKED (PostgreSQL), never
+    more than BATCH_MAX_RUNNING at once over all workers. A running job whose worker stops sending
+    heartbeats is queued again (or failed after BATCH_MAX_ATTEMPTS).
+    """
+
+    def __init__(self, session_factory: sessionmaker = None, max_running: int = None,
+                 stale_seconds: float = None, max_attempts: int = None):
+        self.logger = logging.getLogger(__name__)
+        self.session_factory = session_factory or SessionLocal
+        self.max_running = max_running or settings.BATCH_MAX_RUNNING
+        self.stale_seconds = stale_seconds or settings.BATCH_STALE_SECONDS
+        self.max_attempts = max_attempts or settings.BATCH_MAX_ATTEMPTS
+
+    @staticmethod
+    def _now() -> datetime:
+        return datetime.now(timezone.utc)
+
+    def enqueue(self, batch_name: str, pd_file_path: str, idat_path: str = None,
+                processed_data_path: str = None) -> BatchJob:
+        """
+        :param batch_name: Name used for output files
+        :param pd_file_path: Sample Sheet (local path or gs://)
+        :param idat_path: IDAT directory (local or gs://); runs ChAMP
+        :param processed_data_path: Processed beta store; skips ChAMP (used when idat_path is not given)
+        :return: The queued job
+        :raises ValueError: No IDAT / processed location, or a path check_batch_path rejects
+        """
+        if not idat_path and not processed_data_path:
+            raise ValueError("Either idat_path or processed_data_path is required")
+        pd_file_path = check_batch_path(pd_file_path)
+        if idat_path:
+            idat_path = check_batch_path(idat_path)
+        if processed_data_path:
+            processed_data_path = check_batch_path(processed_data_path, beta_store=True)
+        session = self.session_factory()
+        try:
+            job = BatchJob(batch_name=batch_name, pd_file_path=pd_file_path, idat_path=idat_path,
+                           processed_data_path=processed_data_path, status='queued', attempts=0,
+                           stages={}, created_at=self._now())
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+            session.expunge(job)
+            self.logger.info(f"Queued batch job {job.id}: {batch_name}")
+            return job
+        finally:
+            session.close()
+
+    def get(self, job_id: int) -> Optional[BatchJob]:
+        session = self.session_factory()
+        try:
+            job = session.get(BatchJob, job_id)
+            if job is not None:
+                session.expunge(job)
+            return job
+        finally:
+            session.close()
+
+    def claim(self, worker_id: str) -> Optional[BatchJob]:
+        """
+        Mark the oldest queued job as running for this worker.
+
+        :return: The claimed job, or None when nothing is queued or BATCH_MAX_RUNNING jobs are running
+        """
+        session = self.session_factory()
+        try:
+            if session.get_bind().dialect.name == 'postgresql':
+                session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': CLAIM_LOCK_KEY})
+            running = session.query(func.count(BatchJob.id)).filter(BatchJob.status == 'running').scalar()
+            if running >= self.max_running:
+                session.rollback()
+                return None
+            job = (session.query(BatchJob).filter(BatchJob.status == 'queued').order_by(BatchJob.id)
+                   .with_for_update(skip_locked=True).first())
+            if job is None:
+                session.rollback()
+                return None
+            now = self._now()
+            job.status = 'running'
+            job.worker_id = worker_id
+            job.attempts = (job.attempts or 0) + 1
+            job.started_at = now
+            job.heartbeat_at = now
+            job.error = None
+            job.stages = {}
+            session.commit()
+            session.refresh(job)
+            session.expunge(job)
+            self.logger.info(f"Worker {worker_id} claimed batch job {job.id} (attempt {job.attempts})")
+            return job
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def record_stage(self, job_id: int, stage: str, status: str, seconds: float = None):
+        """Progress of one stage ('running', 'done', 'failed' or 'skipped'); also counts as a heartbeat."""
+        session = self.session_factory()
+        try:
+            job = session.query(BatchJob).filter(BatchJob.id == job_id).with_for_update().one()
+            stages = dict(job.stages or {})
+            stages[stage] = {'status': status, 'seconds': None if seconds is None else round(seconds, 3)}
+            # JSON 欄位要換成新的 dict 才會被寫回
+            job.stages = stages
+            job.heartbeat_at = self._now()
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def heartbeat(self, job_ids: List[int]):
+        if not job_ids:
+            return
+        session = self.session_factory()
+        try:
+            session.query(BatchJob).filter(BatchJob.id.in_(job_ids), BatchJob.status == 'running').update(
+                {BatchJob.heartbeat_at: self._now()}, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def _finish(self, job_id: int, values: Dict):
+        session = self.session_factory()
+        try:
+            values = dict(values)
+            values[BatchJob.finished_at] = self._now()
+            session.query(BatchJob).filter(BatchJob.id == job_id).update(values, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def succeed(self, job_id: int, report_count: int):
+        self._finish(job_id, {BatchJob.status: 'succeeded', BatchJob.report_count: report_count})
+        self.logger.info(f"Batch job {job_id} succeeded with {report_count} reports")
+
+    def fail(self, job_id: int, error: str):
+        self._finish(job_id, {BatchJob.status: 'failed', BatchJob.error: error})
+        self.logger.error(f"Batch job {job_id} failed: {error}")
+
+    def requeue_stale(self) -> Dict[str, int]:
+        """
+        Running jobs without a heartbeat for BATCH_STALE_SECONDS (their worker was stopped or crashed)
+        go back to the queue, or fail once they used BATCH_MAX_ATTEMPTS.
+
+        :return: {'requeued': ..., 'failed': ...}
+        """
+        cutoff = self._now() - timedelta(seconds=self.stale_seconds)
+        counts = {'requeued': 0, 'failed': 0}
+        session = self.session_factory()
+        try:
+            stale = (session.query(BatchJob).filter(BatchJob.status == 'running', BatchJob.heartbeat_at < cutoff)
+                     .with_for_update(skip_locked=True).all())
+            for job in stale:
+                if (job.attempts or 0) >= self.max_attempts:
+                    job.status = 'failed'
+                    job.error = f"Worker {job.worker_id} stopped responding ({job.attempts} attempts)"
+                    job.finished_at = self._now()
+                    counts['failed'] += 1
+                else:
+                    job.status = 'queued'
+                    counts['requeued'] += 1
+                self.logger.warning(f"Batch job {job.id} from worker {job.worker_id} is stale, now {job.status}")
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        return counts
+
+
+_queue: Optional[BatchQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_batch_queue() -> BatchQueue:
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = BatchQueue()
+        return _queue
@@ -0,0 +1,173 @@
+# app/services/batch_worker.py
+# 執行 POST /batches 排入的報告產生工作; 和 API 分開的 process:
+#   python -m app.services.batch_worker
+import io
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+from app.core.config import settings
+from app.db.models import BatchJob
+from app.services.batch_queue import BatchQueue, get_batch_queue
+from app.services.sample_ingest import SampleIngestor, sample_sheet_metadata
+
+# progress(stage, status, seconds)
+ProgressCallback = Callable[[str, str, Optional[float]], None]
+
+
+def open_sample_sheet(path: str):
+    """Open a local or gs:// Sample Sheet as a text file."""
+    if str(path).startswith('gs://'):
+        from app.services.gcs_storage import GCSStorage
+        return GCSStorage().open_text(str(path))
+    return open(path, encoding='utf-8')
+
+
+def idat_prefix_for(job: BatchJob) -> str:
+    """Directory written into SampleData.idat_file: the IDAT location (bucket-relative for gs://)"""
+    location = job.idat_path or os.path.dirname(str(job.pd_file_path))
+    if location.startswith('gs://'):
+        location = location[len('gs://'):].partition('/')[2]
+    return location
+
+
+def run_batch_job(job: BatchJob, progress: ProgressCallback) -> int:
+    """
+    Import the Sample Sheet, preprocess the batch (ChAMP, or read the processed beta store), run the
+    report stages and save the reports, reporting each stage through progress.
+
+    :return: Number of saved reports
+    """
+    # report_generator 載入 R / 模型相關模組, 只在 worker 中 import
+    from app.services.report_generator import IdatReportGenerator, ProcessedDataReportGenerator
+
+    def stage(name: str, func: Callable):
+        progress(name, 'running', None)
+        start = time.perf_counter()
+        try:
+            result = func()
+        except Exception:
+            progress(name, 'failed', time.perf_counter() - start)
+            raise
+        progress(name, 'done', time.perf_counter() - start)
+        return result
+
+    with open_sample_sheet(job.pd_file_path) as sheet:
+        sample_sheet = sheet.read()
+    # 先檢查報告需要的欄位 (Age / Gender), 缺少時在匯入 sample_data 之前就失敗
+    metadata = sample_sheet_metadata(pd.read_csv(io.StringIO(sample_sheet)))
+    stage('ingest', lambda: SampleIngestor().ingest(io.StringIO(sample_sheet), idat_prefix_for(job)))
+
+    if job.idat_path:
+        generator = IdatReportGenerator()
+        stage('preprocess', lambda: generator.process_data(job.pd_file_path, job.idat_path, job.batch_name))
+    else:
+        generator = ProcessedDataReportGenerator()
+        stage('preprocess', lambda: generator.process_data(job.processed_data_path))
+    generator.stage_listener = lambda batch_name, run: progress(
+        run.name, run.status, None if run.status == 'running' else run.seconds)
+    generator.run_stages(metadata)
+    saved = stage('reports', lambda: generator.save_reports(generator.build_report_frame(metadata)))
+    return len(saved)
+
+
+class BatchWorker:
+    """
+    Runs queued batch jobs, at most BATCH_WORKER_CONCURRENCY at a time in this process
+    (and BATCH_MAX_RUNNING over all workers, enforced by BatchQueue.claim).
+
+    Every poll sends heartbeats for the jobs in progress, puts jobs of dead workers back in the
+    queue and claims new jobs for free slots.
+    """
+
+    def __init__(self, queue: BatchQueue = None, concurrency: int = None, poll_interval: float = None,
+                 worker_id: str = None, runner: Callable[[BatchJob, ProgressCallback], int] = None):
+        """
+        :param runner: Function running one job (default run_batch_job)
+        """
+        self.logger = logging.getLogger(__name__)
+        self.queue = queue or get_batch_queue()
+        self.concurrency = max(1, concurrency or settings.BATCH_WORKER_CONCURRENCY)
+        self.poll_interval = settings.BATCH_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.runner = runner or run_batch_job
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='batch')
+        self._running: Dict[int, Future] = {}
+        self._stop = threading.Event()
+
+    def poll(self) -> List[int]:
+        """:return: IDs of the jobs claimed by this poll"""
+        self._running = {job_id: future for job_id, future in self._running.items() if not future.done()}
+        self.queue.heartbeat(list(self._running))
+        self.queue.requeue_stale()
+        claimed = []
+        while len(self._running) < self.concurrency:
+            job = self.queue.claim(self.worker_id)
+            if job is None:
+                break
+            self._running[job.id] = self._executor.submit(self._run, job)
+            claimed.append(job.id)
+        return claimed
+
+    def _run(self, job: BatchJob):
+        def progress(stage: str, status: str, seconds: float = None):
+            try:
+                self.queue.record_stage(job.id, stage, status, seconds)
+            except Exception as e:
+                self.logger.error(f"Could not record stage {stage} of batch job {job.id}: {e}")
+
+        self.logger.info(f"Running batch job {job.id}: {job.batch_name}")
+        try:
+            report_count = self.runner(job, progress)
+        except Exception as e:
+            self.logger.error(f"Batch job {job.id} failed: {e}", exc_info=True)
+            self.queue.fail(job.id, f"{type(e).__name__}: {e}")
+            return
+        self.queue.succeed(job.id, report_count)
+
+    def wait(self):
+        """Block until the jobs in progress have finished."""
+        for future in list(self._running.values()):
+            future.result()
+
+    def serve_forever(self):
+        self.logger.info(f"Batch worker {self.worker_id} started (concurrency {self.concurrency})")
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.poll()
+                except Exception as e:
+                    # 資料庫暫時無法連線時下一輪再試
+                    self.logger.error(f"Batch worker poll failed: {e}")
+                self._stop.wait(self.poll_interval)
+        finally:
+            self._executor.shutdown(wait=True)
+            self.logger.info(f"Batch worker {self.worker_id} stopped")
+
+    def stop(self):
+        self._stop.set()
+
+
+def main():
+    from app.services.report_generator import setup_logging
+    setup_logging()
+    if settings.LINEAR_CLOCK_WARMUP:
+        # 預先載入 clock 係數, 第一個批次不必等 ModelGallery 讀檔 (API process 不產生報告, 不需要載入)
+        from app.services.linear_clock_cache import get_linear_clock_cache
+        get_linear_clock_cache().warm()
+    worker = BatchWorker()
+    try:
+        worker.serve_forever()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+# app/services/beta_cache.py
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from app.core.config import settings
+from app.services.r_handoff import read_handoff_table, write_handoff_table
+
+BACKEND_ROOT = Path(__file__).resolve().parents[2]
+
+
+class BetaTableCache:
+    """
+    Content-addressed, size-bounded cache of post-processed beta tables.
+
+    The key is derived from the contents of every sample's Grn/Red IDAT files, the sample
+    names and the ChAMP parameters, so the same chips processed with the same script hit the
+    cache no matter where the files live. Entries are Feather files; the least recently used
+    ones are evicted once the cache grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path] = None, max_bytes: int = None):
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = Path(cache_dir or settings.BETA_CACHE_DIR or BACKEND_ROOT / 'data' / 'cache' / 'beta_tables')
+        self.max_bytes = settings.BETA_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        # resolved path -> (size, mtime_ns, sha256)
+        self._file_hashes: Dict[str, Tuple[int, int, str]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def hash_file(self, path: Union[str, Path]) -> str:
+        """
+        SHA-256 of a file's contents, memoised on (path, size, mtime) for the life of the process.
+        """
+        path = Path(path)
+        stat = path.stat()
+        resolved = str(path.resolve())
+        memo = self._file_hashes.get(resolved)
+        if memo is not None and memo[:2] == (stat.st_size, stat.st_mtime_ns):
+            return memo[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        # 每個路徑只保留最新的雜湊, 文件改變時取代舊的
+        self._file_hashes[resolved] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+        return digest.hexdigest()
+
+    def make_key(self, idat_files: Dict[str, List[Path]], params: Dict[str, str]) -> str:
+        """
+        :param idat_files: Sample_Name -> that sample's IDAT files
+        :param params: Processing parameters (script hash, array type, ...)
+        :return: Hex cache key
+        """
+        digest = hashlib.sha256()
+        for sample_name in sorted(idat_files):
+            file_hashes = sorted(self.hash_file(path) for path in idat_files[sample_name])
+            digest.update(json.dumps([sample_name, file_hashes]).encode())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.feather"
+
+    def _meta_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        entry_path = self._entry_path(key)
+        if not entry_path.exists():
+            self.logger.info(f"Beta table cache miss: {key[:12]}")
+            return None
+        try:
+            beta_table = read_handoff_table(entry_path, index_col='probeID')
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Dropping unreadable cache entry {key[:12]}: {e}")
+            self.invalidate(key)
+            return None
+        # 更新 mtime 作為 LRU 的最近使用時間
+        os.utime(entry_path)
+        self.logger.info(f"Beta table cache hit: {key[:12]} ({beta_table.shape[0]} probes x {beta_table.shape[1]} samples)")
+        return beta_table
+
+    def put(self, key: str, beta_table: pd.DataFrame, params: Dict[str, str] = None) -> Path:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry_path = self._entry_path(key)
+        # 先寫入暫存檔再改名, 避免其他進程讀到寫一半的檔案
+        tmp_path = entry_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        write_handoff_table(beta_table, tmp_path, index_label='probeID')
+        os.replace(tmp_path, entry_path)
+        self._meta_path(key).write_text(json.dumps({
+            'samples': [str(col) for col in beta_table.columns],
+            'params': params or {},
+            'created': time.time(),
+        }))
+        self.logger.info(f"Cached beta table {key[:12]} ({entry_path.stat().st_size / 1e6:.1f} MB)")
+        self.evict()
+        return entry_path
+
+    def entries(self) -> List[dict]:
+        """
+        All cache entries, least recently used first.
+        """
+        if not self.cache_dir.exists():
+            return []
+        entries = []
+        for entry_path in self.cache_dir.glob('*.feather'):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            meta_path = self._meta_path(entry_path.stem)
+            meta = json.loads(meta_path.read_text()) if meta_path.exists() else {}
+            entries.append({
+                'key': entry_path.stem,
+                'size': stat.st_size,
+                'last_used': stat.st_mtime,
+                'samples': meta.get('samples', []),
+            })
+        return sorted(entries, key=lambda entry: entry['last_used'])
+
+    def evict(self) -> List[str]:
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+
+        :return: Keys of the removed entries
+        """
+        with self._lock:
+            entries = self.entries()
+            total = sum(entry['size'] for entry in entries)
+            evicted = []
+            for entry in entries:
+                if total <= self.max_bytes:
+                    break
+                self.invalidate(entry['key'])
+                total -= entry['size']
+                evicted.append(entry['key'])
+            if evicted:
+                self.logger.info(f"Evicted {len(evicted)} beta table cache entries")
+            return evicted
+
+    def invalidate(self, key: str) -> bool:
+        removed = False
+        for path in (self._entry_path(key), self._meta_path(key)):
+            try:
+                path.unlink()
+                removed = True
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def invalidate_samples(self, sample_names: List[str]) -> List[str]:
+        """
+        Remove every entry that contains any of the given samples (e.g. after an IDAT was re-scanned).
+
+        :return: Keys of the removed entries
+        """
+        sample_names = set(sample_names)
+        removed = [entry['key'] for entry in self.entries() if sample_names & set(entry['samples'])]
+        for key in removed:
+            self.invalidate(key)
+        return removed
+
+    def clear(self) -> int:
+        entries = self.entries()
+        for entry in entries:
+            self.invalidate(entry['key'])
+        return len(entries)
+
+
+_cache: Optional[BetaTableCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_beta_table_cache() -> BetaTableCache:
+    """Process-wide cache, so the IDAT hash memo is kept between batches (and batch worker jobs)."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = BetaTableCache()
+        return _cache
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the processed beta table cache")
+    parser.add_argument("action", choices=["list", "invalidate", "invalidate_samples", "clear"])
+    parser.add_argument("targets", nargs="*", help="Cache keys or sample names")
+    args = parser.parse_args()
+
+    # example: python app/services/beta_cache.py invalidate_samples A1S1 A1S2
+    cache = BetaTableCache()
+    if args.action == "list":
+        for entry in cache.entries():
+            print(f"{entry['key']}  {entry['size'] / 1e6:8.1f} MB  {len(entry['samples'])} samples")
+    elif args.action == "invalidate":
+        for key in args.targets:
+            print(f"{key}: {'removed' if cache.invalidate(key) else 'not found'}")
+    elif args.action == "invalidate_samples":
+        print(f"Removed {len(cache.invalidate_samples(args.targets))} entries")
+    else:
+        print(f"Removed {cache.clear()} entries")
@@ -0,0 +1,135 @@
+# app/services/beta_store.py
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from app.core.config import settings
+
+BACKEND_ROOT = Path(__file__).resolve().parents[2]
+PROCESSED_BETA_TABLE_DIR = BACKEND_ROOT / 'data' / 'processed_beta_table'
+
+logger = logging.getLogger(__name__)
+
+# 每個 store 的 row group 邊界只讀一次 (以 path + mtime 為鍵)
+_group_bounds_cache: Dict[Tuple[str, int], np.ndarray] = {}
+_group_bounds_lock = threading.Lock()
+
+
+def resolve_beta_store_path(path: Union[str, Path]) -> Path:
+    """
+    Accept an absolute path, a path relative to backend/ (as stored in processed_beta_table_path)
+    or a bare file name inside data/processed_beta_table.
+    """
+    path = Path(path)
+    if path.is_absolute() or path.exists():
+        return path
+    if (BACKEND_ROOT / path).exists():
+        return BACKEND_ROOT / path
+    return PROCESSED_BETA_TABLE_DIR / path
+
+
+def write_beta_store(beta_table: pd.DataFrame, path: Union[str, Path], row_group_size: int = None) -> Path:
+    """
+    Write a beta table (probes x samples, index probeID) as a Parquet probe store.
+
+    Rows are sorted by probeID and split into row groups so readers can fetch a probe subset
+    without decoding the whole file; every sample is its own float32 column.
+
+    :param beta_table: Beta table indexed by probeID
+    :param path: Output .parquet path
+    :param row_group_size: Probes per row group (defaults to BETA_STORE_ROW_GROUP_SIZE)
+    :return: The written path
+    """
+    path = Path(path)
+    row_group_size = row_group_size or settings.BETA_STORE_ROW_GROUP_SIZE
+    if not beta_table.index.is_monotonic_increasing:
+        beta_table = beta_table.sort_index()
+    columns = {'probeID': pa.array(beta_table.index.astype(str), type=pa.string())}
+    for sample_name in beta_table.columns:
+        columns[str(sample_name)] = pa.array(beta_table[sample_name].to_numpy(dtype=np.float32))
+    table = pa.table(columns)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, path, row_group_size=row_group_size, compression=settings.BETA_STORE_COMPRESSION)
+    logger.info(f"Wrote beta store {path} ({len(beta_table)} probes x {beta_table.shape[1]} samples, "
+                f"{path.stat().st_size / 1e6:.1f} MB)")
+    return path
+
+
+def _group_bounds(path: Path, parquet_file: pq.ParquetFile) -> np.ndarray:
+    """First probeID of every row group, from the Parquet footer statistics (rows are sorted)."""
+    stat = path.stat()
+    key = (str(path.resolve()), stat.st_mtime_ns)
+    with _group_bounds_lock:
+        bounds = _group_bounds_cache.get(key)
+    if bounds is None:
+        probe_column = parquet_file.schema_arrow.get_field_index('probeID')
+        metadata = parquet_file.metadata
+        bounds = np.array([metadata.row_group(i).column(probe_column).statistics.min
+                           for i in range(metadata.num_row_groups)], dtype=object)
+        with _group_bounds_lock:
+            _group_bounds_cache[key] = bounds
+    return bounds
+
+
+def read_beta_store(path: Union[str, Path], probes: Iterable[str] = None,
+                    samples: Iterable[str] = None) -> pd.DataFrame:
+    """
+    Read a beta table, optionally only some probes (rows) and samples (columns).
+
+    Only the row groups that contain a requested probe and the requested sample columns are
+    decoded. Legacy *_processed.csv tables are still accepted and filtered after reading.
+
+    :param path: Store path (see resolve_beta_store_path)
+    :param probes: Probe IDs to keep; probes missing from the store are ignored
+    :param samples: Sample columns to keep, in this order
+    :return: DataFrame indexed by probeID, in store order
+    """
+    path = resolve_beta_store_path(path)
+    samples = None if samples is None else [str(sample) for sample in samples]
+
+    if path.suffix == '.csv':
+        usecols = None if samples is None else ['probeID'] + samples
+        beta_table = pd.read_csv(path, index_col='probeID', usecols=usecols)
+        if probes is not None:
+            beta_table = beta_table[beta_table.index.isin(pd.Index(probes))]
+        return beta_table
+
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    columns = samples if samples is not None else [name for name in parquet_file.schema_arrow.names if name != 'probeID']
+
+    if probes is None:
+        table = parquet_file.read(columns=['probeID'] + columns)
+    else:
+        # 依 footer 中每個 row group 的最小 probeID 找出需要的 row group, 只解碼這些
+        wanted = np.unique(np.asarray(list(probes), dtype=object))
+        bounds = _group_bounds(path, parquet_file)
+        groups = np.unique(np.searchsorted(bounds, wanted, side='right') - 1)
+        groups = groups[groups >= 0]
+        table = parquet_file.read_row_groups(groups.tolist(), columns=['probeID'] + columns)
+        table = table.filter(pc.is_in(table['probeID'], value_set=pa.array(wanted, type=pa.string())))
+        logger.debug(f"Read {table.num_rows} probes from {len(groups)}/{len(bounds)} row groups of {path}")
+
+    probe_ids = pd.Index(table['probeID'].to_numpy(zero_copy_only=False), name='probeID')
+    return pd.DataFrame(_to_matrix(table, columns), index=probe_ids, columns=columns)
+
+
+def store_samples(path: Union[str, Path]) -> list:
+    """Sample names in a store without reading any data."""
+    path = resolve_beta_store_path(path)
+    if path.suffix == '.csv':
+        return pd.read_csv(path, index_col='probeID', nrows=0).columns.tolist()
+    return [name for name in pq.read_schema(path).names if name != 'probeID']
+
+
+def _to_matrix(table: pa.Table, columns: list) -> np.ndarray:
+    values = np.empty((table.num_rows, len(columns)), dtype=np.float32)
+    for j, column in enumerate(columns):
+        values[:, j] = table[column].to_numpy()
+    return values
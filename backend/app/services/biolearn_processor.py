@@ -3,10 +3,39 @@ import pandas as pd
 import numpy as np
 from pathlib import Path
 import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Union
 from biolearn.model_gallery import ModelGallery
 from biolearn.data_library import GeoData
 
+from app.core.config import settings
+from app.services.beta_store import read_beta_store
+from app.services.linear_clock_cache import get_linear_clock_cache
+
+GRIMAGE_MODELS = ("GrimAgeV1", "GrimAgeV2")
+
+
+def biolearn_output_name(batch_name: str) -> str:
+    """每個批次一個不重複的結果檔名 (同名批次並行時不會互相覆蓋)"""
+    return f"{batch_name}_{uuid.uuid4().hex[:8]}_biolearn_results.csv"
+
+
+class BiolearnJob:
+    """
+    One methylation matrix and the biolearn models to run on it.
+
+    :ivar name: Label used in logs (e.g. 'Horvathv2' or 'sa2bl')
+    :ivar methylation_data: Path to the beta store or a DataFrame indexed by probeID
+    :ivar models: Model names in the biolearn gallery
+    """
+
+    def __init__(self, name: str, methylation_data: Union[str, Path, pd.DataFrame], models: List[str]):
+        self.name = name
+        self.methylation_data = methylation_data
+        self.models = list(models)
+
+
 class BioLearnProcessor:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
@@ -15,6 +44,9 @@ class BioLearnProcessor:
         self.output_dir = self.backend_root / 'data' / 'biolearn_output'
         self.output_dir.mkdir(parents=True, exist_ok=True)
         self.gallery = ModelGallery()
+        self.max_workers = settings.BIOLEARN_MAX_WORKERS
+        # 預先載入的 clock (None = 每次經由 gallery 取得模型)
+        self.clock_cache = get_linear_clock_cache()
 
     def process_biolearn_models(self, data: GeoData, models: List[str]) -> pd.DataFrame:
         """
@@ -27,14 +59,20 @@ class BioLearnProcessor:
         results = []
         for i, model in enumerate(models, 1):
             self.logger.info(f"Processing model {i}: {model}")
-            try:
-                df = self.gallery.get(model).predict(data)
-                df = df.add_prefix(f"{model}_")
+            df = self._predict(model, data)
+            if df is not None:
                 results.append(df)
-            except Exception as e:
-                self.logger.error(f"Error processing model {model}: {str(e)}")
         return pd.concat(results, axis=1)
 
+    def _predict(self, model: str, data: GeoData) -> Union[pd.DataFrame, None]:
+        try:
+            if self.clock_cache is not None and model in self.clock_cache.models:
+                return self.clock_cache.predict(model, data).add_prefix(f"{model}_")
+            return self.gallery.get(model).predict(data).add_prefix(f"{model}_")
+        except Exception as e:
+            self.logger.error(f"Error processing model {model}: {str(e)}")
+            return None
+
     def save_model_results(self, results: pd.DataFrame, output_file: str) -> str:
         """
         Save the combined model results to a CSV file.
@@ -47,32 +85,21 @@ class BioLearnProcessor:
         self.logger.info(f"Results saved to {output_path}")
         return output_path.relative_to(self.backend_root).as_posix()
 
-    def run_biolearn(self, methylation_data: Union[str, Path, pd.DataFrame], 
-                     models: List[str], output_file: str, 
-                     metadata: Dict[str, List] = None):
-        """
-        Run the complete biolearn analysis pipeline.
-        
-        :param methylation_data: Either a path to the CSV file or a DataFrame containing methylation data
-        :param models: List of model names to process
-        :param output_file: Name of the output file
-        :param metadata: Optional dictionary containing metadata (age, sex)
-        """
-        self.logger.info("Starting biolearn analysis")
-        
-        if "GrimAgeV1" in models or "GrimAgeV2" in models:
-            if metadata is None or 'age' not in metadata or 'sex' not in metadata:
-                raise ValueError("Metadata with 'age' and 'sex' is required for GrimAge models")
-        
-        # 處理 methylation_data 輸入
+    def _read_methylation_data(self, methylation_data: Union[str, Path, pd.DataFrame]) -> pd.DataFrame:
         if isinstance(methylation_data, (str, Path)):
             self.logger.info(f"Reading methylation data from file: {methylation_data}")
-            methylation_data_path = self.processed_beta_table_dir / methylation_data
-            self.logger.info(f"methylation_data_path: {methylation_data_path}")
-            methylation_data = pd.read_csv(methylation_data_path, index_col='probeID')
-        elif not isinstance(methylation_data, pd.DataFrame):
+            return read_beta_store(methylation_data)
+        if not isinstance(methylation_data, pd.DataFrame):
             raise ValueError("methylation_data must be either a file path or a pandas DataFrame")
+        return methylation_data
+
+    def build_geo_data(self, methylation_data: pd.DataFrame, metadata: Dict[str, List] = None) -> GeoData:
+        """
+        GeoData for one matrix, with age/sex mapped from metadata by order_ecid.
         
+        :param methylation_data: Beta table indexed by probeID, one column per sample
+        :param metadata: Optional dictionary containing metadata (order_ecid, age, sex)
+        """
         geo_data = GeoData.from_methylation_matrix(methylation_data)
         
         if metadata:
@@ -92,13 +119,61 @@ class BioLearnProcessor:
             geo_data.metadata['sex'] = selected_sexes
 
             self.logger.info(f"Metadata assigned: {len(selected_ages)} ages, {len(selected_sexes)} sexes")
+        return geo_data
+
+    def run_biolearn_jobs(self, jobs: List[BiolearnJob], output_file: str = None,
+                          metadata: Dict[str, List] = None, save: bool = True) -> pd.DataFrame:
+        """
+        Run several (matrix, models) jobs: each matrix becomes one GeoData, and every model of every
+        job runs concurrently in a thread pool.
         
-        results_df = self.process_biolearn_models(geo_data, models)
-        relative_path = self.save_model_results(results_df, output_file)
+        :param jobs: Jobs to run; a model name may only appear in one job
+        :param output_file: Name of the combined output file (default: biolearn_output_name('biolearn'))
+        :param metadata: Optional dictionary containing metadata (order_ecid, age, sex)
+        :param save: Write the combined frame to output_file (False: the caller saves it, e.g. after other jobs)
+        :return: One frame with the '{model}_*' columns of all jobs, rows in the first job's sample order
+        """
+        models = [model for job in jobs for model in job.models]
+        if len(set(models)) != len(models):
+            raise ValueError(f"Each model may only appear in one job: {models}")
+        if any(model in GRIMAGE_MODELS for model in models):
+            if metadata is None or 'age' not in metadata or 'sex' not in metadata:
+                raise ValueError("Metadata with 'age' and 'sex' is required for GrimAge models")
+
+        self.logger.info(f"Starting biolearn analysis: {', '.join(f'{job.name}{job.models}' for job in jobs)}")
+        matrices = [self._read_methylation_data(job.methylation_data) for job in jobs]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(models)))) as executor:
+            geo_data = list(executor.map(lambda matrix: self.build_geo_data(matrix, metadata), matrices))
+            futures = [executor.submit(self._predict, model, data)
+                       for job, data in zip(jobs, geo_data) for model in job.models]
+            results = [future.result() for future in futures]
+
+        results = [df for df in results if df is not None]
+        if not results:
+            raise ValueError("No biolearn model produced results")
+        sample_order = matrices[0].columns
+        results_df = pd.concat(results, axis=1)
+        results_df = results_df.reindex(sample_order.append(results_df.index.difference(sample_order)))
+        if not save:
+            return results_df
+
+        relative_path = self.save_model_results(results_df, output_file or biolearn_output_name('biolearn'))
         self.logger.info(f"Processed data saved. Relative path: {relative_path}")
         self.logger.info("Biolearn analysis completed")
         return results_df
 
+    def run_biolearn(self, methylation_data: Union[str, Path, pd.DataFrame], 
+                     models: List[str], output_file: str, 
+                     metadata: Dict[str, List] = None):
+        """
+        Run the complete biolearn analysis pipeline.
+        
+        :param methylation_data: Either a path to the beta store (Parquet, or legacy CSV) or a DataFrame containing methylation data
+        :param models: List of model names to process
+        :param output_file: Name of the output file
+        :param metadata: Optional dictionary containing metadata (age, sex)
+        """
+        return self.run_biolearn_jobs([BiolearnJob('biolearn', methylation_data, models)], output_file, metadata)
 
 if __name__ == "__main__":
     from pathlib import Path
@@ -107,8 +182,7 @@ if __name__ == "__main__":
     processor = BioLearnProcessor()
     
     # 示例用法
-    beta_table_path = processor.backend_root / 'data' / 'processed_beta_table' / 'our_all_samples_processed.csv'
-    methylation_data = pd.read_csv(beta_table_path, index_col='probeID')
+    methylation_data = read_beta_store('our_all_samples_processed.parquet')
     metadata = {
         'age': [42, 42, 43, 43, 43, 28, 28, 28, 42, 42, 43, 43, 43, 28, 28, 28],
         'sex': [2, 2, 2, 2, 2, 1, 1, 1, 2, 2, 2, 2, 2, 1, 1, 1]
@@ -0,0 +1,84 @@
+# app/services/epigentl_engine.py
+import logging
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+import pandas as pd
+
+from app.services.model_registry import get_model_registry
+
+BACKEND_ROOT = Path(__file__).resolve().parents[2]
+# r_support/export_epigentl_coefficients.R 從 ExampleFiles.RData 匯出的 C_Algorithms_GitHub
+EPIGENTL_COEFFICIENT_FILE = BACKEND_ROOT / 'app' / 'resources' / 'epigentl' / 'C_Algorithms_GitHub.csv'
+
+
+class EpigenTLCoefficients:
+    """
+    The "C" algorithms of EpigenTL as arrays.
+
+    :ivar cpgs: CpGs used by the algorithms, in coefficient order
+    :ivar intercepts: float64 array (n_biomarkers,)
+    :ivar weights: float64 array (n_cpgs, n_biomarkers)
+    :ivar biomarkers: Biomarker names (e.g. 'DNAmFitAge')
+    """
+
+    def __init__(self, cpgs: pd.Index, intercepts: np.ndarray, weights: np.ndarray, biomarkers: List[str]):
+        self.cpgs = cpgs
+        self.intercepts = intercepts
+        self.weights = weights
+        self.biomarkers = biomarkers
+
+    @classmethod
+    def from_table(cls, table: pd.DataFrame) -> 'EpigenTLCoefficients':
+        """
+        :param table: C_Algorithms_GitHub: a Variable column ('Intercept', then the CpGs) and one column per biomarker
+        """
+        if table['Variable'].iloc[0] != 'Intercept':
+            raise ValueError("The first coefficient row must be the intercept")
+        coefficients = table.drop(columns='Variable').to_numpy(dtype=np.float64)
+        return cls(pd.Index(table['Variable'].iloc[1:], name='probeID'), coefficients[0],
+                   np.ascontiguousarray(coefficients[1:]), [str(c) for c in table.columns if c != 'Variable'])
+
+    @classmethod
+    def read(cls, path: Union[str, Path]) -> 'EpigenTLCoefficients':
+        return cls.from_table(pd.read_csv(path))
+
+
+class EpigenTLEngine:
+    """
+    In-process EpigenTL: Saliva.2.Blood.DNAmBiomarkers(method = "C") as one matrix product
+    [1, X] @ coefficients for all samples and biomarkers.
+    """
+
+    def __init__(self, coefficient_file: Union[str, Path] = None):
+        self.logger = logging.getLogger(__name__)
+        self.coefficient_file = Path(coefficient_file or EPIGENTL_COEFFICIENT_FILE)
+        self.model_registry = get_model_registry()
+
+    @property
+    def available(self) -> bool:
+        return self.coefficient_file.exists()
+
+    def coefficients(self) -> EpigenTLCoefficients:
+        """Coefficient tables, loaded once per process (reloaded when the file changes)."""
+        return self.model_registry.load(self.coefficient_file, EpigenTLCoefficients.read, name='epigentl_coefficients')
+
+    def predict(self, beta_table: pd.DataFrame) -> pd.DataFrame:
+        """
+        :param beta_table: Preprocessed beta table (probeID x samples) with every EpigenTL CpG and no NaN
+        :return: One row per sample (index SampleID), columns '{biomarker}_C_Pred'
+        """
+        coefficients = self.coefficients()
+        positions = beta_table.index.get_indexer(coefficients.cpgs)
+        if (positions < 0).any():
+            missing = list(coefficients.cpgs[positions < 0])
+            raise ValueError(f"Not all CpG columns are present for this prediction, missing {len(missing)}: {missing[:10]}")
+        values = np.take(beta_table.to_numpy(dtype=np.float64, copy=False), positions, axis=0)
+        if np.isnan(values).any():
+            raise ValueError("Missing values are not allowed. Please impute missing values in the beta table.")
+
+        predictions = values.T @ coefficients.weights
+        predictions += coefficients.intercepts
+        return pd.DataFrame(predictions, index=pd.Index(beta_table.columns, name='SampleID'),
+                            columns=[f"{biomarker}_C_Pred" for biomarker in coefficients.biomarkers])
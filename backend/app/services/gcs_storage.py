@@ -1,39 +1,252 @@
 # app/services/gcs_storage.py
 
-from google.cloud import storage
-from google.oauth2 import service_account
-from app.core.config import settings
+import base64
+import hashlib
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from app.core.config import settings
+
+# GCS 一次 compose 最多 32 個來源物件
+MAX_COMPOSE_COMPONENTS = 32
+
+
+class GCSTransferError(RuntimeError):
+    """One or more files of a directory/prefix transfer failed; `results` holds every file's outcome."""
+
+    def __init__(self, message: str, results: List[Dict]):
+        super().__init__(message)
+        self.results = results
+
 
 class GCSStorage:
-    def __init__(self):
+    def __init__(self, client=None, bucket=None, max_workers: int = None):
+        """
+        :param client: storage.Client to use (default: built from GOOGLE_APPLICATION_CREDENTIALS)
+        :param bucket: Bucket object to use instead of settings.GCS_BUCKET_NAME (e.g. a local fake in tests)
+        :param max_workers: Parallel transfers for directory/prefix operations (default GCS_TRANSFER_WORKERS)
+        """
+        self.logger = logging.getLogger(__name__)
         self.backend_root = Path(__file__).resolve().parents[2]
-        credential_file_name = settings.GOOGLE_APPLICATION_CREDENTIALS
-        credentials_path = self.backend_root / credential_file_name
-        self.credentials = service_account.Credentials.from_service_account_file(
-            str(credentials_path)
-        )
-        self.client = storage.Client(credentials=self.credentials)
-        self.bucket_name = settings.GCS_BUCKET_NAME
-        self.bucket = self.client.bucket(self.bucket_name)
-
-    def upload_file(self, source_file_path: str, destination_blob_name: str):
-        """Uploads a file to the bucket."""
-        blob = self.bucket.blob(destination_blob_name)
-        blob.upload_from_filename(source_file_path)
+        if bucket is None:
+            if client is None:
+                from google.cloud import storage
+                from google.oauth2 import service_account
+                credential_file_name = settings.GOOGLE_APPLICATION_CREDENTIALS
+                credentials_path = self.backend_root / credential_file_name
+                self.credentials = service_account.Credentials.from_service_account_file(
+                    str(credentials_path)
+                )
+                client = storage.Client(credentials=self.credentials)
+            bucket = client.bucket(settings.GCS_BUCKET_NAME)
+        self.client = client
+        self.bucket = bucket
+        self.bucket_name = bucket.name
+        self.max_workers = max_workers or settings.GCS_TRANSFER_WORKERS
+        self.chunk_size = settings.GCS_CHUNK_SIZE
+        self.composite_threshold = settings.GCS_COMPOSITE_THRESHOLD
+        self.composite_parts = min(settings.GCS_COMPOSITE_PARTS, MAX_COMPOSE_COMPONENTS)
+
+    def _object_name(self, gcs_path: str) -> str:
+        # 從 GCS 路徑中提取對象名稱
+        prefix = f"gs://{self.bucket_name}/"
+        return gcs_path[len(prefix):] if gcs_path.startswith(prefix) else gcs_path
+
+    def _resumable_blob(self, blob_name: str):
+        blob = self.bucket.blob(blob_name)
+        # 設定 chunk_size 後大檔案走 resumable upload, 每個 chunk 失敗時可單獨重試
+        blob.chunk_size = self.chunk_size
+        return blob
+
+    @staticmethod
+    def _local_hashes(path: Path, need_crc32c: bool) -> Tuple[Optional[str], str]:
+        """(base64 CRC32C or None, base64 MD5) of a local file, same encoding as the blob properties."""
+        crc = None
+        if need_crc32c:
+            import google_crc32c
+            crc = google_crc32c.Checksum()
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+                if crc is not None:
+                    crc.update(chunk)
+        crc32c = base64.b64encode(crc.digest()).decode() if crc is not None else None
+        return crc32c, base64.b64encode(md5.digest()).decode()
+
+    def same_content(self, local_path: Path, blob) -> bool:
+        """
+        Whether a local file and a blob have the same content.
+        Compares CRC32C when the blob has one (composite objects have no MD5), otherwise MD5.
+        """
+        if blob is None or not Path(local_path).exists():
+            return False
+        if blob.size is not None and blob.size != Path(local_path).stat().st_size:
+            return False
+        crc32c, md5 = self._local_hashes(Path(local_path), need_crc32c=bool(blob.crc32c))
+        if blob.crc32c:
+            return crc32c == blob.crc32c
+        if blob.md5_hash:
+            return md5 == blob.md5_hash
+        return False
+
+    def upload_file(self, source_file_path: str, destination_blob_name: str, skip_if_same: bool = True) -> str:
+        """Uploads a file to the bucket (resumable; large files as a parallel composite upload)."""
+        self._upload(Path(source_file_path), destination_blob_name, skip_if_same)
         return f"gs://{self.bucket_name}/{destination_blob_name}"
 
-    def download_file(self, source_blob_name: str, destination_file_name: str):
-        """Downloads a blob from the bucket."""
-        blob = self.bucket.blob(source_blob_name)
-        blob.download_to_filename(destination_file_name)
+    def _upload(self, source_file_path: Path, destination_blob_name: str, skip_if_same: bool) -> bool:
+        """:return: False when the blob was already identical and nothing was uploaded"""
+        if skip_if_same and self.same_content(source_file_path, self.bucket.get_blob(destination_blob_name)):
+            self.logger.debug(f"Skipped {source_file_path.name}: gs://{self.bucket_name}/{destination_blob_name} is identical")
+            return False
+        size = source_file_path.stat().st_size
+        if size >= self.composite_threshold and self.composite_parts > 1:
+            self._composite_upload(source_file_path, destination_blob_name, size)
+        else:
+            self._resumable_blob(destination_blob_name).upload_from_filename(str(source_file_path))
+        return True
+
+    def _composite_upload(self, source_file_path: Path, destination_blob_name: str, size: int):
+        """
+        Upload parts of the file in parallel as temporary objects, then compose them into the destination.
+        """
+        part_size = -(-size // self.composite_parts)
+        ranges = [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+        part_prefix = f"{destination_blob_name}.parts-{uuid.uuid4().hex[:8]}"
+        part_blobs = [self._resumable_blob(f"{part_prefix}/{i:02d}") for i in range(len(ranges))]
+
+        def upload_part(blob, offset, length):
+            with open(source_file_path, 'rb') as f:
+                f.seek(offset)
+                blob.upload_from_file(f, size=length)
+
+        try:
+            with ThreadPoolExecutor(max_workers=min(len(ranges), self.max_workers)) as executor:
+                futures = [executor.submit(upload_part, blob, offset, length)
+                           for blob, (offset, length) in zip(part_blobs, ranges)]
+                for future in futures:
+                    future.result()
+            self.bucket.blob(destination_blob_name).compose(part_blobs)
+            self.logger.info(f"Composite upload of {source_file_path.name} from {len(part_blobs)} parts")
+        finally:
+            for blob in part_blobs:
+                try:
+                    blob.delete()
+                except Exception:
+                    pass
+
+    def download_file(self, source_blob_name: str, destination_file_name: str, skip_if_same: bool = True) -> bool:
+        """
+        Downloads a blob from the bucket.
+
+        The data goes to `<destination>.part` first; an interrupted download resumes from the bytes
+        already on disk, and the finished file is checked against the blob's CRC32C/MD5 before it
+        replaces the destination.
+
+        :return: False when the local file was already identical and nothing was downloaded
+        """
+        source_blob_name = self._object_name(source_blob_name)
+        destination = Path(destination_file_name)
+        blob = self.bucket.get_blob(source_blob_name)
+        if blob is None:
+            raise FileNotFoundError(f"gs://{self.bucket_name}/{source_blob_name} does not exist")
+        if skip_if_same and self.same_content(destination, blob):
+            return False
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        part_path = destination.with_name(destination.name + '.part')
+        start = part_path.stat().st_size if part_path.exists() else 0
+        if blob.size is not None and start > blob.size:
+            start = 0
+        if blob.size is None or start < blob.size:
+            with open(part_path, 'ab' if start else 'wb') as f:
+                blob.download_to_file(f, start=start or None)
+        if not self.same_content(part_path, blob) and (blob.crc32c or blob.md5_hash):
+            part_path.unlink()
+            raise IOError(f"Checksum mismatch downloading gs://{self.bucket_name}/{source_blob_name}")
+        os.replace(part_path, destination)
+        return True
+
+    def _run_transfers(self, jobs: List[Tuple[str, Callable, tuple]], raise_on_error: bool) -> List[Dict]:
+        results = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(func, *args): name for name, func, args in jobs}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    outcome = future.result()
+                    results.append({'name': name, 'status': 'skipped' if outcome is False else 'done'})
+                except Exception as e:
+                    self.logger.error(f"Transfer of {name} failed: {e}")
+                    results.append({'name': name, 'status': 'failed', 'error': str(e)})
+        failed = [r for r in results if r['status'] == 'failed']
+        self.logger.info(f"Transferred {len(results) - len(failed)} files ({len(failed)} failed)")
+        if failed and raise_on_error:
+            raise GCSTransferError(f"{len(failed)} of {len(results)} transfers failed", results)
+        return results
+
+    def upload_directory(self, source_dir: str, destination_prefix: str, skip_if_same: bool = True,
+                         raise_on_error: bool = True) -> List[Dict]:
+        """
+        Upload every file under a directory in parallel, keeping the relative paths.
+
+        :return: One {'name', 'status': 'done' | 'skipped' | 'failed'} dict per file
+        """
+        source_dir = Path(source_dir)
+        destination_prefix = destination_prefix.rstrip('/')
+        jobs = []
+        for local_path in sorted(p for p in source_dir.rglob('*') if p.is_file()):
+            blob_name = f"{destination_prefix}/{local_path.relative_to(source_dir).as_posix()}".lstrip('/')
+            jobs.append((blob_name, self._upload, (local_path, blob_name, skip_if_same)))
+        return self._run_transfers(jobs, raise_on_error)
+
+    def download_files(self, blob_names: Iterable[str], destination_dir: str, strip_prefix: str = '',
+                       skip_if_same: bool = True, raise_on_error: bool = True) -> List[Dict]:
+        """
+        Download blobs in parallel into destination_dir, keeping their path below strip_prefix
+        (the full object name when strip_prefix is empty).
+        """
+        strip_prefix = self._object_name(strip_prefix).rstrip('/')
+        jobs = []
+        for blob_name in blob_names:
+            blob_name = self._object_name(blob_name)
+            if not strip_prefix:
+                relative = blob_name
+            elif blob_name.startswith(strip_prefix):
+                relative = blob_name[len(strip_prefix):].lstrip('/')
+            else:
+                relative = Path(blob_name).name
+            jobs.append((blob_name, self.download_file, (blob_name, str(Path(destination_dir) / relative), skip_if_same)))
+        return self._run_transfers(jobs, raise_on_error)
+
+    def download_prefix(self, prefix: str, destination_dir: str, skip_if_same: bool = True,
+                        raise_on_error: bool = True) -> List[Dict]:
+        """Download every blob under a prefix (e.g. a whole run directory) in parallel."""
+        prefix = self._object_name(prefix)
+        blob_names = [blob.name for blob in self.list_blobs(prefix) if not blob.name.endswith('/')]
+        return self.download_files(blob_names, destination_dir, strip_prefix=prefix,
+                                   skip_if_same=skip_if_same, raise_on_error=raise_on_error)
 
     def upload_string(self, string_data: str, destination_blob_name: str):
         """Uploads a string to the bucket."""
         blob = self.bucket.blob(destination_blob_name)
         blob.upload_from_string(string_data)
         return f"gs://{self.bucket_name}/{destination_blob_name}"
-    
+
+    def open_text(self, gcs_path: str):
+        """
+        Open a text file in GCS for streaming reads (the object is fetched in chunks, not all at once).
+
+        :param gcs_path: gs://bucket/object or an object name in this bucket
+        :return: A file-like object; use it as a context manager
+        """
+        return self.bucket.blob(self._object_name(gcs_path)).open("rt", encoding="utf-8")
+
     def download_as_text_utf8(self, gcs_path: str) -> str:
         """
         Download a file from Google Cloud Storage and return its content as a string.
@@ -42,26 +255,20 @@ class GCSStorage:
         :return: The content of the file as a string
         """
         try:
-            # 從 GCS 路徑中提取對象名稱
-            if gcs_path.startswith(f"gs://{self.bucket_name}/"):
-                object_name = gcs_path[len(f"gs://{self.bucket_name}/"):]
-            else:
-                object_name = gcs_path
+            blob = self.bucket.blob(self._object_name(gcs_path))
 
-            blob = self.bucket.blob(object_name)
-            
             # 下載為字節並解碼為字符串
             content = blob.download_as_text(encoding="utf-8")
-            
+
             return content
         except Exception as e:
             raise Exception(f"Error downloading file from GCS: {str(e)}")
-        
+
     def list_blobs(self, prefix: str):
         """
         List all blobs in the bucket with the given prefix.
-        
+
         :param prefix: The prefix to filter blobs
         :return: An iterable of blob objects
         """
-        return self.bucket.list_blobs(prefix=prefix)
\ No newline at end of file
+        return self.bucket.list_blobs(prefix=prefix)
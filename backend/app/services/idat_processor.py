@@ -1,9 +1,14 @@
 # app/services/idat_processor.py
 import pandas as pd
+import numpy as np
 import logging
 import os
 import subprocess
-import json
+import shutil
+import uuid
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List
 from app.core.config import settings
 from pathlib import Path
 import sys
@@ -11,6 +16,11 @@ project_root = Path(__file__).resolve().parents[2]
 sys.path.append(str(project_root))
 from app.db.session import SessionLocal
 from app.db import models
+from app.services.r_handoff import (use_binary_handoff, new_handoff_path, parse_r_output, read_handoff_table,
+                                    remove_handoff_file, get_scratch_dir)
+from app.services.r_worker_pool import get_r_worker_pool
+from app.services.probe_index import get_probe_codes
+from app.services.beta_store import write_beta_store
 
 
 class IDATProcessor:
@@ -19,6 +29,7 @@ class IDATProcessor:
         self.backend_root = Path(__file__).resolve().parents[2]
         self.r_script_path = settings.CHAMP_R_SCRIPT_PATH
         self.r_executable = settings.R_EXECUTABLE
+        self.array_type = settings.CHAMP_ARRAY_TYPE
 
     def process_idat(self, pd_file_path, idat_file_path) -> pd.DataFrame:
         '''
@@ -43,38 +54,43 @@ class IDATProcessor:
         if not os.path.exists(idat_file_path):
             raise FileNotFoundError(f"IDAT directory not found at {idat_file_path}")
         
+        output_path = new_handoff_path('champ') if use_binary_handoff() else None
+        output_lines = []
+        r_pool = get_r_worker_pool()
         try:
-            result = subprocess.run(
-                [self.r_executable, self.r_script_path, pd_file_path, idat_file_path],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            self.logger.info("R script execution completed")
-
-            R_stderr = result.stderr.strip()
-            #R script輸出測試-----------------------------------------------------
-            # 保存输出到文件
-            output_file_path = Path("c:/Users/yxwu/Documents/Rscript_output_temp.txt")
-            output_file_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(output_file_path, "w") as f:
-                f.write(R_stderr)
-                # f.write("\n".join(R_stderr))
-            self.logger.info(f"R script output saved to {output_file_path}")
-            #R script輸出測試-----------------------------------------------------
-
-            output_lines = result.stdout.strip().split('\n')
-            json_output = output_lines[-1]
-
-            try:
-                output = json.loads(json_output)
-            except json.JSONDecodeError as json_error:
-                self.logger.error(f"Failed to parse R script output as JSON: {json_error}")
-                self.logger.error(f"R script output: {output_lines}")
-                raise
+            if r_pool is not None:
+                # 常駐 R worker 已載入 ChAMP, 不需要重新啟動 Rscript
+                output = r_pool.run('champ', {
+                    'pd_file_path': str(pd_file_path),
+                    'idat_file_path': str(idat_file_path),
+                    'output_path': str(output_path) if output_path is not None else None,
+                    'array_type': self.array_type
+                })
+            else:
+                command = [self.r_executable, self.r_script_path, str(pd_file_path), str(idat_file_path)]
+                if output_path is not None:
+                    command.append(str(output_path))
+                result = subprocess.run(
+                    command,
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                    env={**os.environ, 'CHAMP_ARRAY_TYPE': self.array_type}
+                )
+                self.logger.info("R script execution completed")
+
+                # ChAMP 的進度訊息寫在 stderr, 和 R worker pool 一樣轉給 logger
+                for line in result.stderr.splitlines():
+                    self.logger.debug(f"R: {line.rstrip()}")
+
+                output_lines = result.stdout.strip().split('\n')
+                output = parse_r_output(result.stdout)
 
             if output['status'] == 'success':
                 self.logger.info("IDAT processing completed successfully")
+                if output['data'].get('format') == 'feather':
+                    # R 只回傳狀態, beta table 直接從 Feather 檔案讀取
+                    return read_handoff_table(output_path)
                 beta_table = output['data']['beta_table']
                 rownames = output['data']['rownames']
                 colnames = output['data']['colnames']
@@ -87,14 +103,150 @@ class IDATProcessor:
             raise
         except Exception as e:
             self.logger.error(f"Other error in processing IDAT file: {str(e)}")
-            self.logger.error(f"Full output: {output_lines}")
+            self.logger.error(f"Full output: {output_lines[-5:]}")
             raise
+        finally:
+            remove_handoff_file(output_path)
+
+    def plan_shards(self, sample_sheet: pd.DataFrame, shard_size: int) -> List[pd.DataFrame]:
+        '''
+        將 Sample Sheet 依 Sentrix_ID (晶片) 分組, 再把整片晶片裝進最多 shard_size 個樣本的分片
+
+        :param sample_sheet: Sample Sheet DataFrame
+        :param shard_size: 每個分片的最大樣本數
+        :return: 每個分片的 Sample Sheet
+        '''
+        if shard_size < 1:
+            raise ValueError("shard_size must be at least 1")
+
+        shards = []
+        current = []
+        current_size = 0
+        for _, chip in sample_sheet.groupby('Sentrix_ID', sort=False):
+            # 單一晶片超過分片大小時, 只好把晶片拆開
+            pieces = [chip.iloc[i:i + shard_size] for i in range(0, len(chip), shard_size)]
+            for piece in pieces:
+                if current and current_size + len(piece) > shard_size:
+                    shards.append(pd.concat(current))
+                    current, current_size = [], 0
+                current.append(piece)
+                current_size += len(piece)
+        if current:
+            shards.append(pd.concat(current))
+        return shards
+
+    def find_idat_files(self, idat_dir: Path, sentrix_id: str, sentrix_position: str) -> List[Path]:
+        '''
+        找出某個樣本的 Grn/Red IDAT 文件 (檔名可帶 GSM 前綴或 .gz)
+        '''
+        pattern = f"*{sentrix_id}_{sentrix_position}_*.idat*"
+        files = sorted(idat_dir.glob(pattern)) or sorted(idat_dir.rglob(pattern))
+        if not files:
+            raise FileNotFoundError(f"No IDAT files for {sentrix_id}_{sentrix_position} in {idat_dir}")
+        return files
+
+    def idat_files_for_sheet(self, pd_file_path, idat_file_path) -> Dict[str, List[Path]]:
+        '''
+        :param pd_file_path: Sample Sheet CSV 文件的路徑
+        :param idat_file_path: 包含 IDAT 文件的目錄的路徑
+        :return: Sample_Name -> 該樣本的 IDAT 文件
+        '''
+        sample_sheet = pd.read_csv(pd_file_path, dtype={'Sentrix_ID': str, 'Sentrix_Position': str})
+        idat_dir = Path(idat_file_path)
+        return {
+            row['Sample_Name']: self.find_idat_files(idat_dir, row['Sentrix_ID'], row['Sentrix_Position'])
+            for _, row in sample_sheet.iterrows()
+        }
+
+    def cache_params(self) -> Dict[str, str]:
+        '''
+        影響 ChAMP 輸出的設定, 作為 beta table 快取鍵的一部分
+        '''
+        r_script = Path(self.r_script_path)
+        return {
+            'r_script_sha256': hashlib.sha256(r_script.read_bytes()).hexdigest() if r_script.exists() else '',
+            'array_type': self.array_type,
+            'shard_size': str(settings.CHAMP_SHARD_SIZE),
+        }
+
+    def _prepare_shard_dir(self, shard_sheet: pd.DataFrame, idat_dir: Path, shard_dir: Path) -> Path:
+        '''
+        建立只含該分片 IDAT 的目錄 (symlink, 不支援時複製) 和對應的 Sample Sheet, 給 champ.load 使用
+        '''
+        shard_dir.mkdir(parents=True)
+        for _, row in shard_sheet.iterrows():
+            for idat_file in self.find_idat_files(idat_dir, row['Sentrix_ID'], row['Sentrix_Position']):
+                link_path = shard_dir / idat_file.name
+                try:
+                    link_path.symlink_to(idat_file.resolve())
+                except OSError:
+                    shutil.copy2(idat_file, link_path)
+        shard_sheet_path = shard_dir / 'Sample_Sheet.csv'
+        shard_sheet.to_csv(shard_sheet_path, index=False)
+        return shard_sheet_path
+
+    def process_idat_sharded(self, pd_file_path, idat_file_path, shard_size: int = None,
+                             max_concurrency: int = None) -> pd.DataFrame:
+        '''
+        分片執行 ChAMP: 依晶片切分 Sample Sheet, 平行處理各分片後合併成 probe 對齊的 beta table。
+        R 端的記憶體只與分片大小和同時執行的分片數有關, 與整批樣本數無關。
+
+        :param pd_file_path: Sample Sheet CSV 文件的路徑
+        :param idat_file_path: 包含 IDAT 文件的目錄的路徑
+        :param shard_size: 每個分片的最大樣本數 (預設 CHAMP_SHARD_SIZE)
+        :param max_concurrency: 同時執行的分片數 (預設 CHAMP_MAX_CONCURRENCY)
+        :return: 和 process_idat 相同格式的 DataFrame (含 probeID 列)
+        '''
+        shard_size = shard_size or settings.CHAMP_SHARD_SIZE
+        max_concurrency = max_concurrency or settings.CHAMP_MAX_CONCURRENCY
+        if shard_size < 1:
+            return self.process_idat(pd_file_path, idat_file_path)
+
+        sample_sheet = pd.read_csv(pd_file_path, dtype={'Sentrix_ID': str, 'Sentrix_Position': str})
+        shards = self.plan_shards(sample_sheet, shard_size)
+        if len(shards) <= 1:
+            return self.process_idat(pd_file_path, idat_file_path)
+
+        self.logger.info(f"Processing {len(sample_sheet)} samples in {len(shards)} ChAMP shards "
+                         f"(shard size {shard_size}, concurrency {max_concurrency})")
+        idat_dir = Path(idat_file_path)
+        work_dir = get_scratch_dir() / f"champ_shards_{uuid.uuid4().hex}"
+        merged = None
+        try:
+            shard_inputs = []
+            for i, shard_sheet in enumerate(shards):
+                shard_dir = work_dir / f"shard_{i:03d}"
+                shard_inputs.append((self._prepare_shard_dir(shard_sheet, idat_dir, shard_dir), shard_dir))
+
+            # 每個分片是獨立的 R 進程 (或 R worker), 這裡的 thread 只負責等待結果
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                futures = {
+                    executor.submit(self.process_idat, str(sheet_path), str(shard_dir)): i
+                    for i, (sheet_path, shard_dir) in enumerate(shard_inputs)
+                }
+                for future in as_completed(futures):
+                    shard_beta = future.result().set_index('probeID').astype('float32', copy=False)
+                    self.logger.info(f"Shard {futures[future]} done: {shard_beta.shape[0]} probes x {shard_beta.shape[1]} samples")
+                    # 逐一合併, 只保留所有分片都通過 ChAMP 過濾的 probe
+                    merged = shard_beta if merged is None else merged.join(shard_beta, how='inner')
+                    del shard_beta
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        # 依 Sample Sheet 的順序排列樣本
+        sample_order = [name for name in sample_sheet['Sample_Name'] if name in merged.columns]
+        sample_order += [name for name in merged.columns if name not in set(sample_order)]
+        merged = merged[sample_order].sort_index()
+        self.logger.info(f"Merged shards: {merged.shape[0]} probes x {merged.shape[1]} samples")
+        merged.index.name = 'probeID'
+        return merged.reset_index()
 
-    def champ_df_postprocess(self, beta_table: pd.DataFrame) -> pd.DataFrame:
+    def champ_df_postprocess(self, beta_table: pd.DataFrame, inplace: bool = False) -> pd.DataFrame:
         '''
         後處理 CHAMP 輸出的 beta_table DataFrame
 
         :param beta_table: 從 CHAMP 腳本獲得的 beta_table DataFrame
+        :param inplace: 直接使用 beta_table 的記憶體存放結果 (之後不可再使用 beta_table), 避免峰值記憶體加倍
         :return: 去除重複probe(重複的取平均)後的 DataFrame
         '''
         if 'probeID' not in beta_table.columns:
@@ -103,20 +255,24 @@ class IDATProcessor:
         if beta_table.index.name != 'probeID':
             beta_table.set_index('probeID', inplace=True)
         
-        grouped = beta_table.groupby(beta_table.index.str[:10])
-        return grouped.mean()
+        # 以預先計算的 probe -> canonical probe 代碼做數值平均, 取代 index.str[:10] 的字串 groupby
+        probe_index, codes = get_probe_codes(self.array_type, beta_table.index)
+        values = beta_table.to_numpy(dtype=np.float32)
+        collapsed, probe_ids = probe_index.collapse(values, codes, inplace=inplace)
+        if not inplace and np.shares_memory(collapsed, beta_table.values):
+            collapsed = collapsed.copy()
+        return pd.DataFrame(collapsed, index=pd.Index(probe_ids, name='probeID'), columns=beta_table.columns)
 
     def save_processed_data(self, beta_table_rmdup: pd.DataFrame, batch_name: str) -> str:
         '''
-        保存處理後的數據到 CSV 文件並更新數據庫
+        保存處理後的數據到 Parquet probe store 並更新數據庫
         
         :param beta_table_rmdup: 處理後的 DataFrame
         :param batch_name: 樣本名稱，用於生成文件名
         :return: 保存的文件的相對路徑
         '''
         processed_beta_table_dir = self.backend_root / 'data' / 'processed_beta_table'
-        output_file = processed_beta_table_dir / f"{batch_name}_processed.csv"
-        beta_table_rmdup.to_csv(output_file, index=True)
+        output_file = write_beta_store(beta_table_rmdup, processed_beta_table_dir / f"{batch_name}_processed.parquet")
         self.logger.info(f"Processed data saved to {output_file}")
         relative_path = output_file.relative_to(self.backend_root).as_posix()
         
@@ -158,6 +314,7 @@ if __name__ == "__main__":
     parser.add_argument("pd_file_path", help="Path to the Sample Sheet CSV file")
     parser.add_argument("idat_file_path", help="Path to the directory containing IDAT files")
     parser.add_argument("--batch_name", help="Name of the batch for output file", required=True)
+    parser.add_argument("--shard_size", type=int, default=0, help="Max samples per ChAMP shard (0 = no sharding)")
     args = parser.parse_args()
 
     processor = IDATProcessor()
@@ -165,7 +322,7 @@ if __name__ == "__main__":
     try:
         # 示例用法
         # python app/services/idat_processor.py "D:/SideProject/EpiAging/SVD_test/raw/Sample_Sheet.csv" "D:/SideProject/EpiAging/SVD_test/raw" --batch_name our_all_samples
-        result = processor.process_idat(args.pd_file_path, args.idat_file_path)
+        result = processor.process_idat_sharded(args.pd_file_path, args.idat_file_path, shard_size=args.shard_size)
         if isinstance(result, pd.DataFrame):
             processed_result = processor.champ_df_postprocess(result)
             print("Processing completed. Sample of processed data:")
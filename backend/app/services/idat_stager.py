@@ -0,0 +1,212 @@
+# app/services/idat_stager.py
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from app.core.config import settings
+from app.db import models
+from app.db.session import SessionLocal
+from app.services.sample_ingest import idat_file_paths
+
+BACKEND_ROOT = Path(__file__).resolve().parents[2]
+
+
+class StagedBatch:
+    """
+    A sample sheet and its IDATs copied from GCS into the local scratch cache.
+
+    :ivar pd_file_path: Local path of the sample sheet
+    :ivar idat_dir: Local directory holding the IDATs (pass both to IdatReportGenerator.process_data)
+    :ivar files: Every local file of the batch; they are protected from eviction until released
+    """
+
+    def __init__(self, pd_file_path: Path, idat_dir: Path, files: List[Path]):
+        self.pd_file_path = pd_file_path
+        self.idat_dir = idat_dir
+        self.files = files
+
+
+class IdatStager:
+    """
+    Stages IDATs from GCS onto local disk for ChAMP.
+
+    Objects are mirrored under cache_dir with their bucket paths, so a run that was staged before
+    is only checked (CRC32C) and not downloaded again. The cache is bounded by max_bytes; the least
+    recently used files are removed first, except those of batches that are still in use.
+    prefetch() stages the next batch in the background while the current one is normalizing.
+    """
+
+    def __init__(self, gcs_storage=None, cache_dir: Union[str, Path] = None, max_bytes: int = None):
+        self.logger = logging.getLogger(__name__)
+        self._gcs_storage = gcs_storage
+        self.cache_dir = Path(cache_dir or settings.IDAT_STAGING_DIR or BACKEND_ROOT / 'data' / 'cache' / 'idat_staging')
+        self.max_bytes = settings.IDAT_STAGING_MAX_BYTES if max_bytes is None else max_bytes
+        self._pinned: Dict[Path, int] = {}
+        self._lock = threading.Lock()
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='idat-prefetch')
+
+    @property
+    def gcs_storage(self):
+        if self._gcs_storage is None:
+            from app.services.gcs_storage import GCSStorage
+            self._gcs_storage = GCSStorage()
+        return self._gcs_storage
+
+    def local_path(self, gcs_path: str) -> Path:
+        return self.cache_dir / self.gcs_storage._object_name(gcs_path)
+
+    def idat_blobs_for_sheet(self, sample_sheet: pd.DataFrame, idat_prefix: str) -> List[str]:
+        """
+        Object names of the Grn/Red IDATs of every sample in the sheet.
+        Uses SampleData.idat_file when the sample is in the database, otherwise the
+        {prefix}/{Sentrix_ID}_{Sentrix_Position}_{Grn,Red}.idat naming.
+        """
+        idat_prefix = self.gcs_storage._object_name(idat_prefix).rstrip('/')
+        db = SessionLocal()
+        try:
+            rows = db.query(models.SampleData.Sentrix_ID, models.SampleData.Sentrix_Position, models.SampleData.idat_file).filter(
+                models.SampleData.Sentrix_ID.in_(sample_sheet['Sentrix_ID'].unique().tolist())).all()
+        except Exception as e:
+            self.logger.warning(f"Could not read SampleData.idat_file, using the IDAT naming convention: {e}")
+            rows = []
+        finally:
+            db.close()
+        known = {(sentrix_id, position): idat_file for sentrix_id, position, idat_file in rows if idat_file}
+
+        blobs = []
+        for sentrix_id, position in sample_sheet[['Sentrix_ID', 'Sentrix_Position']].itertuples(index=False):
+            idat_file = known.get((sentrix_id, position)) or idat_file_paths(idat_prefix, sentrix_id, position)
+            blobs.extend(self.gcs_storage._object_name(path.strip()) for path in idat_file.split(','))
+        return blobs
+
+    def stage(self, pd_file_gcs_path: str, idat_gcs_prefix: str) -> StagedBatch:
+        """
+        Download a sample sheet and the IDATs it lists (in parallel), pinning them in the cache.
+
+        :param pd_file_gcs_path: gs:// path of Sample_Sheet.csv
+        :param idat_gcs_prefix: gs:// directory of the run's IDATs
+        :return: StagedBatch with local paths; call release() when ChAMP is done with it
+        """
+        pd_blob = self.gcs_storage._object_name(pd_file_gcs_path)
+        sheet_path = self.local_path(pd_blob)
+        # 下載前就 pin, 避免同時執行的 evict() (例如 prefetch 執行緒) 在讀取前刪掉 Sample Sheet
+        self._pin([sheet_path])
+        idat_files = []
+        try:
+            self.gcs_storage.download_file(pd_blob, str(sheet_path))
+            sample_sheet = pd.read_csv(sheet_path, dtype={'Sentrix_ID': str, 'Sentrix_Position': str})
+            idat_blobs = self.idat_blobs_for_sheet(sample_sheet, idat_gcs_prefix)
+            idat_prefix = self.gcs_storage._object_name(idat_gcs_prefix).rstrip('/') + '/'
+            outside = [blob for blob in idat_blobs if not blob.startswith(idat_prefix)]
+            if outside:
+                # champ.load 只讀 idat_dir 底下的文件
+                self.logger.warning(f"{len(outside)} IDATs are not under {idat_gcs_prefix}, e.g. {outside[0]}")
+            idat_files = [self.local_path(blob) for blob in idat_blobs]
+            self._pin(idat_files)
+            # 下載到與 bucket 相同的相對路徑, 已存在且 CRC32C 相同的文件不會重新下載
+            results = self.gcs_storage.download_files(idat_blobs, str(self.cache_dir), strip_prefix='')
+        except Exception:
+            self._unpin([sheet_path] + idat_files)
+            raise
+        files = [sheet_path] + idat_files
+        # 更新 mtime 作為 LRU 的最近使用時間
+        for path in files:
+            os.utime(path)
+        downloaded = sum(result['status'] == 'done' for result in results)
+        self.logger.info(f"Staged {len(files)} files for {pd_file_gcs_path} ({downloaded} downloaded)")
+        self.evict()
+        return StagedBatch(files[0], self.local_path(idat_prefix), files)
+
+    def prefetch(self, pd_file_gcs_path: str, idat_gcs_prefix: str) -> Future:
+        """Stage a batch in the background; the future's result is the StagedBatch."""
+        return self._prefetch_executor.submit(self.stage, pd_file_gcs_path, idat_gcs_prefix)
+
+    def staged_batches(self, batches: Iterable[Tuple[str, str]]) -> Iterator[StagedBatch]:
+        """
+        Yield each (sample sheet, IDAT prefix) batch staged locally, downloading batch n+1 while
+        the caller is still processing batch n. Each batch is released when the next one is requested.
+        """
+        batches = iter(batches)
+        first = next(batches, None)
+        if first is None:
+            return
+        pending = self.prefetch(*first)
+        while pending is not None:
+            staged = pending.result()
+            following = next(batches, None)
+            pending = self.prefetch(*following) if following is not None else None
+            try:
+                yield staged
+            finally:
+                self.release(staged)
+
+    def release(self, batch: StagedBatch):
+        self._unpin(batch.files)
+
+    def _pin(self, files: List[Path]):
+        with self._lock:
+            for path in files:
+                self._pinned[path] = self._pinned.get(path, 0) + 1
+
+    def _unpin(self, files: List[Path]):
+        with self._lock:
+            for path in files:
+                count = self._pinned.get(path, 0) - 1
+                if count > 0:
+                    self._pinned[path] = count
+                else:
+                    self._pinned.pop(path, None)
+
+    def evict(self) -> List[Path]:
+        """
+        Remove least recently used files until the cache fits in max_bytes; pinned files and the
+        .part files of downloads in progress are kept.
+
+        :return: Removed files
+        """
+        if not self.cache_dir.exists():
+            return []
+        with self._lock:
+            entries = []
+            for path in self.cache_dir.rglob('*'):
+                try:
+                    if path.is_file():
+                        stat = path.stat()
+                        entries.append((stat.st_mtime, stat.st_size, path))
+                except FileNotFoundError:
+                    # 下載完成時 .part 被改名
+                    continue
+            total = sum(size for _, size, _ in entries)
+            removed = []
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                # .part 是進行中 (或可續傳) 的下載, 只 pin 了最終路徑, 不可刪除
+                if path in self._pinned or path.name.endswith('.part'):
+                    continue
+                path.unlink(missing_ok=True)
+                total -= size
+                removed.append(path)
+        if removed:
+            self.logger.info(f"Evicted {len(removed)} staged IDAT files")
+        return removed
+
+    def shutdown(self):
+        self._prefetch_executor.shutdown(wait=True)
+
+
+_stager: Optional[IdatStager] = None
+_stager_lock = threading.Lock()
+
+
+def get_idat_stager() -> IdatStager:
+    global _stager
+    with _stager_lock:
+        if _stager is None:
+            _stager = IdatStager()
+        return _stager
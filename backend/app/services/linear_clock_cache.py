@@ -0,0 +1,188 @@
+# app/services/linear_clock_cache.py
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from app.core.config import settings
+
+# biolearn hybrid_impute: 樣本中有值比例低於此門檻的 probe 改用參考值
+HYBRID_IMPUTE_THRESHOLD = 0.8
+# ModelGallery.get 的 imputation 方法 -> (參考值檔案, 欄位)
+IMPUTATION_REFERENCES = {
+    'sesame_450k': ('sesame_450k_median.csv', 'median'),
+    'dunedin': ('DunedinPACE_Gold_Means.csv', 'mean'),
+}
+
+
+class LinearClock:
+    """
+    A biolearn linear methylation clock evaluated as one dense dot product.
+
+    Gives the same result as ModelGallery().get(name).predict(): optional preprocessing, the
+    model's default imputation ('none', 'averaging' or hybrid with reference values), the sum of
+    weight * beta over the clock's probes (NaN counts as 0, like the pandas sum) and the transform.
+
+    :ivar probe_ids: Probes of the clock
+    :ivar weights: float64 coefficients, one per probe
+    """
+
+    def __init__(self, name: str, probe_ids: pd.Index, weights: np.ndarray, transform: Callable,
+                 preprocess: Callable = None, imputation: str = 'none', reference: pd.Series = None):
+        self.name = name
+        self.probe_ids = probe_ids
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.transform = transform
+        self.preprocess = preprocess
+        self.imputation = imputation
+        self.reference = None if reference is None else reference.reindex(probe_ids).to_numpy(dtype=np.float64)
+        # 最近一次對齊的 matrix index 與位置
+        self._aligned = None
+
+    def positions(self, probe_index: pd.Index) -> np.ndarray:
+        """Row of each clock probe in the matrix (-1 when absent), cached for the same index object."""
+        aligned = self._aligned
+        if aligned is not None and aligned[0] is probe_index:
+            return aligned[1]
+        positions = probe_index.get_indexer(self.probe_ids)
+        self._aligned = (probe_index, positions)
+        return positions
+
+    def _impute(self, rows: np.ndarray, found: np.ndarray) -> np.ndarray:
+        if self.imputation == 'none':
+            return rows
+        missing = np.isnan(rows)
+        counts = (~missing).sum(axis=1)
+        # 每個 probe 在這批樣本中的平均值 (impute_from_average)
+        row_means = np.where(missing, 0.0, rows).sum(axis=1) / np.maximum(counts, 1)
+        if self.reference is None:
+            # averaging: 只補已有 probe 的 NaN
+            averaged = found
+        else:
+            averaged = found & (counts / max(rows.shape[1], 1) >= HYBRID_IMPUTE_THRESHOLD)
+        fill = averaged[:, None] & missing
+        rows[fill] = np.broadcast_to(row_means[:, None], rows.shape)[fill]
+        if self.reference is not None:
+            from_reference = ~averaged
+            unknown = from_reference & np.isnan(self.reference)
+            if unknown.any():
+                raise ValueError(f"Tried to fill the following cpgs but they were missing from cpg_source: "
+                                 f"{list(self.probe_ids[unknown])}")
+            rows[from_reference] = self.reference[from_reference, None]
+        return rows
+
+    def predict(self, matrix: pd.DataFrame) -> pd.DataFrame:
+        """
+        :param matrix: Beta values indexed by probeID, one column per sample (GeoData.dnam)
+        :return: DataFrame with a 'Predicted' column, indexed by sample
+        """
+        if self.preprocess is not None:
+            matrix = self.preprocess(matrix)
+        positions = self.positions(matrix.index)
+        found = positions >= 0
+        values = matrix.to_numpy(dtype=np.float64, copy=False)
+        rows = np.full((len(positions), values.shape[1]), np.nan)
+        rows[found] = values[positions[found]]
+        rows = self._impute(rows, found)
+        sums = self.weights @ np.nan_to_num(rows, nan=0.0)
+        return pd.Series(sums, index=matrix.columns).apply(self.transform).to_frame(name="Predicted")
+
+
+class LinearClockCache:
+    """
+    Clocks loaded once per worker (warm() at startup) instead of through ModelGallery on every call.
+
+    Linear methylation clocks become LinearClock objects; other models (e.g. GrimAge) keep the
+    gallery instance, so their coefficient tables are still read only once.
+    """
+
+    def __init__(self, models: List[str] = None, gallery=None):
+        self.logger = logging.getLogger(__name__)
+        self.models = list(models) if models is not None else [
+            name.strip() for name in settings.LINEAR_CLOCK_MODELS.split(',') if name.strip()]
+        self._gallery = gallery
+        self._clocks: Dict[str, object] = {}
+        self._lock = threading.Lock()
+        self.load_seconds: Dict[str, float] = {}
+        self.startup_seconds: Optional[float] = None
+
+    @property
+    def gallery(self):
+        if self._gallery is None:
+            from biolearn.model_gallery import ModelGallery
+            self._gallery = ModelGallery()
+        return self._gallery
+
+    def warm(self) -> Dict[str, float]:
+        """
+        Load every configured clock and record the startup time against LINEAR_CLOCK_STARTUP_BUDGET_SECONDS.
+
+        :return: Model name -> load seconds
+        """
+        start = time.perf_counter()
+        for name in self.models:
+            try:
+                self.get(name)
+            except Exception as e:
+                self.logger.error(f"Could not warm clock {name}: {e}")
+        self.startup_seconds = time.perf_counter() - start
+        budget = settings.LINEAR_CLOCK_STARTUP_BUDGET_SECONDS
+        message = (f"Clock cache warmed in {self.startup_seconds:.2f}s (budget {budget:.0f}s): "
+                   + ', '.join(f"{name} {seconds:.2f}s" for name, seconds in self.load_seconds.items()))
+        if self.startup_seconds > budget:
+            self.logger.warning(message)
+        else:
+            self.logger.info(message)
+        return dict(self.load_seconds)
+
+    def get(self, name: str):
+        """:return: LinearClock for linear methylation clocks, otherwise the gallery model"""
+        with self._lock:
+            if name not in self._clocks:
+                start = time.perf_counter()
+                self._clocks[name] = self._build(name)
+                self.load_seconds[name] = time.perf_counter() - start
+            return self._clocks[name]
+
+    def _build(self, name: str):
+        from biolearn.model import LinearMethylationModel
+        from biolearn.util import get_data_file
+
+        model = self.gallery.get(name)
+        clock = getattr(model, 'clock', model)
+        if not isinstance(clock, LinearMethylationModel):
+            return model
+        model_def = self.gallery.model_definitions[name]['model']
+        imputation = model_def.get('default_imputation', 'sesame_450k')
+        reference = None
+        if imputation in IMPUTATION_REFERENCES:
+            file_name, column = IMPUTATION_REFERENCES[imputation]
+            reference = pd.read_csv(get_data_file(file_name), index_col=0)[column]
+        elif imputation not in ('none', 'averaging'):
+            return model
+        coefficients = clock.coefficients['CoefficientTraining']
+        return LinearClock(name, pd.Index(coefficients.index, name='probeID'), coefficients.to_numpy(),
+                           clock.transform, preprocess=model_def.get('preprocess'),
+                           imputation=imputation, reference=reference)
+
+    def predict(self, name: str, geo_data) -> pd.DataFrame:
+        """Same output as ModelGallery().get(name).predict(geo_data)."""
+        clock = self.get(name)
+        if isinstance(clock, LinearClock):
+            return clock.predict(geo_data.dnam)
+        return clock.predict(geo_data)
+
+
+_cache: Optional[LinearClockCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_linear_clock_cache() -> LinearClockCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LinearClockCache()
+        return _cache
@@ -6,6 +6,57 @@ from pathlib import Path
 import logging
 from typing import Dict, Union, List
 
+from app.core.config import settings
+from app.services.model_registry import get_model_registry
+
+# quantile_transform 使用的百分位 (0, 1, ..., 100)
+QUANTILE_LEVELS = np.arange(0, 101)
+
+
+def quantile_table(data: pd.DataFrame, features: List[str]) -> np.ndarray:
+    """:return: (len(QUANTILE_LEVELS), len(features)) percentiles of each feature column"""
+    return np.percentile(data[features].to_numpy(dtype=np.float64), QUANTILE_LEVELS, axis=0)
+
+
+def interp_columns(x: np.ndarray, xp: np.ndarray, fp: np.ndarray) -> np.ndarray:
+    """
+    np.interp applied to every column at once: column j of x is mapped from xp[:, j] to fp[:, j].
+
+    :param x: (n_samples, n_features) values
+    :param xp: (n_points, n_features) increasing sample points per feature (ties allowed)
+    :param fp: (n_points, n_features) values at xp
+    :return: (n_samples, n_features) float64 array, identical to np.interp per column
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n_points = xp.shape[0]
+    # np.interp 的區間: 最後一個 xp[j] <= x
+    upper = (xp[None, :, :] <= x[:, None, :]).sum(axis=1)
+    lower = np.clip(upper - 1, 0, n_points - 2)
+    columns = np.arange(x.shape[1])
+    x0, x1 = xp[lower, columns], xp[lower + 1, columns]
+    f0, f1 = fp[lower, columns], fp[lower + 1, columns]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = f0 + (x - x0) * (f1 - f0) / (x1 - x0)
+    result = np.where(upper == 0, fp[0], result)
+    result = np.where(upper == n_points, fp[-1], result)
+    result[np.isnan(x)] = np.nan
+    return result
+
+
+def write_quantile_reference(quantiles: np.ndarray, features: List[str], path: Union[str, Path]) -> Path:
+    """Save a quantile table (QUANTILE_LEVELS x features) as an npz."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(path, features=np.asarray(features, dtype=str), quantiles=np.asarray(quantiles, dtype=np.float64))
+    return path
+
+
+def read_quantile_reference(path: Union[str, Path]) -> pd.DataFrame:
+    """:return: Quantile table with one column per feature, one row per QUANTILE_LEVELS entry"""
+    with np.load(path) as data:
+        return pd.DataFrame(data['quantiles'], columns=data['features'].astype(object))
+
+
 class MentalHealthProcessor:
     def __init__(self, classifier='logistic'):
         self.logger = logging.getLogger(__name__)
@@ -14,14 +65,20 @@ class MentalHealthProcessor:
         self.classifier = classifier
         self.model_file = self.resource_dir / 'mentalhealth_assets' / f'mdd_prediction_{classifier}.pkl'
         self.blood_data_file = self.resource_dir / 'mentalhealth_assets' / 'biolearn_GSE201287_training.csv'
-        self.model = self.load_model()
-        self.blood_data = self.load_blood_data()
+        # 唾液 EpigenTL 結果的參考分布 (scripts_manual/build_mentalhealth_saliva_reference.py 產生)
+        self.saliva_reference_file = self.resource_dir / 'mentalhealth_assets' / 'saliva_reference_quantiles.npz'
+        self.quantile_mode = settings.MENTALHEALTH_QUANTILE_MODE.lower()
+        self.min_batch_samples = settings.MENTALHEALTH_MIN_BATCH_SAMPLES
+        self.model_registry = get_model_registry()
         self.feature_mapping = {
             'adm': 'DNAmADM_C_Pred',
             'cystatin': 'DNAmCystatinC_C_Pred',
             'pai1': 'DNAmPAI1_C_Pred',
             'timp': 'DNAmTIMP1_C_Pred'
         }
+        self.model = self.load_model()
+        # 血液訓練資料的百分位表, 每個 process 只計算一次
+        self.blood_quantiles = self.load_blood_quantiles()
         self.logger.info(f"MentalHealthProcessor initialized with classifier: {classifier}")
 
     def load_model(self):
@@ -42,16 +99,50 @@ class MentalHealthProcessor:
         self.logger.info("Blood data loaded successfully")
         return blood_data
 
+    def load_blood_quantiles(self) -> np.ndarray:
+        """(QUANTILE_LEVELS x training features) of the blood training data, cached by the model registry"""
+        if not self.blood_data_file.exists():
+            self.logger.error(f"Blood data file not found: {self.blood_data_file}")
+            raise FileNotFoundError(f"Blood data file not found: {self.blood_data_file}")
+        features = list(self.feature_mapping.keys())
+        return self.model_registry.load(self.blood_data_file,
+                                        lambda path: quantile_table(pd.read_csv(path), features),
+                                        name='mentalhealth_blood_quantiles')
+
+    def saliva_reference_quantiles(self) -> Union[np.ndarray, None]:
+        """Stored saliva quantiles in feature_mapping order, or None when the reference has not been built"""
+        if not self.saliva_reference_file.exists():
+            return None
+        reference = self.model_registry.load(self.saliva_reference_file, read_quantile_reference,
+                                             name='mentalhealth_saliva_reference')
+        return reference[list(self.feature_mapping.values())].to_numpy()
+
+    def saliva_quantiles(self, saliva_values: np.ndarray) -> np.ndarray:
+        """
+        Source quantiles for the transform, by MENTALHEALTH_QUANTILE_MODE:
+        'batch' uses the batch itself, 'reference' the stored saliva distribution, and 'auto' the
+        reference when the batch has fewer than MENTALHEALTH_MIN_BATCH_SAMPLES samples.
+        """
+        if self.quantile_mode not in ('auto', 'batch', 'reference'):
+            raise ValueError(f"Unsupported MENTALHEALTH_QUANTILE_MODE: {self.quantile_mode}")
+        use_reference = self.quantile_mode == 'reference' or (
+            self.quantile_mode == 'auto' and len(saliva_values) < self.min_batch_samples)
+        if use_reference:
+            reference = self.saliva_reference_quantiles()
+            if reference is not None:
+                return reference
+            if self.quantile_mode == 'reference':
+                raise FileNotFoundError(f"Saliva reference not found: {self.saliva_reference_file}")
+            self.logger.warning(f"{self.saliva_reference_file.name} not found, "
+                                f"using the quantiles of a batch of {len(saliva_values)} samples")
+        return np.percentile(saliva_values, QUANTILE_LEVELS, axis=0)
+
     def quantile_transform(self, saliva_df: pd.DataFrame) -> pd.DataFrame:
         self.logger.info("Performing quantile transformation")
-        transformed_saliva = pd.DataFrame()
-        for training_feature, db_feature in self.feature_mapping.items():
-            self.logger.info(f"Transforming feature: {db_feature} to {training_feature}")
-            blood_quantiles = np.percentile(self.blood_data[training_feature], np.arange(0, 101))
-            saliva_quantiles = np.percentile(saliva_df[db_feature], np.arange(0, 101))
-            transformed_saliva[training_feature] = np.interp(saliva_df[db_feature], saliva_quantiles, blood_quantiles)
+        saliva_values = saliva_df[list(self.feature_mapping.values())].to_numpy(dtype=np.float64)
+        transformed = interp_columns(saliva_values, self.saliva_quantiles(saliva_values), self.blood_quantiles)
         self.logger.info("Quantile transformation completed")
-        return transformed_saliva
+        return pd.DataFrame(transformed, columns=list(self.feature_mapping.keys()))
 
     def predict_mentalhealth(self, saliva_data: pd.DataFrame) -> Dict[str, Union[np.ndarray, np.ndarray]]:
         self.logger.info("Predicting mental health")
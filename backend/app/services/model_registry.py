@@ -0,0 +1,121 @@
+# app/services/model_registry.py
+import hashlib
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+
+class _Entry:
+    def __init__(self, value: Any, stat_key: Tuple[int, int], digest: Optional[str], load_seconds: float):
+        self.value = value
+        self.stat_key = stat_key
+        self.digest = digest
+        self.load_seconds = load_seconds
+        self.hits = 0
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of model resources (pickled models, probe lists, coefficient tables).
+
+    Each resource is loaded once per process by its loader function. Every lookup stats the file;
+    when its size or mtime changed, the content hash decides whether it is really reloaded (a
+    redeploy that only touches the file keeps the loaded object).
+
+    Hashing and loading hold only the lock of that resource, so a slow cold load (e.g. the LASSO
+    models) does not block lookups of other resources from other stages or batches.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._entries: Dict[Tuple[str, str], _Entry] = {}
+        # 只保護 dict 存取; 載入時使用每個資源自己的鎖
+        self._lock = threading.Lock()
+        self._key_locks: Dict[Tuple[str, str], threading.RLock] = {}
+
+    @staticmethod
+    def _stat_key(path: Path) -> Tuple[int, int]:
+        stat = path.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _digest(path: Path) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def load(self, path: Union[str, Path], loader: Callable[[Path], Any], name: str = None) -> Any:
+        """
+        :param path: Resource file
+        :param loader: Function that turns the file into the cached object
+        :param name: Cache name of this view of the file (default: the loader's qualified name),
+                     so the same file can be cached in different forms
+        :return: The cached (or freshly loaded) object
+        """
+        path = Path(path).resolve()
+        key = (str(path), name or getattr(loader, '__qualname__', repr(loader)))
+        with self._lock:
+            entry = self._entries.get(key)
+            key_lock = self._key_locks.setdefault(key, threading.RLock())
+        stat_key = self._stat_key(path)
+        if entry is not None and entry.stat_key == stat_key:
+            with self._lock:
+                entry.hits += 1
+            return entry.value
+
+        with key_lock:
+            # 等待鎖的期間其他執行緒可能已經載入
+            with self._lock:
+                entry = self._entries.get(key)
+            stat_key = self._stat_key(path)
+            if entry is not None and entry.stat_key == stat_key:
+                with self._lock:
+                    entry.hits += 1
+                return entry.value
+
+            digest = self._digest(path)
+            if entry is not None and entry.digest == digest:
+                # 只有 mtime 改變, 內容相同
+                with self._lock:
+                    entry.stat_key = stat_key
+                    entry.hits += 1
+                return entry.value
+
+            start = time.perf_counter()
+            value = loader(path)
+            load_seconds = time.perf_counter() - start
+            with self._lock:
+                self._entries[key] = _Entry(value, stat_key, digest, load_seconds)
+            self.logger.info(f"{'Reloaded' if entry is not None else 'Loaded'} {path.name} ({key[1]}) in {load_seconds:.2f}s")
+            return value
+
+    def invalidate(self, path: Union[str, Path] = None):
+        """Drop one file's cached objects (or everything when path is None)."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                return
+            resolved = str(Path(path).resolve())
+            for key in [key for key in self._entries if key[0] == resolved]:
+                del self._entries[key]
+
+    def stats(self) -> list:
+        with self._lock:
+            return [{'path': path, 'name': name, 'hits': entry.hits, 'load_seconds': entry.load_seconds}
+                    for (path, name), entry in self._entries.items()]
+
+
+_registry: Optional[ModelRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_model_registry() -> ModelRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+        return _registry
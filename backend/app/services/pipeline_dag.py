@@ -0,0 +1,169 @@
+# app/services/pipeline_dag.py
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    :ivar name: Stage name, used in logs and timings
+    :ivar func: Called without arguments once every input is available; its return value is kept in StageRun.result
+    :ivar inputs: Names of the data the stage reads (outputs of other stages)
+    :ivar outputs: Names of the data the stage produces
+    """
+
+    def __init__(self, name: str, func: Callable, inputs: List[str] = (), outputs: List[str] = ()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+
+class StageRun:
+    """
+    Result of one stage: status is 'done', 'failed' or 'skipped' (an upstream stage failed);
+    'running' while the stage is executing.
+
+    :ivar seconds: Run time of the stage itself
+    :ivar finished_at: Seconds since the start of the graph when the stage ended
+    """
+
+    def __init__(self, name: str, status: str, seconds: float = 0.0, finished_at: float = 0.0,
+                 result=None, error: Optional[BaseException] = None):
+        self.name = name
+        self.status = status
+        self.seconds = seconds
+        self.finished_at = finished_at
+        self.result = result
+        self.error = error
+
+
+class StageGraph:
+    """
+    Runs stages as soon as the stages producing their inputs have finished, with independent
+    branches in parallel on a thread pool (the stages wait on R, NumPy or the database, which
+    release the GIL). The wall time becomes the longest dependency chain instead of the sum.
+    """
+
+    def __init__(self, max_workers: int = 4, listener: Callable[[StageRun], None] = None):
+        """
+        :param max_workers: Maximum number of stages running at the same time
+        :param listener: Called with a 'running' StageRun when a stage starts and with its final StageRun
+                         when it finishes (e.g. progress reporting)
+        """
+        self.logger = logging.getLogger(__name__)
+        self.max_workers = max(1, max_workers)
+        self.listener = listener
+        self.stages: Dict[str, Stage] = {}
+        self.runs: Dict[str, StageRun] = {}
+        self.wall_seconds: Optional[float] = None
+
+    def add(self, name: str, func: Callable, inputs: List[str] = (), outputs: List[str] = ()) -> 'StageGraph':
+        if name in self.stages:
+            raise ValueError(f"Duplicate stage: {name}")
+        self.stages[name] = Stage(name, func, inputs, outputs)
+        return self
+
+    def dependencies(self) -> Dict[str, List[str]]:
+        """
+        :return: Stage name -> names of the stages producing its inputs
+        :raises ValueError: An input nobody produces, an output produced twice, or a cycle
+        """
+        producers = {}
+        for stage in self.stages.values():
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError(f"{output} is produced by both {producers[output]} and {stage.name}")
+                producers[output] = stage.name
+        dependencies = {}
+        for stage in self.stages.values():
+            unknown = [i for i in stage.inputs if i not in producers]
+            if unknown:
+                raise ValueError(f"Stage {stage.name} reads {unknown}, which no stage produces")
+            dependencies[stage.name] = sorted({producers[i] for i in stage.inputs})
+
+        # Kahn: 所有 stage 都能排序才沒有環
+        remaining = {name: set(deps) for name, deps in dependencies.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Stage graph has a cycle between {sorted(remaining)}")
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return dependencies
+
+    def run(self) -> Dict[str, StageRun]:
+        """
+        Run every stage. A failed stage does not stop independent branches; stages downstream of it
+        are skipped. Once nothing is left to run, the error of the first failed stage is raised.
+
+        :return: Stage name -> StageRun
+        """
+        dependencies = self.dependencies()
+        self.runs = {}
+        pending = list(self.stages)
+        start = time.perf_counter()
+
+        def execute(stage: Stage):
+            stage_start = time.perf_counter()
+            try:
+                result = stage.func()
+            except Exception as e:
+                return StageRun(stage.name, 'failed', time.perf_counter() - stage_start,
+                                time.perf_counter() - start, error=e)
+            return StageRun(stage.name, 'done', time.perf_counter() - stage_start,
+                            time.perf_counter() - start, result=result)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
+            while pending or running:
+                for name in list(pending):
+                    statuses = [self.runs[dep].status if dep in self.runs else None for dep in dependencies[name]]
+                    if any(status in ('failed', 'skipped') for status in statuses):
+                        pending.remove(name)
+                        self._record(StageRun(name, 'skipped', finished_at=time.perf_counter() - start))
+                    elif all(status == 'done' for status in statuses):
+                        pending.remove(name)
+                        self.logger.info(f"Starting stage {name}")
+                        self._notify(StageRun(name, 'running'))
+                        running[executor.submit(execute, self.stages[name])] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    self._record(future.result())
+
+        self.wall_seconds = time.perf_counter() - start
+        self.logger.info(f"Stage graph finished in {self.wall_seconds:.2f}s: " + ', '.join(
+            f"{run.name} {run.status} {run.seconds:.2f}s" for run in self.runs.values()))
+        failed = sorted((run for run in self.runs.values() if run.status == 'failed'), key=lambda run: run.finished_at)
+        if failed:
+            raise failed[0].error
+        return self.runs
+
+    def _record(self, run: StageRun):
+        self.runs[run.name] = run
+        if run.status == 'failed':
+            self.logger.error(f"Stage {run.name} failed after {run.seconds:.2f}s: {run.error}")
+        elif run.status == 'skipped':
+            self.logger.warning(f"Stage {run.name} skipped, an upstream stage failed")
+        else:
+            self.logger.info(f"Stage {run.name} finished in {run.seconds:.2f}s")
+        self._notify(run)
+
+    def _notify(self, run: StageRun):
+        if self.listener is not None:
+            try:
+                self.listener(run)
+            except Exception as e:
+                self.logger.error(f"Stage listener failed for {run.name}: {e}")
+
+    def timings(self) -> Dict[str, float]:
+        """:return: Stage name -> seconds, in completion order"""
+        return {name: run.seconds for name, run in self.runs.items()}
@@ -0,0 +1,120 @@
+# app/services/population_reference.py
+import logging
+from pathlib import Path
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from app.services.model_registry import get_model_registry
+
+BACKEND_ROOT = Path(__file__).resolve().parents[2]
+POPULATION_FILE = BACKEND_ROOT / 'app' / 'resources' / 'population_salivas' / 'GSEs.csv'
+
+# 指標 -> PR 的方向: 'ge' = 母體中 >= 樣本值的比例 (越低越好), 'lt' = 母體中 < 樣本值的比例 (越高越好)
+POPULATION_METRICS = {
+    'fitage': 'ge',
+    'vo2max': 'lt',
+    'grip': 'lt',
+    'gait': 'lt',
+    'mentalhealth': 'ge',
+}
+
+
+def age_groups(ages: Sequence) -> np.ndarray:
+    """
+    Age group of each age: 0 (< 40), 1 (40-59) or 2 (>= 60).
+    NaN ends up in group 2, as the per-sample if/elif/else did.
+    """
+    ages = np.asarray(ages, dtype=np.float64)
+    return np.where(ages < 40, 0, np.where((ages >= 40) & (ages < 60), 1, 2))
+
+
+def population_gender(sex) -> Optional[str]:
+    """Metadata sex -> gender column value: False/0 is "Female", True/1 is "Male", anything else is unknown."""
+    if sex == False:  # noqa: E712 (metadata 可能是 bool 或 0/1)
+        return "Female"
+    if sex == True:  # noqa: E712
+        return "Male"
+    return None
+
+
+class PopulationReference:
+    """
+    GSEs.csv bucketed by (age group, gender), one sorted array per metric, so the percentile ranks of a
+    whole batch are a few searchsorted calls.
+
+    Matches the per-sample `(population[metric] >= value).mean()`: NaN population values are never
+    counted as >= or <, but stay in the denominator.
+    """
+
+    def __init__(self, population: pd.DataFrame):
+        self.logger = logging.getLogger(__name__)
+        self.metrics = [metric for metric in POPULATION_METRICS if metric in population.columns]
+        groups = age_groups(population['age']) if 'age' in population.columns else np.full(len(population), -1)
+        genders = population['gender'].to_numpy() if 'gender' in population.columns else np.full(len(population), None)
+        # (age group, gender) -> metric -> (排序後的非 NaN 值, 該組總人數)
+        self.buckets: Dict[Tuple, Dict[str, Tuple[np.ndarray, int]]] = {}
+        masks = {(None, None): np.ones(len(population), dtype=bool)}
+        for group in (0, 1, 2):
+            masks[(group, None)] = groups == group
+            for gender in ("Female", "Male"):
+                masks[(group, gender)] = (groups == group) & (genders == gender)
+        for key, mask in masks.items():
+            self.buckets[key] = {}
+            for metric in self.metrics:
+                values = population[metric].to_numpy(dtype=np.float64)[mask]
+                self.buckets[key][metric] = (np.sort(values[~np.isnan(values)]), int(mask.sum()))
+
+    @classmethod
+    def read(cls, path: Union[str, Path]) -> 'PopulationReference':
+        return cls(pd.read_csv(path))
+
+    @staticmethod
+    def bucket_keys(ages: Sequence, sexes: Sequence) -> List[Hashable]:
+        """
+        Bucket of each sample: (age group, gender); (age group, None) without gender;
+        (None, None), i.e. everyone, without gender and age.
+        """
+        groups = age_groups(ages)
+        keys = []
+        for age, group, sex in zip(np.asarray(ages, dtype=np.float64), groups, sexes):
+            gender = population_gender(sex)
+            if gender is not None:
+                keys.append((int(group), gender))
+            elif not np.isnan(age):
+                keys.append((int(group), None))
+            else:
+                keys.append((None, None))
+        return keys
+
+    def percentile_ranks(self, values: pd.DataFrame, ages: Sequence, sexes: Sequence) -> pd.DataFrame:
+        """
+        :param values: One row per sample, a column per metric (fitage, vo2max, grip, gait, mentalhealth)
+        :param ages: Age of each sample
+        :param sexes: Metadata sex of each sample
+        :return: '{metric}_pr' columns in [0, 100], same index as values; None for metrics missing from
+                 the population file and for samples whose bucket is empty
+        """
+        samples_by_key: Dict[Hashable, List[int]] = {}
+        for row, key in enumerate(self.bucket_keys(ages, sexes)):
+            samples_by_key.setdefault(key, []).append(row)
+        ranks = pd.DataFrame(np.nan, index=values.index, columns=[f"{metric}_pr" for metric in POPULATION_METRICS])
+        for key, rows in samples_by_key.items():
+            rows = np.asarray(rows)
+            for metric in self.metrics:
+                sorted_values, total = self.buckets[key][metric]
+                if total == 0:
+                    continue
+                sample_values = values[metric].to_numpy(dtype=np.float64)[rows]
+                below = np.searchsorted(sorted_values, sample_values, side='left')
+                count = len(sorted_values) - below if POPULATION_METRICS[metric] == 'ge' else below
+                # NaN 樣本值和任何值比較都是 False
+                count = np.where(np.isnan(sample_values), 0, count)
+                ranks.iloc[rows, ranks.columns.get_loc(f"{metric}_pr")] = np.clip(count / total * 100, 0, 100)
+        return ranks.astype(object).where(ranks.notna(), None)
+
+
+def get_population_reference(path: Union[str, Path] = None) -> PopulationReference:
+    """Population reference loaded once per process (reloaded when the file changes)."""
+    return get_model_registry().load(path or POPULATION_FILE, PopulationReference.read, name='population_reference')
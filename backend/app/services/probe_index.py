@@ -0,0 +1,178 @@
+# app/services/probe_index.py
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+BACKEND_ROOT = Path(__file__).resolve().parents[2]
+
+# EPICv2 的 probe 名稱帶有後綴 (cg00000029_TC21), 前 10 個字元即為對應的 EPICv1/450K probe
+CANONICAL_PROBE_LENGTH = 10
+
+
+class ProbeCollapseIndex:
+    """
+    Precomputed probe -> canonical-probe mapping for one array type.
+
+    Every known probe ID has an integer code pointing into the sorted array of canonical
+    probe IDs, so collapsing replicate probes is a numeric operation instead of a string groupby.
+    The index is stored as an .npz file and grows when a batch contains probes it has not seen.
+    """
+
+    def __init__(self, array_type: str, probe_ids: np.ndarray, canonical_ids: np.ndarray, codes: np.ndarray,
+                 index_dir: Path = None):
+        self.logger = logging.getLogger(__name__)
+        self.array_type = array_type
+        self.probe_ids = probe_ids
+        self.canonical_ids = canonical_ids
+        self.codes = codes
+        self.index_dir = Path(index_dir) if index_dir else BACKEND_ROOT / 'data' / 'probe_index'
+        self._lookup = pd.Index(probe_ids)
+
+    @classmethod
+    def build(cls, array_type: str, probe_ids, index_dir: Path = None) -> "ProbeCollapseIndex":
+        probe_ids = np.unique(np.asarray(probe_ids, dtype=object))
+        canonical = pd.Index(probe_ids).str[:CANONICAL_PROBE_LENGTH]
+        canonical_ids, codes = np.unique(np.asarray(canonical, dtype=object), return_inverse=True)
+        return cls(array_type, probe_ids, canonical_ids, codes.astype(np.int32), index_dir)
+
+    @property
+    def path(self) -> Path:
+        return self.index_dir / f"{self.array_type}.npz"
+
+    @classmethod
+    def load(cls, array_type: str, index_dir: Path = None) -> "ProbeCollapseIndex":
+        index_dir = Path(index_dir) if index_dir else BACKEND_ROOT / 'data' / 'probe_index'
+        with np.load(index_dir / f"{array_type}.npz", allow_pickle=False) as data:
+            probe_ids = data['probe_ids'].astype(object)
+            canonical_ids = data['canonical_ids'].astype(object)
+            codes = data['codes']
+        return cls(array_type, probe_ids, canonical_ids, codes, index_dir)
+
+    def save(self):
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        # 以 bytes 陣列保存, 讀取時不需要 pickle
+        np.savez(self.path,
+                 probe_ids=self.probe_ids.astype('S'),
+                 canonical_ids=self.canonical_ids.astype('S'),
+                 codes=self.codes)
+        self.logger.info(f"Saved probe index for {self.array_type} ({len(self.probe_ids)} probes) to {self.path}")
+
+    def codes_for(self, probe_ids: pd.Index) -> np.ndarray:
+        """
+        Canonical-probe codes for the rows of a beta table, or -1 for probes not in the index.
+        """
+        positions = self._lookup.get_indexer(probe_ids)
+        codes = np.full(len(positions), -1, dtype=np.int32)
+        found = positions >= 0
+        codes[found] = self.codes[positions[found]]
+        return codes
+
+    def extended(self, new_probe_ids) -> "ProbeCollapseIndex":
+        probe_ids = np.concatenate([self.probe_ids, np.asarray(new_probe_ids, dtype=object)])
+        return ProbeCollapseIndex.build(self.array_type, probe_ids, self.index_dir)
+
+    def collapse(self, values: np.ndarray, codes: np.ndarray, inplace: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Average rows that share a canonical probe, skipping NaNs (same result as groupby().mean()).
+
+        :param values: 2-D array, one row per probe
+        :param codes: Canonical-probe code per row (from codes_for)
+        :param inplace: Reuse the memory of `values` for the result instead of allocating a new array
+        :return: (collapsed values, canonical probe IDs of the result rows)
+        """
+        if len(codes) and (np.diff(codes) < 0).any():
+            # 行不是依 probe 排序時先排序 (會複製一次)
+            order = np.argsort(codes, kind='stable')
+            values = values[order]
+            codes = codes[order]
+            inplace = True
+
+        n_rows = len(codes)
+        is_start = np.empty(n_rows, dtype=bool)
+        is_start[:1] = True
+        np.not_equal(codes[1:], codes[:-1], out=is_start[1:])
+        starts = np.flatnonzero(is_start)
+        out_ids = self.canonical_ids[codes[starts]]
+        if len(starts) == n_rows:
+            # 沒有重複的 probe (EPICv1 / 450K)
+            return values, out_ids
+
+        counts = np.diff(np.append(starts, n_rows))
+        dup_groups = np.flatnonzero(counts > 1)
+
+        # 先算重複組的平均 (只佔少數行), 再壓縮其餘的行
+        dup_rows = np.repeat(starts[dup_groups], counts[dup_groups]) + _ranges(counts[dup_groups])
+        dup_values = values[dup_rows]
+        valid = ~np.isnan(dup_values)
+        segment_starts = np.concatenate([[0], np.cumsum(counts[dup_groups])[:-1]])
+        sums = np.add.reduceat(np.where(valid, dup_values, 0), segment_starts, axis=0)
+        n_valid = np.add.reduceat(valid, segment_starts, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dup_means = (sums / n_valid).astype(values.dtype, copy=False)
+
+        if inplace:
+            out = _compact_rows(values, starts)
+        else:
+            out = values[starts]
+        out[dup_groups] = dup_means
+        return out, out_ids
+
+
+def _ranges(counts: np.ndarray) -> np.ndarray:
+    """[0..c0-1, 0..c1-1, ...] for the given counts."""
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.arange(counts.sum()) - offsets
+
+
+def _compact_rows(values: np.ndarray, rows: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """
+    Move values[rows] to the front of `values` without allocating a second full-size array.
+    Requires rows to be increasing, so rows[i] >= i and a chunk never overwrites rows that
+    a later chunk still has to read.
+    """
+    for start in range(0, len(rows), chunk_size):
+        chunk_rows = rows[start:start + chunk_size]
+        values[start:start + len(chunk_rows)] = values[chunk_rows]
+    return values[:len(rows)]
+
+
+_indexes: Dict[str, ProbeCollapseIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_probe_codes(array_type: str, probe_ids: pd.Index, index_dir: Path = None) -> Tuple[ProbeCollapseIndex, np.ndarray]:
+    """
+    Collapse index covering all given probe IDs together with their codes (ProbeCollapseIndex.codes_for).
+    Loaded from disk once per process; built or extended (and saved) when probes are missing.
+
+    The probe IDs are looked up once; only a batch with new probes is looked up again in the extended index.
+    """
+    with _indexes_lock:
+        index = _indexes.get(array_type)
+        if index is None:
+            try:
+                index = ProbeCollapseIndex.load(array_type, index_dir)
+            except FileNotFoundError:
+                index = None
+        if index is None:
+            index = ProbeCollapseIndex.build(array_type, probe_ids, index_dir)
+            index.save()
+            codes = index.codes_for(probe_ids)
+        else:
+            codes = index.codes_for(probe_ids)
+            unknown = probe_ids[codes < 0]
+            if len(unknown):
+                index = index.extended(unknown)
+                index.save()
+                codes = index.codes_for(probe_ids)
+        _indexes[array_type] = index
+        return index, codes
+
+
+def get_probe_index(array_type: str, probe_ids: pd.Index, index_dir: Path = None) -> ProbeCollapseIndex:
+    """Return the collapse index for an array type that covers all given probe IDs (see get_probe_codes)."""
+    return get_probe_codes(array_type, probe_ids, index_dir)[0]
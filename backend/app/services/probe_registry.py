@@ -0,0 +1,157 @@
+# app/services/probe_registry.py
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+BACKEND_ROOT = Path(__file__).resolve().parents[2]
+MODEL_PROBES_DIR = BACKEND_ROOT / 'app' / 'resources' / 'model_probes'
+
+# 以 CSV 提供 probe 清單的模型 (其餘名稱視為 biolearn gallery 模型)
+PROBE_LIST_FILES = {
+    'DunedinPACE': MODEL_PROBES_DIR / 'DunedinPACE_probes.csv',
+    'EpigenTL': MODEL_PROBES_DIR / 'EpigenTL_probes.csv',
+}
+
+# 同時保留幾個 matrix index 的位置 (同時執行的批次數; 各批次的 stage 執行緒共用同一個 index)
+SUBSET_CACHE_SIZE = 8
+
+
+class ProbeSubset:
+    """
+    Rows of one beta matrix used by one model.
+
+    :ivar positions: Row positions in the matrix, increasing (so slices keep matrix order)
+    :ivar probe_ids: Probe IDs of those rows
+    :ivar missing: Model probes that are not in the matrix
+    """
+
+    def __init__(self, model: str, positions: np.ndarray, probe_ids: pd.Index, missing: pd.Index):
+        self.model = model
+        self.positions = positions
+        self.probe_ids = probe_ids
+        self.missing = missing
+
+    def take(self, values: np.ndarray) -> np.ndarray:
+        return np.take(values, self.positions, axis=0)
+
+
+class ProbeRegistry:
+    """
+    Probe lists of every model stage, loaded once per process, and their row positions in
+    the beta matrix of the current batch.
+
+    Stages ask for a float32 sub-matrix by model name instead of filtering the full table with
+    index.isin; the positions are computed once per matrix and reused by every stage. Positions are
+    kept for the SUBSET_CACHE_SIZE most recently used indexes, held by weak reference so a finished
+    batch's index can be freed.
+    """
+
+    def __init__(self, probe_list_files: Dict[str, Path] = None):
+        self.logger = logging.getLogger(__name__)
+        self.probe_list_files = dict(PROBE_LIST_FILES if probe_list_files is None else probe_list_files)
+        self._probes: Dict[str, pd.Index] = {}
+        self._gallery = None
+        self._lock = threading.Lock()
+        # id(matrix index) -> (index 的 weakref, 模型 -> 位置), LRU 順序
+        self._subsets: "OrderedDict[int, Tuple[weakref.ref, Dict[str, ProbeSubset]]]" = OrderedDict()
+
+    def register(self, model: str, probes: Iterable[str]):
+        """Register (or replace) the probe list of a model."""
+        with self._lock:
+            self._probes[model] = pd.Index(pd.unique(np.asarray(list(probes), dtype=object)), name='probeID')
+            for _, subsets in self._subsets.values():
+                subsets.pop(model, None)
+
+    def probes(self, model: str) -> pd.Index:
+        """
+        Probe IDs used by a model, in the order of its probe list.
+
+        :param model: 'DunedinPACE', 'EpigenTL' or a biolearn gallery model name (e.g. 'Horvathv2')
+        """
+        with self._lock:
+            if model not in self._probes:
+                self._probes[model] = self._load_probes(model)
+            return self._probes[model]
+
+    def _load_probes(self, model: str) -> pd.Index:
+        if model in self.probe_list_files:
+            probes = pd.read_csv(self.probe_list_files[model], header=None, names=['probeID'])['probeID']
+        else:
+            if self._gallery is None:
+                from biolearn.model_gallery import ModelGallery
+                self._gallery = ModelGallery()
+            probes = pd.Series(self._gallery.get(model).methylation_sites())
+        self.logger.info(f"Loaded {len(probes)} probes for {model}")
+        return pd.Index(pd.unique(probes.to_numpy(dtype=object)), name='probeID')
+
+    def subset(self, model: str, probe_index: pd.Index) -> ProbeSubset:
+        """
+        Row positions of a model's probes in a beta matrix, cached per index object (see SUBSET_CACHE_SIZE).
+        """
+        model_probes = self.probes(model)
+        with self._lock:
+            subsets = self._index_subsets(probe_index)
+            subset = subsets.get(model)
+        if subset is None:
+            # get_indexer 在鎖外執行, 其他批次不必等待
+            positions = probe_index.get_indexer(model_probes)
+            found = positions >= 0
+            positions = np.sort(positions[found])
+            subset = ProbeSubset(model, positions, probe_index[positions], model_probes[~found])
+            if len(subset.missing):
+                self.logger.info(f"{model}: {len(subset.missing)} of {len(model_probes)} probes missing")
+            with self._lock:
+                subset = subsets.setdefault(model, subset)
+        return subset
+
+    def _index_subsets(self, probe_index: pd.Index) -> Dict[str, ProbeSubset]:
+        """Cached subsets of one index object (caller holds self._lock)."""
+        key = id(probe_index)
+        entry = self._subsets.get(key)
+        if entry is not None and entry[0]() is probe_index:
+            self._subsets.move_to_end(key)
+            return entry[1]
+        # 已被釋放的 index (id 可能被重用) 先移除, 再依 LRU 淘汰
+        for dead in [k for k, (ref, _) in self._subsets.items() if ref() is None]:
+            del self._subsets[dead]
+        subsets: Dict[str, ProbeSubset] = {}
+        self._subsets[key] = (weakref.ref(probe_index), subsets)
+        while len(self._subsets) > SUBSET_CACHE_SIZE:
+            self._subsets.popitem(last=False)
+        return subsets
+
+    def submatrix(self, model: str, beta_table: pd.DataFrame) -> pd.DataFrame:
+        """
+        float32 rows of a beta table used by a model, in the table's probe order.
+
+        :param model: Model name (see probes())
+        :param beta_table: Beta table indexed by probeID
+        :return: New DataFrame with only the model's probes that are present
+        """
+        subset = self.subset(model, beta_table.index)
+        values = beta_table.to_numpy(dtype=np.float32, copy=False)
+        return pd.DataFrame(subset.take(values), index=subset.probe_ids, columns=beta_table.columns)
+
+    def missing_report(self, probe_index: pd.Index, models: List[str]) -> Dict[str, pd.Index]:
+        """
+        :return: Model name -> probes of that model that are not in the matrix
+        """
+        return {model: self.subset(model, probe_index).missing for model in models}
+
+
+_registry: Optional[ProbeRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_probe_registry() -> ProbeRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ProbeRegistry()
+        return _registry
@@ -3,7 +3,6 @@ import pandas as pd
 import logging
 import os
 import subprocess
-import json
 from app.core.config import settings
 from pathlib import Path
 import sys
@@ -17,6 +16,9 @@ sys.path.append(str(project_root))
 
 from app.db import models
 from app.db.session import SessionLocal
+from app.services.r_handoff import (use_binary_handoff, new_handoff_path, parse_r_output,
+                                    read_handoff_table, write_handoff_table, remove_handoff_file)
+from app.services.r_worker_pool import get_r_worker_pool
 
 class EpiDISHProcessor:
     def __init__(self):
@@ -43,28 +45,34 @@ class EpiDISHProcessor:
         if not os.path.exists(csv_file_path):
             raise FileNotFoundError(f"CSV file not found at {csv_file_path}")
                 
+        output_path = new_handoff_path('epidish') if use_binary_handoff() else None
+        r_pool = get_r_worker_pool()
         try:
-            result = subprocess.run(
-                [self.r_executable, self.r_script_path, csv_file_path],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-
-            output_lines = result.stdout.strip().split('\n')
-            json_output = output_lines[-1]
-
-            try:
-                output = json.loads(json_output)
-            except json.JSONDecodeError as json_error:
-                self.logger.error(f"Failed to parse R script output as JSON: {json_error}")
-                self.logger.error(f"R script output: {json_output}")
-                raise
+            if r_pool is not None:
+                output = r_pool.run('epidish', {
+                    'beta_file_path': str(csv_file_path),
+                    'output_path': str(output_path) if output_path is not None else None
+                })
+            else:
+                command = [self.r_executable, self.r_script_path, str(csv_file_path)]
+                if output_path is not None:
+                    command.append(str(output_path))
+                result = subprocess.run(
+                    command,
+                    capture_output=True,
+                    text=True,
+                    check=True
+                )
+
+                output = parse_r_output(result.stdout)
             
             if output['status'] == 'success':
                 self.logger.info("EpiDISH processing completed successfully")
                 # self.logger.info(f"Output: {output}")
                 
+                if output['data'].get('format') == 'feather':
+                    return read_handoff_table(output_path, index_col='SampleID')
+
                 cell_proportion_data = output['data']['cell_proportion']
                 
                 df = pd.DataFrame(cell_proportion_data)
@@ -81,6 +89,22 @@ class EpiDISHProcessor:
         except Exception as e:
             self.logger.error(f"Other error in processing CSV file with EpiDISH: {str(e)}")
             raise
+        finally:
+            remove_handoff_file(output_path)
+
+    def run_epidish_with_df(self, beta_table: pd.DataFrame) -> pd.DataFrame:
+        '''
+        將記憶體中的 beta table 以 Feather 檔案交給 EpiDISH, 避免寫出/解析 CSV
+
+        :param beta_table: 以 probeID 為索引的甲基化數據
+        :return: EpiDISH 處理後的細胞比例 DataFrame
+        '''
+        input_path = new_handoff_path('epidish_input')
+        try:
+            write_handoff_table(beta_table, input_path, index_label='probeID')
+            return self.run_epidish_with_csv(str(input_path))
+        finally:
+            remove_handoff_file(input_path)
 
     def save_cell_proportions(self, cell_proportions: pd.DataFrame, batch_name: str) -> str:
         '''
@@ -139,8 +163,8 @@ if __name__ == "__main__":
 
     try:
         # 示例用法
-        # python app/services/r_epidish_processor.py "data/processed_beta_table/our_all_samples_processed.csv" --batch_name our_all_samples
-        result = processor.run_epidish_with_csv("data/processed_beta_table/our_all_samples_processed.csv")
+        # python app/services/r_epidish_processor.py "data/processed_beta_table/our_all_samples_processed.parquet" --batch_name our_all_samples
+        result = processor.run_epidish_with_csv("data/processed_beta_table/our_all_samples_processed.parquet")
         if isinstance(result, pd.DataFrame):
             print("Processing completed. Sample of cell proportions:")
             print(result.head())
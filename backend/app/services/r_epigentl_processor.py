@@ -1,9 +1,9 @@
 # app/services/r_epigentl_processor.py
 import pandas as pd
+import numpy as np
 import logging
 import os
 import subprocess
-import json
 from pathlib import Path
 from typing import Union
 import sys
@@ -14,6 +14,35 @@ sys.path.append(str(project_root))
 from app.db import models
 from app.db.session import SessionLocal
 from app.core.config import settings
+from app.services.r_handoff import (new_handoff_path, parse_r_output, read_handoff_table, remove_handoff_file,
+                                    use_binary_handoff, write_handoff_table)
+from app.services.beta_store import read_beta_store, resolve_beta_store_path
+from app.services.epigentl_engine import EpigenTLEngine
+from app.services.model_registry import get_model_registry
+from app.services.probe_registry import get_probe_registry
+from app.services.r_worker_pool import get_r_worker_pool
+
+
+def imputation_means_from_samples(ex_samples: pd.DataFrame, probes: pd.Index) -> pd.Series:
+    """
+    Mean beta value of each EpigenTL CpG over the example saliva samples (ExSample_SalivaCpGs.csv,
+    one row per sample, one column per CpG).
+    """
+    means = ex_samples.reindex(columns=probes[probes.isin(ex_samples.columns)]).mean()
+    return means.astype(np.float32).rename_axis('probeID')
+
+
+def write_imputation_means(means: pd.Series, path: Union[str, Path]) -> Path:
+    """Save the imputation vector as a compressed npz (probe IDs + float32 means)."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(path, probe_ids=means.index.to_numpy(dtype=str), means=means.to_numpy(dtype=np.float32))
+    return path
+
+
+def read_imputation_means(path: Union[str, Path]) -> pd.Series:
+    with np.load(path) as data:
+        return pd.Series(data['means'], index=pd.Index(data['probe_ids'].astype(object), name='probeID'))
 
 
 class EpigenTLProcessor:
@@ -25,110 +54,171 @@ class EpigenTLProcessor:
         self.resource_dir = self.backend_root / 'app' / 'resources'
         self.probes_file = self.resource_dir / 'model_probes' / 'EpigenTL_probes.csv'
         self.ex_sample_file = self.resource_dir / 'model_probes' / 'ExSample_SalivaCpGs.csv'
+        # 預先計算的插補向量 (scripts_manual/build_epigentl_imputation.py 由 ExSample_SalivaCpGs.csv 產生)
+        self.imputation_file = self.resource_dir / 'model_probes' / 'EpigenTL_imputation_means.npz'
+        self.impute_nan = settings.EPIGENTL_IMPUTE_NAN
+        self.probe_registry = get_probe_registry()
+        self.model_registry = get_model_registry()
+        self.engine = settings.EPIGENTL_ENGINE.lower()
+        self.python_engine = EpigenTLEngine()
 
     def read_model_probes(self) -> pd.Series:
         """
-        Read the model probes from a CSV file.
+        Read the model probes from a CSV file (loaded once by the probe registry).
         
         :return: Series of model probes
         """
-        model_probes = pd.read_csv(self.probes_file, header=None, names=['probeID'])
-        return model_probes['probeID']
+        return pd.Series(self.probe_registry.probes('EpigenTL'), name='probeID')
+
+    def imputation_means(self) -> pd.Series:
+        """
+        Reference mean per EpigenTL CpG (loaded once per process).
+        Uses the precomputed npz; falls back to ExSample_SalivaCpGs.csv when the npz has not been built.
+        """
+        if self.imputation_file.exists():
+            return self.model_registry.load(self.imputation_file, read_imputation_means, name='epigentl_imputation')
+        if self.ex_sample_file.exists():
+            self.logger.warning(f"{self.imputation_file.name} not found, computing imputation means from {self.ex_sample_file.name}")
+            return self.model_registry.load(
+                self.ex_sample_file,
+                lambda path: imputation_means_from_samples(pd.read_csv(path), self.probe_registry.probes('EpigenTL')),
+                name='epigentl_imputation')
+        self.logger.warning("No EpigenTL imputation reference found, missing CpGs will not be imputed")
+        return pd.Series(dtype=np.float32, index=pd.Index([], name='probeID'))
 
     def preprocess_beta_table(self, beta_table: pd.DataFrame) -> pd.DataFrame:
         """
         Preprocess beta table by filtering and imputing missing values.
+
+        Model CpGs missing from the table are added with the reference mean; with EPIGENTL_IMPUTE_NAN,
+        NaN values of individual samples are also replaced by the reference mean of that CpG.
         
         :param beta_table: Original beta table
-        :return: Preprocessed beta table
+        :return: Preprocessed beta table (float32)
         """
         self.logger.info("Preprocessing beta table")
-        
-        EpigenTL_Cpgs = self.read_model_probes()
-        
-        # Read ExSample_SalivaCpGs
-        ExSample_Saliva_beta_table = pd.read_csv(self.ex_sample_file)
-        # 第一列是索引，但没有列名，我们给它一个名字
-        ExSample_Saliva_beta_table.index.name = 'sample_id'
-        # 重置索引，使第一列成为一个普通列
-        ExSample_Saliva_beta_table = ExSample_Saliva_beta_table.reset_index()
-        # 现在列名就是CpG探针ID
-        
-        # Filter beta_table
-        beta_table_filtered = beta_table[beta_table.index.isin(EpigenTL_Cpgs)].copy()
-        
-        # Find missing CpGs
-        missing_cpgs = EpigenTL_Cpgs[~EpigenTL_Cpgs.isin(beta_table.index)]
-        
-        # Impute missing CpGs
-        for cpg in missing_cpgs:
-            if cpg in ExSample_Saliva_beta_table.columns:
-                mean_value = ExSample_Saliva_beta_table[cpg].mean()
-                beta_table_filtered.loc[cpg] = mean_value
-        
-        return beta_table_filtered
+        means = self.imputation_means()
+
+        # 依 registry 的行位置直接切片, 缺少的 CpG 以參考平均值補在後面
+        subset = self.probe_registry.subset('EpigenTL', beta_table.index)
+        imputable = subset.missing[subset.missing.isin(means.index)]
+        n_present = len(subset.positions)
+        values = np.empty((n_present + len(imputable), beta_table.shape[1]), dtype=np.float32)
+        np.take(beta_table.to_numpy(dtype=np.float32, copy=False), subset.positions, axis=0, out=values[:n_present])
+        values[n_present:] = means.reindex(imputable).to_numpy(dtype=np.float32)[:, None]
+
+        if self.impute_nan:
+            present = values[:n_present]
+            rows, cols = np.nonzero(np.isnan(present))
+            if len(rows):
+                reference = means.reindex(subset.probe_ids).to_numpy(dtype=np.float32)
+                present[rows, cols] = reference[rows]
+                self.logger.info(f"Imputed {len(rows)} NaN values in {len(np.unique(cols))} samples")
+
+        return pd.DataFrame(values, index=subset.probe_ids.append(imputable).rename('probeID'),
+                            columns=beta_table.columns)
 
     def run_epigentl_with_csv(self, csv_file_path: Union[str, Path]) -> pd.DataFrame:
         '''
-        使用 R 的 EpigenTL 包處理 CSV 文件，並返回 EpigenTL 結果的 DataFrame
+        使用 R 的 EpigenTL 包處理 beta table 文件，並返回 EpigenTL 結果的 DataFrame
         
-        :param csv_file_path: 包含甲基化數據的 CSV 文件的路徑 (可以是 str 或 Path 對象)
+        :param csv_file_path: beta table 的路徑 (Parquet probe store 或舊的 CSV, 可以是 str 或 Path 對象)
         :return: EpigenTL 處理後的結果 DataFrame
         '''
-        csv_file_path = Path(csv_file_path)  # Convert to Path object if it's a string
+        csv_file_path = resolve_beta_store_path(csv_file_path)
         self.logger.info(f"Processing CSV file with EpigenTL: {csv_file_path}")
 
-        if not self.r_script_path:
-            raise ValueError("EPIGENTL_R_SCRIPT_PATH environment variable is not set")
-        
-        if not Path(self.r_script_path).exists():
-            raise FileNotFoundError(f"R script not found at {self.r_script_path}")
-        
         if not csv_file_path.exists():
             raise FileNotFoundError(f"CSV file not found at {csv_file_path}")
         
-        # Read and preprocess the beta table
-        beta_table = pd.read_csv(csv_file_path, index_col='probeID')
+        # Read and preprocess the beta table (只讀 EpigenTL 用到的 probe)
+        beta_table = read_beta_store(csv_file_path, probes=self.probe_registry.probes('EpigenTL'))
+        return self.run_epigentl_with_df(beta_table)
+
+    def use_python_engine(self) -> bool:
+        """EPIGENTL_ENGINE=auto 時, 有匯出的係數檔就用 NumPy 計算, 否則用 R"""
+        if self.engine not in ('auto', 'python', 'r'):
+            raise ValueError(f"Unsupported EPIGENTL_ENGINE: {self.engine}")
+        if self.engine == 'auto':
+            return self.python_engine.available
+        return self.engine == 'python'
+
+    def run_epigentl_with_df(self, beta_table: pd.DataFrame) -> pd.DataFrame:
+        '''
+        預處理記憶體中的 beta table 後計算 EpigenTL (依 EPIGENTL_ENGINE 使用 NumPy 或 R)
+
+        :param beta_table: 以 probeID 為索引的甲基化數據
+        :return: EpigenTL 處理後的結果 DataFrame
+        '''
         preprocessed_beta_table = self.preprocess_beta_table(beta_table)
+        if self.use_python_engine():
+            return self.python_engine.predict(preprocessed_beta_table)
+        return self.run_r_epigentl(preprocessed_beta_table)
+
+    def run_r_epigentl(self, preprocessed_beta_table: pd.DataFrame) -> pd.DataFrame:
+        '''
+        將預處理後的 beta table 交給 R 的 EpigenTL
+
+        矩陣寫入 scratch 目錄下名稱唯一的暫存檔 (R_HANDOFF_FORMAT=feather 時為 Feather,
+        結果也以 Feather 傳回), 多個批次同時執行不會互相覆蓋
+
+        :param preprocessed_beta_table: preprocess_beta_table 的結果
+        :return: EpigenTL 處理後的結果 DataFrame
+        '''
+        if not self.r_script_path:
+            raise ValueError("EPIGENTL_R_SCRIPT_PATH environment variable is not set")
         
-        # Save preprocessed beta table to a temporary file
-        self.logger.info(f"csv_file_path: {csv_file_path}")
-        temp_csv_path = csv_file_path.with_stem(csv_file_path.stem + '_preprocessed')
-        preprocessed_beta_table.to_csv(temp_csv_path)
+        if not Path(self.r_script_path).exists():
+            raise FileNotFoundError(f"R script not found at {self.r_script_path}")
+
+        binary = use_binary_handoff()
+        input_path = new_handoff_path('epigentl_input', '.feather' if binary else '.csv')
+        output_path = new_handoff_path('epigentl') if binary else None
 
         r_script_dir = Path(self.r_script_path).parent
         epigentl_source_functions_path = r_script_dir / 'EpigenTL_SourceFunctions.R'
 
+        r_pool = get_r_worker_pool()
         try:
-            result = subprocess.run(
-                [self.r_executable, str(self.r_script_path), str(temp_csv_path), str(epigentl_source_functions_path)],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-
-            # self.logger.info("R script output:")
-            # self.logger.info(result.stdout)
-
-            output_lines = result.stdout.strip().split('\n')
-            json_output = output_lines[-1]
-
-            try:
-                output = json.loads(json_output)
-            except json.JSONDecodeError as json_error:
-                self.logger.error(f"Failed to parse R script output as JSON: {json_error}")
-                self.logger.error(f"R script output: {json_output}")
-                raise
+            if binary:
+                write_handoff_table(preprocessed_beta_table, input_path, index_label='probeID')
+            else:
+                preprocessed_beta_table.to_csv(input_path)
+
+            if r_pool is not None:
+                # worker 啟動時已載入 EpigenTL_SourceFunctions.R 和 ExampleFiles.RData
+                output = r_pool.run('epigentl', {
+                    'csv_file_path': str(input_path),
+                    'output_path': str(output_path) if output_path is not None else None
+                })
+            else:
+                command = [self.r_executable, str(self.r_script_path), str(input_path), str(epigentl_source_functions_path)]
+                if output_path is not None:
+                    command.append(str(output_path))
+                result = subprocess.run(
+                    command,
+                    capture_output=True,
+                    text=True,
+                    check=True
+                )
+
+                # self.logger.info("R script output:")
+                # self.logger.info(result.stdout)
+
+                output = parse_r_output(result.stdout)
             
             if output['status'] == 'success':
                 self.logger.info("EpigenTL processing completed successfully")
-                
-                epigentl_data = output['data']['epigentl_results']
-                
-                df = pd.DataFrame(epigentl_data)
-                df.set_index('SampleID', inplace=True)
-                
-                return df
+
+                if output['data'].get('format') == 'feather':
+                    df = read_handoff_table(output_path, index_col='SampleID')
+                else:
+                    epigentl_data = output['data']['epigentl_results']
+
+                    df = pd.DataFrame(epigentl_data)
+                    df.set_index('SampleID', inplace=True)
+
+                return self.restore_sample_names(df, preprocessed_beta_table.columns)
             
             else:
                 self.logger.error(f"R script execution failed: {output.get('message', 'Unknown error')}")
@@ -140,9 +230,28 @@ class EpigenTLProcessor:
             self.logger.error(f"Other error in processing CSV file with EpigenTL: {str(e)}")
             raise
         finally:
-            # Remove the temporary preprocessed CSV file
-            if temp_csv_path.exists():
-                temp_csv_path.unlink()
+            # Remove the temporary hand-off files
+            remove_handoff_file(input_path)
+            remove_handoff_file(output_path)
+
+    def restore_sample_names(self, epigentl_results: pd.DataFrame, samples: pd.Index) -> pd.DataFrame:
+        """
+        R 可能改掉樣本名稱 (read.csv 的 check.names: 204875570001_R01C01 -> X204875570001_R01C01, S-01 -> S.01);
+        結果依輸入順序排列, 名稱對不上但筆數相同時以輸入的欄名取代
+
+        :param epigentl_results: R 傳回的結果 (SampleID 為索引)
+        :param samples: 輸入 beta table 的欄名
+        :return: 以原本樣本名稱為索引的結果
+        """
+        if epigentl_results.index.isin(samples).all():
+            return epigentl_results
+        if len(epigentl_results) != len(samples):
+            raise ValueError(f"EpigenTL returned {len(epigentl_results)} results for {len(samples)} samples "
+                             f"and its sample names do not match the input")
+        self.logger.warning("EpigenTL sample names do not match the input, restoring them by position")
+        epigentl_results = epigentl_results.copy()
+        epigentl_results.index = pd.Index(samples, name=epigentl_results.index.name)
+        return epigentl_results
 
     def save_epigentl_results(self, epigentl_results: pd.DataFrame, batch_name: str) -> str:
         '''
@@ -195,7 +304,7 @@ if __name__ == "__main__":
 
     try:
         # 示例用法
-        result = processor.run_epigentl_with_csv("data/processed_beta_table/report_test01_processed.csv")
+        result = processor.run_epigentl_with_csv("data/processed_beta_table/report_test01_processed.parquet")
         if isinstance(result, pd.DataFrame):
             print("Processing completed. Sample of EpigenTL results:")
             print(result.head())
@@ -0,0 +1,115 @@
+# app/services/r_handoff.py
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import List, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+BACKEND_ROOT = Path(__file__).resolve().parents[2]
+
+HANDOFF_FORMATS = ("json", "feather")
+
+
+def use_binary_handoff() -> bool:
+    """
+    Whether R scripts should hand matrices back as Feather files instead of JSON on stdout.
+    """
+    handoff_format = settings.R_HANDOFF_FORMAT.lower()
+    if handoff_format not in HANDOFF_FORMATS:
+        raise ValueError(f"Unsupported R_HANDOFF_FORMAT: {settings.R_HANDOFF_FORMAT}")
+    return handoff_format == "feather"
+
+
+def get_scratch_dir() -> Path:
+    """
+    Directory for temporary files exchanged with R (created on demand).
+    """
+    scratch_dir = Path(settings.R_SCRATCH_DIR) if settings.R_SCRATCH_DIR else BACKEND_ROOT / 'data' / 'tmp'
+    scratch_dir.mkdir(parents=True, exist_ok=True)
+    return scratch_dir
+
+
+def new_handoff_path(prefix: str, suffix: str = '.feather') -> Path:
+    """
+    Reserve a uniquely named file in the scratch directory.
+
+    :param prefix: File name prefix, e.g. the stage name
+    :param suffix: File extension
+    :return: Path of the (empty) reserved file
+    """
+    fd, path = tempfile.mkstemp(prefix=f"{prefix}_", suffix=suffix, dir=get_scratch_dir())
+    os.close(fd)
+    return Path(path)
+
+
+def remove_handoff_file(path: Union[str, Path, None]):
+    if path is None:
+        return
+    try:
+        Path(path).unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning(f"Could not remove hand-off file {path}: {e}")
+
+
+def parse_r_output(stdout: str) -> dict:
+    """
+    Parse the JSON status envelope printed as the last line of an R script's stdout.
+
+    :param stdout: Captured standard output of the R script
+    :return: Parsed envelope ({"status": ..., "data"/"message": ...})
+    """
+    output_lines = stdout.strip().split('\n')
+    json_output = output_lines[-1]
+    try:
+        return json.loads(json_output)
+    except json.JSONDecodeError as json_error:
+        logger.error(f"Failed to parse R script output as JSON: {json_error}")
+        logger.error(f"R script output: {output_lines[-5:]}")
+        raise
+
+
+def write_handoff_table(df: pd.DataFrame, path: Union[str, Path], index_label: str = None) -> Path:
+    """
+    Write a numeric matrix as an uncompressed float32 Feather file that R (arrow) can read.
+
+    :param df: Numeric DataFrame
+    :param path: Output path
+    :param index_label: If given, the index is written as the first (string) column with this name
+    :return: Output path
+    """
+    columns = {}
+    fields = []
+    if index_label is not None:
+        columns[index_label] = pa.array(df.index.astype(str))
+        fields.append(pa.field(index_label, pa.string()))
+    for col in df.columns:
+        columns[str(col)] = pa.array(df[col].to_numpy(dtype='float32', na_value=float('nan')), type=pa.float32())
+        fields.append(pa.field(str(col), pa.float32()))
+    table = pa.Table.from_pydict(columns, schema=pa.schema(fields))
+    feather.write_feather(table, str(path), compression='uncompressed')
+    return Path(path)
+
+
+def read_handoff_table(path: Union[str, Path], index_col: str = None, columns: List[str] = None) -> pd.DataFrame:
+    """
+    Memory-map a Feather file written by an R script into a DataFrame.
+
+    :param path: Path to the Feather file
+    :param index_col: Optional column to use as the index
+    :param columns: Optional subset of columns to read
+    :return: DataFrame with the file contents
+    """
+    table = feather.read_table(str(path), columns=columns, memory_map=True)
+    df = table.to_pandas()
+    if index_col is not None:
+        df.set_index(index_col, inplace=True)
+    return df
@@ -0,0 +1,279 @@
+# app/services/r_worker_pool.py
+import atexit
+import json
+import logging
+import queue
+import subprocess
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from app.core.config import settings
+
+
+class RWorkerError(RuntimeError):
+    """The R worker died, timed out or replied with something that is not a job result."""
+
+
+class RWorker:
+    """
+    One long-lived Rscript process running r_worker.R.
+
+    Jobs are sent as one JSON line on stdin; the worker replies with one JSON line on stdout.
+    Everything R prints to stderr is forwarded to the logger.
+    """
+
+    def __init__(self, worker_id: int, command: List[str], startup_timeout: float):
+        self.logger = logging.getLogger(f"{__name__}.worker{worker_id}")
+        self.worker_id = worker_id
+        self.command = command
+        self.startup_timeout = startup_timeout
+        self.process: Optional[subprocess.Popen] = None
+        self.replies: "queue.Queue[Optional[dict]]" = queue.Queue()
+        self.jobs_done = 0
+
+    def start(self):
+        self.logger.info(f"Starting R worker: {' '.join(self.command)}")
+        self.replies = queue.Queue()
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1
+        )
+        threading.Thread(target=self._read_stdout, args=(self.process, self.replies), daemon=True).start()
+        threading.Thread(target=self._read_stderr, args=(self.process,), daemon=True).start()
+        # 等待 R 端載入套件完成
+        ready = self._wait_reply("ready", self.startup_timeout)
+        self.logger.info(f"R worker ready (pid {ready['data']['pid']})")
+
+    def _read_stdout(self, process: subprocess.Popen, replies: queue.Queue):
+        for line in process.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                replies.put(json.loads(line))
+            except json.JSONDecodeError:
+                self.logger.debug(f"R stdout: {line}")
+        # EOF: 進程已結束
+        replies.put(None)
+
+    def _read_stderr(self, process: subprocess.Popen):
+        for line in process.stderr:
+            self.logger.debug(f"R: {line.rstrip()}")
+
+    def _wait_reply(self, job_id: str, timeout: Optional[float]) -> dict:
+        deadline = None if not timeout else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                reply = self.replies.get(timeout=remaining)
+            except queue.Empty:
+                raise RWorkerError(f"R worker {self.worker_id} did not answer job {job_id} within {timeout}s")
+            if reply is None:
+                raise RWorkerError(f"R worker {self.worker_id} exited with code {self.process.wait()}")
+            if reply.get('id') == job_id:
+                return reply
+            self.logger.warning(f"Discarding stale reply for job {reply.get('id')}")
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def call(self, job: str, args: Dict, timeout: Optional[float] = None) -> dict:
+        """
+        Run one job on this worker and return its status envelope.
+
+        :param job: Job name understood by r_worker.R ("champ", "epidish", "epigentl", "ping")
+        :param args: Job arguments
+        :param timeout: Seconds to wait for the reply (None/0 = wait forever)
+        :return: Envelope with 'status' and 'data' or 'message'
+        """
+        if not self.is_alive():
+            raise RWorkerError(f"R worker {self.worker_id} is not running")
+        job_id = uuid.uuid4().hex
+        try:
+            self.process.stdin.write(json.dumps({'id': job_id, 'job': job, 'args': args}) + '\n')
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise RWorkerError(f"Could not send job to R worker {self.worker_id}: {e}")
+        reply = self._wait_reply(job_id, timeout)
+        self.jobs_done += 1
+        return reply
+
+    def ping(self, timeout: float = 10) -> bool:
+        try:
+            return self.call('ping', {}, timeout=timeout)['status'] == 'success'
+        except RWorkerError as e:
+            self.logger.warning(f"Health check failed: {e}")
+            return False
+
+    def stop(self, timeout: float = 10):
+        if self.process is None:
+            return
+        if self.is_alive():
+            try:
+                self.process.stdin.write(json.dumps({'id': 'shutdown', 'job': 'shutdown'}) + '\n')
+                self.process.stdin.flush()
+                self.process.wait(timeout=timeout)
+            except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    def restart(self):
+        self.logger.warning(f"Restarting R worker {self.worker_id}")
+        self.stop(timeout=1)
+        self.start()
+
+
+class RWorkerPool:
+    """
+    Fixed-size pool of R workers that keep ChAMP, EpiDISH and EpigenTL loaded between jobs.
+    Each worker runs one job at a time; callers block until a worker is free.
+    """
+
+    def __init__(self, size: int, r_executable: str = None, worker_script_path: str = None,
+                 epigentl_source_functions_path: str = None, startup_timeout: float = None,
+                 job_timeout: float = None, health_interval: float = None):
+        if size < 1:
+            raise ValueError("R worker pool size must be at least 1")
+        self.logger = logging.getLogger(__name__)
+        self.size = size
+        self.r_executable = r_executable or settings.R_EXECUTABLE
+        self.worker_script_path = Path(worker_script_path or settings.R_WORKER_SCRIPT_PATH
+                                       or Path(settings.CHAMP_R_SCRIPT_PATH).parent / 'r_worker.R')
+        if epigentl_source_functions_path is None and settings.EPIGENTL_R_SCRIPT_PATH:
+            epigentl_source_functions_path = Path(settings.EPIGENTL_R_SCRIPT_PATH).parent / 'EpigenTL_SourceFunctions.R'
+        self.epigentl_source_functions_path = epigentl_source_functions_path
+        self.startup_timeout = startup_timeout if startup_timeout is not None else settings.R_WORKER_STARTUP_TIMEOUT
+        self.job_timeout = job_timeout if job_timeout is not None else settings.R_WORKER_JOB_TIMEOUT
+        self.health_interval = health_interval if health_interval is not None else settings.R_WORKER_HEALTH_INTERVAL
+        self.workers: List[RWorker] = []
+        self.idle: "queue.Queue[RWorker]" = queue.Queue()
+        self._stop_event = threading.Event()
+        self._health_thread = None
+
+    def _worker_command(self) -> List[str]:
+        command = [self.r_executable, str(self.worker_script_path), str(self.worker_script_path.parent)]
+        if self.epigentl_source_functions_path and Path(self.epigentl_source_functions_path).exists():
+            command.append(str(self.epigentl_source_functions_path))
+        return command
+
+    def start(self):
+        if not self.worker_script_path.exists():
+            raise FileNotFoundError(f"R worker script not found at {self.worker_script_path}")
+        self.logger.info(f"Starting R worker pool with {self.size} workers")
+        for worker_id in range(self.size):
+            worker = RWorker(worker_id, self._worker_command(), self.startup_timeout)
+            worker.start()
+            self.workers.append(worker)
+            self.idle.put(worker)
+        if self.health_interval > 0:
+            self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+            self._health_thread.start()
+
+    def run(self, job: str, args: Dict, timeout: float = None) -> dict:
+        """
+        Run a job on the next free worker. A worker that crashes or times out is restarted
+        before it is handed out again; the failed job is not retried.
+
+        :param job: Job name ("champ", "epidish", "epigentl")
+        :param args: Job arguments, see r_worker.R
+        :param timeout: Seconds to wait for the result (defaults to R_WORKER_JOB_TIMEOUT, 0 = no limit)
+        :return: Status envelope, same shape as the JSON printed by the standalone R scripts
+        """
+        timeout = self.job_timeout if timeout is None else timeout
+        worker = self.idle.get()
+        try:
+            if not worker.is_alive():
+                worker.restart()
+            self.logger.info(f"Running R job '{job}' on worker {worker.worker_id}")
+            return worker.call(job, args, timeout=timeout)
+        except RWorkerError:
+            self.logger.error(f"R worker {worker.worker_id} failed while running '{job}'")
+            self._restart_quietly(worker)
+            raise
+        finally:
+            self.idle.put(worker)
+
+    def _restart_quietly(self, worker: RWorker):
+        try:
+            worker.restart()
+        except Exception as e:
+            # 下一次取用時會再嘗試啟動
+            self.logger.error(f"Could not restart R worker {worker.worker_id}: {e}")
+
+    def check_health(self) -> List[dict]:
+        """
+        Ping every idle worker, restarting the ones that are dead or unresponsive.
+
+        :return: One status dict per checked worker
+        """
+        statuses = []
+        checked = []
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            checked.append(worker)
+            healthy = worker.is_alive() and worker.ping()
+            if not healthy:
+                self._restart_quietly(worker)
+            statuses.append({
+                'worker_id': worker.worker_id,
+                'healthy': healthy,
+                'restarted': not healthy,
+                'jobs_done': worker.jobs_done
+            })
+        for worker in checked:
+            self.idle.put(worker)
+        return statuses
+
+    def _health_loop(self):
+        while not self._stop_event.wait(self.health_interval):
+            for status in self.check_health():
+                if status['restarted']:
+                    self.logger.warning(f"R worker {status['worker_id']} was unhealthy and has been restarted")
+
+    def shutdown(self):
+        self._stop_event.set()
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+        self.idle = queue.Queue()
+        self.logger.info("R worker pool stopped")
+
+
+_pool: Optional[RWorkerPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_r_worker_pool() -> Optional[RWorkerPool]:
+    """
+    Return the process-wide R worker pool, starting it on first use.
+    Returns None when R_WORKER_POOL_SIZE is 0, i.e. processors should spawn Rscript themselves.
+    """
+    global _pool
+    if settings.R_WORKER_POOL_SIZE <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            pool = RWorkerPool(settings.R_WORKER_POOL_SIZE)
+            pool.start()
+            _pool = pool
+            atexit.register(shutdown_r_worker_pool)
+        return _pool
+
+
+def shutdown_r_worker_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
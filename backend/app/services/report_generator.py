@@ -3,26 +3,68 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timezone
 from scipy import stats
+from sqlalchemy import delete, insert
 from typing import Dict, Union, List
 import random
 import logging
+import uuid
+from functools import partial
 from pathlib import Path
 import sys
 
 project_root = Path(__file__).resolve().parents[2]
 sys.path.append(str(project_root))
+from app.core.config import settings
 from app.services.idat_processor import IDATProcessor
+from app.services.beta_cache import get_beta_table_cache
+from app.services.idat_stager import get_idat_stager
 from app.services.r_epidish_processor import EpiDISHProcessor
 from app.services.sa2bl_processor import SA2BLProcessor
-from app.services.biolearn_processor import BioLearnProcessor
+from app.services.biolearn_processor import BioLearnProcessor, BiolearnJob, biolearn_output_name
 from app.services.r_epigentl_processor import EpigenTLProcessor
 from app.services.mentalhealth_processor import MentalHealthProcessor
+from app.services.r_handoff import use_binary_handoff
+from app.services.pipeline_dag import StageGraph, StageRun
+from app.services.population_reference import POPULATION_METRICS, get_population_reference
+from app.services.beta_store import read_beta_store
+from app.services.probe_registry import get_probe_registry
 from app.db.models import Report, SampleData
 from app.db.session import SessionLocal
 
 # Set project root directory
 BACKEND_ROOT = Path(__file__).resolve().parents[2]
 
+# 報告 frame 中直接寫入 reports 表的欄位 (index 的 sample_name 寫入 order_ecid)
+REPORT_VALUE_COLUMNS = ['gender', 'age', 'cdt', 'bio_age', 'pace_value', 'pace_pr', 'fitage', 'fitage_pr',
+                        'vo2max', 'vo2max_pr', 'grip', 'grip_pr', 'gait', 'gait_pr', 'mentalhealth',
+                        'mentalhealth_pr', 'cystatin', 'adm', 'timp', 'pai1', 'packyrs']
+# 報告欄位 <- EpigenTL 結果欄位
+EPIGENTL_REPORT_COLUMNS = {
+    'fitage': 'DNAmFitAge_C_Pred',
+    'vo2max': 'DNAmVO2max_C_Pred',
+    'grip': 'DNAmGrip_noAge_C_Pred',
+    'gait': 'DNAmGait_noAge_C_Pred',
+    'cystatin': 'DNAmCystatinC_C_Pred',
+    'adm': 'DNAmADM_C_Pred',
+    'timp': 'DNAmTIMP1_C_Pred',
+    'pai1': 'DNAmPAI1_C_Pred',
+    'packyrs': 'DNAmPACKYRS_C_Pred',
+}
+MENTALHEALTH_FEATURES = ['DNAmADM_C_Pred', 'DNAmCystatinC_C_Pred', 'DNAmPAI1_C_Pred', 'DNAmTIMP1_C_Pred']
+# 582人跑出來的sa2bl平均值，直接平移來跟dunedinPACE對齊(都用1.0當人群mean)
+SA2BL_PACE_OFFSET = 0.059355713
+PACE_POPULATION_SD = 0.1381
+
+
+def report_records(report_frame: pd.DataFrame) -> List[Dict]:
+    """
+    Rows of a report frame as plain dicts (sample_name + REPORT_VALUE_COLUMNS), NaN as None,
+    for the bulk insert and API responses.
+    """
+    frame = report_frame.reset_index()
+    frame = frame.astype(object).where(frame.notna(), None)
+    return frame.to_dict(orient='records')
+
 def setup_logging():
     log_dir = BACKEND_ROOT / 'logs'
     log_dir.mkdir(exist_ok=True)
@@ -37,268 +79,288 @@ def setup_logging():
         ]
     )
 
-def cap_pr(value):
-    """
-    將PR值限制在0到100之間。
-    """
-    return max(0, min(100, value))
-
 class ReportGenerator:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.processed_data = None
         self.processed_data_path = None
+        # 本批次的名稱, 用於輸出檔名
+        self.batch_name = "report"
         self.epidish_data = None
         self.sa2bl_data = None
         self.biolearn_result_Horvathv2 = None
         self.biolearn_result_DunedinPACE = None
         self.epigentl_result = None
         self.mentalhealth_result = None
-        self.population_data = None
+        # 最近一次 generate_report 的 stage 執行紀錄 (時間 / 失敗), 以及每個 stage 完成時的回呼
+        self.stage_graph = None
+        self.stage_listener = None
+        self.session_factory = SessionLocal
         self.epidish_processor = EpiDISHProcessor()
         self.sa2bl_processor = SA2BLProcessor()
         self.biolearn_processor = BioLearnProcessor()
         self.epigentl_processor = EpigenTLProcessor()
         self.mentalhealth_processor = MentalHealthProcessor(classifier='logistic')
+        self.probe_registry = get_probe_registry()
 
     def _run_epidish(self):
-        self.epidish_data = self.epidish_processor.run_epidish_with_csv(self.processed_data_path)
+        if use_binary_handoff() and self.processed_data is not None:
+            # beta table 已在記憶體中, 以 Feather 交給 R 而不是讓 R 重新解析 CSV
+            self.epidish_data = self.epidish_processor.run_epidish_with_df(self.processed_data)
+        else:
+            self.epidish_data = self.epidish_processor.run_epidish_with_csv(self.processed_data_path)
 
     def _perform_sa2bl(self):
         self.sa2bl_data = self.sa2bl_processor.sa2bl_from_pd(self.processed_data, self.epidish_data)
 
-    def _run_biolearn(self, metadata=None):
-        self.biolearn_result_Horvathv2 = self.biolearn_processor.run_biolearn(
-            self.processed_data, ["Horvathv2"], "temp_biolearn_results.csv", metadata=metadata)
-        self.biolearn_result_DunedinPACE = self.biolearn_processor.run_biolearn(
-            self.sa2bl_data, ["DunedinPACE"], "temp_biolearn_results.csv", metadata=metadata)
-        
+    def _log_missing_probes(self):
+        # 一次列出各模型在這批數據中缺少的 probe
+        for model, missing in self.probe_registry.missing_report(
+                self.processed_data.index, ['DunedinPACE', 'EpigenTL', 'Horvathv2']).items():
+            if len(missing):
+                self.logger.warning(f"{model}: {len(missing)} probes missing from beta table, e.g. {list(missing[:5])}")
+
+    def _run_horvath(self, metadata=None):
+        # Horvathv2 是線性模型, 只需要它自己的 probe
+        job = BiolearnJob('Horvathv2', self.probe_registry.submatrix('Horvathv2', self.processed_data), ["Horvathv2"])
+        self.biolearn_result_Horvathv2 = self.biolearn_processor.run_biolearn_jobs([job], metadata=metadata, save=False)
+
+    def _run_pace(self, metadata=None):
+        job = BiolearnJob('sa2bl', self.sa2bl_data, ["DunedinPACE"])
+        self.biolearn_result_DunedinPACE = self.biolearn_processor.run_biolearn_jobs([job], metadata=metadata, save=False)
+
+    def _save_biolearn_results(self) -> str:
+        # 兩個分支的結果寫入本批次自己的同一個檔案
+        results = pd.concat([self.biolearn_result_Horvathv2, self.biolearn_result_DunedinPACE], axis=1)
+        sample_order = self.processed_data.columns
+        results = results.reindex(sample_order.append(results.index.difference(sample_order)))
+        return self.biolearn_processor.save_model_results(results, biolearn_output_name(self.batch_name))
+
     def _run_epigentl(self):
-        self.epigentl_result = self.epigentl_processor.run_epigentl_with_csv(self.processed_data_path)
+        if use_binary_handoff() and self.processed_data is not None:
+            # beta table 已在記憶體中, 不必再從 probe store 讀一次
+            self.epigentl_result = self.epigentl_processor.run_epigentl_with_df(self.processed_data)
+        else:
+            self.epigentl_result = self.epigentl_processor.run_epigentl_with_csv(self.processed_data_path)
 
     def _run_mentalhealth(self):
-        mentalhealth_features = ['DNAmADM_C_Pred', 'DNAmCystatinC_C_Pred', 'DNAmPAI1_C_Pred', 'DNAmTIMP1_C_Pred']
-        mentalhealth_data = pd.DataFrame({
-            feature: [getattr(self.epigentl_result, feature).iloc[i] for i in range(len(self.processed_data.columns))]
-            for feature in mentalhealth_features
-        }, index=self.processed_data.columns)
-        
+        # 依樣本名稱對齊; EpigenTL 沒有結果的樣本不預測
+        mentalhealth_data = self.epigentl_result[MENTALHEALTH_FEATURES].reindex(self.processed_data.columns).dropna()
+        if mentalhealth_data.empty:
+            # 沒有可預測的樣本: mentalhealth 留 NaN, 不讓整個批次失敗
+            self.logger.warning("No EpigenTL results match the batch samples, skipping MentalHealth")
+            self.mentalhealth_result = {'predictions': np.array([]), 'probabilities': np.array([], dtype=np.float64),
+                                        'sample_names': mentalhealth_data.index}
+            return
         self.mentalhealth_result = self.mentalhealth_processor.predict_mentalhealth(mentalhealth_data)
+        self.mentalhealth_result['sample_names'] = mentalhealth_data.index
+
+    def _stage_graph(self, metadata=None) -> StageGraph:
+        """
+        Analysis stages of one batch. EpiDISH→SA2BL→DunedinPACE, Horvathv2 and EpigenTL→MentalHealth
+        only share the processed beta table, so the three branches run at the same time.
+        """
+        graph = StageGraph(max_workers=settings.PIPELINE_MAX_WORKERS, listener=self._on_stage_finished)
+        graph.add('epidish', self._run_epidish, outputs=['epidish_data'])
+        graph.add('sa2bl', self._perform_sa2bl, inputs=['epidish_data'], outputs=['sa2bl_data'])
+        graph.add('pace', partial(self._run_pace, metadata), inputs=['sa2bl_data'],
+                  outputs=['biolearn_result_DunedinPACE'])
+        graph.add('horvath', partial(self._run_horvath, metadata), outputs=['biolearn_result_Horvathv2'])
+        graph.add('biolearn_results', self._save_biolearn_results,
+                  inputs=['biolearn_result_Horvathv2', 'biolearn_result_DunedinPACE'], outputs=['biolearn_results_path'])
+        graph.add('epigentl', self._run_epigentl, outputs=['epigentl_result'])
+        graph.add('mentalhealth', self._run_mentalhealth, inputs=['epigentl_result'], outputs=['mentalhealth_result'])
+        return graph
+
+    def _on_stage_finished(self, run: StageRun):
+        if self.stage_listener is not None:
+            self.stage_listener(self.batch_name, run)
 
-    def load_population_data(self, csv_path=None, metadata=None):
+    def run_stages(self, metadata=None):
+        """Run all analysis stages of the batch; timings and failures stay in self.stage_graph.runs."""
+        self._log_missing_probes()
+        self.stage_graph = self._stage_graph(metadata)
+        self.stage_graph.run()
+
+    def population_percentile_ranks(self, report_frame: pd.DataFrame) -> pd.DataFrame:
+        """
+        PR of fitage / vo2max / grip / gait / mentalhealth for every sample of the batch, against the
+        population with the same age group and gender (GSEs.csv is read once per process).
+
+        :param report_frame: Report frame with age, gender and the metric columns
+        :return: '{metric}_pr' columns with the frame's index; None when the population data is not available
+        """
         try:
-            if csv_path and metadata:
-                # 從 CSV 文件加載數據
-                df = pd.read_csv(csv_path)
-                
-                # 確保 metadata 包含必要的信息
-                if 'age' in metadata and 'sex' in metadata:
-                    # 假設 metadata 只包含一個樣本的信息
-                    age = metadata['age'][0]
-                    sex = metadata['sex'][0]
-
-                    self.logger.info(f"Processing data for age: {age}, sex: {sex}")
-                    
-                    # 定義年齡組
-                    if age < 40:
-                        age_group = (df['age'] < 40)
-                    elif 40 <= age < 60:
-                        age_group = (df['age'] >= 40) & (df['age'] < 60)
-                    else:
-                        age_group = (df['age'] >= 60)
-                    
-                    # 將 metadata 中的 'sex' 值轉換為與 CSV 中 'gender' 列匹配的格式
-                    if sex == False:
-                        gender = "Female"
-                    elif sex == True:
-                        gender = "Male"
-                    else:
-                        gender = None
-
-                    # 篩選同年齡層和同性別的數據
-                    if gender is not None:
-                        self.population_data = df[age_group & (df['gender'] == gender)]
-                    elif age is not None and not np.isnan(age):
-                        self.population_data = df[age_group]
-                        self.logger.warning(f"no gender information provided in metadata. Using data for age group {age_group}")
-                    else:
-                        self.logger.warning("Metadata does not contain age or sex information. Using all data.")
-                        self.population_data = df
-                    self.logger.info(f"Filtered data: {len(self.population_data)} rows")
-                else:
-                    self.logger.warning("Metadata does not contain age and sex information. Setting population_data to None.")
-                    self.population_data = None
-            else:
-                self.logger.info("No CSV path or metadata provided. Setting population_data to None.")
-                self.population_data = None
-            
-            # # 硬編碼的數據（已註釋）
-            # self.population_data = pd.DataFrame({
-            #     'fitage': [29.219, 50.46631, 61.1163, 67.76352, 72.28644, 75.15615, 77.44028, 80.22087, 82.6989, 86.1581, 100.1406],
-            #     'vo2max': [30.0562, 36.1469, 36.75708, 37.14681, 37.48146, 37.8964, 38.25902, 38.62972, 39.22418, 39.97038, 43.359],
-            #     'grip': [26.9162, 30.48044, 31.49458, 32.38475, 33.1172, 33.81915, 34.38916, 35.1858, 36.54686, 38.88269, 48.9712],
-            #     'gait': [1.2357, 1.51273, 1.57494, 1.61249, 1.64798, 1.6794, 1.71936, 1.7815, 1.8631, 1.974, 2.3878],
-            #     'mentalhealth': [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
-            # })
-            
-            self.logger.info("Population data loaded successfully.")
+            reference = get_population_reference()
         except Exception as e:
             self.logger.error(f"Error loading population data: {str(e)}", exc_info=True)
-            self.population_data = None
-                    
-    def generate_report(self, metadata=None, mentalhealth_classifier='logistic') -> List[Dict[str, Dict[str, Union[str, float, datetime]]]]:
+            self.logger.warning("Population data not available. Percentile ranks will be set to None.")
+            return pd.DataFrame({f"{metric}_pr": [None] * len(report_frame) for metric in POPULATION_METRICS},
+                                index=report_frame.index, dtype=object)
+        return reference.percentile_ranks(report_frame[list(POPULATION_METRICS)], report_frame['age'],
+                                          report_frame['gender'])
+
+    def _sample_metadata(self, metadata, samples: pd.Index) -> pd.DataFrame:
+        """age / gender per sample: by order_ecid when the metadata has it, otherwise in beta table column order"""
+        if metadata is None or 'age' not in metadata or 'sex' not in metadata:
+            raise ValueError("Metadata with 'age' and 'sex' is required to generate reports")
+        index = metadata['order_ecid'] if 'order_ecid' in metadata else samples
+        frame = pd.DataFrame({'gender': list(metadata['sex']), 'age': list(metadata['age'])}, index=index)
+        frame = frame[~frame.index.duplicated(keep='last')].reindex(samples)
+        frame['age'] = frame['age'].astype(float)
+        return frame
+
+    def build_report_frame(self, metadata=None) -> pd.DataFrame:
+        """
+        All reports of the batch as one frame: one row per sample (index sample_name), columns
+        REPORT_VALUE_COLUMNS. Every stage result is joined on sample name, so a sample one stage
+        dropped gets NaN instead of shifting the other samples.
+        """
+        samples = pd.Index(self.processed_data.columns, name='sample_name')
+        frame = self._sample_metadata(metadata, samples)
+        frame['cdt'] = datetime.now(timezone.utc)
+        frame['bio_age'] = self.biolearn_result_Horvathv2['Horvathv2_Predicted'].reindex(samples)
+        frame['pace_value'] = self.biolearn_result_DunedinPACE['DunedinPACE_Predicted'].reindex(samples) - SA2BL_PACE_OFFSET
+        epigentl = self.epigentl_result.reindex(samples)
+        for column, source in EPIGENTL_REPORT_COLUMNS.items():
+            frame[column] = epigentl[source]
+        probabilities = pd.Series(self.mentalhealth_result['probabilities'],
+                                  index=self.mentalhealth_result.get('sample_names', samples))
+        frame['mentalhealth'] = (probabilities.reindex(samples) - 0.5) * 2  # 將機率轉換為[-1, 1]的範圍
+
+        # 計算百分位數
+        frame['pace_pr'] = stats.norm.sf(frame['pace_value'], loc=1, scale=PACE_POPULATION_SD) * 100
+        frame = frame.join(self.population_percentile_ranks(frame))
+
+        incomplete = frame[['bio_age', 'pace_value', 'fitage', 'mentalhealth']].isna().any(axis=1)
+        if incomplete.any():
+            self.logger.warning(f"{int(incomplete.sum())} samples are missing results from a stage: "
+                                f"{list(samples[incomplete][:10])}")
+        self.logger.info(f"Built {len(frame)} reports")
+        return frame[REPORT_VALUE_COLUMNS]
+
+    def generate_report_frame(self, metadata=None, mentalhealth_classifier='logistic') -> pd.DataFrame:
         # If the classifier has changed, reinitialize the MentalHealthProcessor
         if mentalhealth_classifier != self.mentalhealth_processor.classifier:
             self.mentalhealth_processor = MentalHealthProcessor(classifier=mentalhealth_classifier)
-        
-        self._run_epidish()
-        self._perform_sa2bl()
-        self._run_biolearn(metadata)
-        self._run_epigentl()
-        self._run_mentalhealth()
-
-        # 確保已加載母體數據 (位置目前先寫死)
-        GSEs_path = BACKEND_ROOT / 'app' / 'resources' / 'population_salivas' / 'GSEs.csv'
-        # "../resources/population_salivas/GSEs.csv"
-
-        reports = []
-        for i, sample_name in enumerate(self.processed_data.columns):
-            self.logger.info(f"Generating report for sample {sample_name}")
-            self.logger.info(f"sample gender: {metadata['sex'][i]}")
-            self.logger.info(f"sample age: {float(metadata['age'][i])}")
-
-            # 为每个样本加载特定的人群数据
-            sample_metadata = {
-                'age': [metadata['age'][i]],
-                'sex': [metadata['sex'][i]]
-            }
-            self.load_population_data(GSEs_path, metadata=sample_metadata)
-            bio_age = self.biolearn_result_Horvathv2['Horvathv2_Predicted'].iloc[i]
-            pace_value = self.biolearn_result_DunedinPACE['DunedinPACE_Predicted'].iloc[i] - 0.059355713  # 582人跑出來的sa2bl平均值，直接平移來跟dunedinPACE對齊(都用1.0當人群mean)
-            fitage = self.epigentl_result['DNAmFitAge_C_Pred'].iloc[i]
-            vo2max = self.epigentl_result['DNAmVO2max_C_Pred'].iloc[i]
-            grip = self.epigentl_result['DNAmGrip_noAge_C_Pred'].iloc[i]
-            gait = self.epigentl_result['DNAmGait_noAge_C_Pred'].iloc[i]
-            mentalhealth = (self.mentalhealth_result['probabilities'][i] - 0.5) * 2 # 將機率轉換為[-1, 1]的範圍
-            cystatin = self.epigentl_result['DNAmCystatinC_C_Pred'].iloc[i]
-            adm = self.epigentl_result['DNAmADM_C_Pred'].iloc[i]
-            timp = self.epigentl_result['DNAmTIMP1_C_Pred'].iloc[i]
-            pai1 = self.epigentl_result['DNAmPAI1_C_Pred'].iloc[i]
-            packyrs = self.epigentl_result['DNAmPACKYRS_C_Pred'].iloc[i]
-
-            # 計算百分位數
-            pace_pr = stats.norm.sf(pace_value, loc=1, scale=0.1381) * 100
-            if self.population_data is not None:
-                fitage_pr = cap_pr((self.population_data['fitage'] >= fitage).mean() * 100) if 'fitage' in self.population_data.columns else None
-                vo2max_pr = cap_pr((self.population_data['vo2max'] < vo2max).mean() * 100) if 'vo2max' in self.population_data.columns else None
-                grip_pr = cap_pr((self.population_data['grip'] < grip).mean() * 100) if 'grip' in self.population_data.columns else None
-                gait_pr = cap_pr((self.population_data['gait'] < gait).mean() * 100) if 'gait' in self.population_data.columns else None
-                mentalhealth_pr = cap_pr((self.population_data['mentalhealth'] >= mentalhealth).mean() * 100) if 'mentalhealth' in self.population_data.columns else None
-            else:
-                self.logger.warning("Population data not available. Percentile ranks will be set to None.")
-                vo2max_pr = grip_pr = gait_pr = fitage_pr = mentalhealth_pr = None
-            
-            report = {
-                sample_name: {
-                    "sample_name": sample_name,
-                    "gender": metadata['sex'][i],
-                    "age": float(metadata['age'][i]),
-                    "cdt": datetime.now(timezone.utc),
-                    "bio_age": bio_age,
-                    "pace_value": pace_value,
-                    "pace_pr": pace_pr,
-                    "fitage": fitage,
-                    "fitage_pr": fitage_pr,
-                    "vo2max": vo2max,
-                    "vo2max_pr": vo2max_pr,
-                    "grip": grip,
-                    "grip_pr": grip_pr,
-                    "gait": gait,
-                    "gait_pr": gait_pr,
-                    "mentalhealth": mentalhealth,
-                    "mentalhealth_pr": mentalhealth_pr,
-                    "cystatin": cystatin,
-                    "adm": adm,
-                    "timp": timp,
-                    "pai1": pai1,
-                    "packyrs": packyrs
-                }
-            }
-            reports.append(report)
-
-        return reports
-
-    def save_reports(self, reports: List[Dict[str, Dict[str, Union[str, float, datetime]]]]) -> List[Report]:
-        db = SessionLocal()
+
+        self.run_stages(metadata)
+        return self.build_report_frame(metadata)
+
+    def generate_report(self, metadata=None, mentalhealth_classifier='logistic') -> List[Dict[str, Dict[str, Union[str, float, datetime]]]]:
+        """Reports as [{sample_name: {...}}, ...]; generate_report_frame gives the same data as one frame."""
+        frame = self.generate_report_frame(metadata=metadata, mentalhealth_classifier=mentalhealth_classifier)
+        return [{record['sample_name']: record} for record in report_records(frame)]
+
+    def _existing_sample_names(self, db, sample_names: List[str], chunk_size: int) -> set:
+        found = set()
+        for start in range(0, len(sample_names), chunk_size):
+            chunk = sample_names[start:start + chunk_size]
+            found.update(name for (name,) in db.query(SampleData.sample_name).filter(SampleData.sample_name.in_(chunk)))
+        return found
+
+    @staticmethod
+    def _report_row(data: Dict[str, Union[str, float, datetime]]) -> Dict:
+        row = {column: data[column] for column in REPORT_VALUE_COLUMNS}
+        row['id'] = uuid.uuid4()
+        row['order_ecid'] = data['sample_name']
+        return row
+
+    def save_reports(self, reports: Union[pd.DataFrame, List[Dict[str, Dict[str, Union[str, float, datetime]]]]],
+                     replace: bool = None) -> List[Report]:
+        """
+        Save the reports of a batch in one transaction: one IN query (per chunk) finds the samples
+        that exist, and the rows are inserted in chunks of REPORT_SAVE_CHUNK_SIZE.
+
+        :param reports: Output of generate_report_frame (or of generate_report)
+        :param replace: Delete earlier reports with the same order_ecid first, so a re-run replaces them
+                        instead of adding duplicates (default REPORT_REPLACE_EXISTING)
+        :return: The saved reports (detached Report objects)
+        """
+        replace = settings.REPORT_REPLACE_EXISTING if replace is None else replace
+        chunk_size = settings.REPORT_SAVE_CHUNK_SIZE
+        if isinstance(reports, pd.DataFrame):
+            records = report_records(reports)
+        else:
+            records = [data for report_data in reports for data in report_data.values()]
+        rows = [self._report_row(data) for data in records]
+        db = self.session_factory()
         try:
-            saved_reports = []
-            for report_data in reports:
-                for sample_name, data in report_data.items():
-                    # 查找對應的 SampleData
-                    sample = db.query(SampleData).filter(SampleData.sample_name == sample_name).first()
-                    if not sample:
-                        self.logger.warning(f"Sample with name {sample_name} not found in database.")
-                        continue
-
-                    new_report = Report(
-                        order_ecid=data['sample_name'],
-                        gender=data['gender'],
-                        age=data['age'],
-                        cdt=data['cdt'],
-                        bio_age=data['bio_age'],
-                        pace_value=data['pace_value'],
-                        pace_pr=data['pace_pr'],
-                        fitage=data['fitage'],
-                        fitage_pr=data['fitage_pr'],
-                        vo2max=data['vo2max'],
-                        vo2max_pr=data['vo2max_pr'],
-                        grip=data['grip'],
-                        grip_pr=data['grip_pr'],
-                        gait=data['gait'],
-                        gait_pr=data['gait_pr'],
-                        mentalhealth=data['mentalhealth'],
-                        mentalhealth_pr=data['mentalhealth_pr'],
-                        cystatin=data['cystatin'],
-                        adm=data['adm'],
-                        timp=data['timp'],
-                        pai1=data['pai1'],
-                        packyrs=data['packyrs']
-                    )
-                    db.add(new_report)
-                    saved_reports.append(new_report)
+            sample_names = list(dict.fromkeys(row['order_ecid'] for row in rows))
+            existing = self._existing_sample_names(db, sample_names, chunk_size)
+            for sample_name in sample_names:
+                if sample_name not in existing:
+                    self.logger.warning(f"Sample with name {sample_name} not found in database.")
+            rows = [row for row in rows if row['order_ecid'] in existing]
+            order_ecids = [name for name in sample_names if name in existing]
+
+            if replace:
+                for start in range(0, len(order_ecids), chunk_size):
+                    db.execute(delete(Report).where(Report.order_ecid.in_(order_ecids[start:start + chunk_size])))
+            for start in range(0, len(rows), chunk_size):
+                db.execute(insert(Report), rows[start:start + chunk_size])
             db.commit()
-            return saved_reports
+            self.logger.info(f"Saved {len(rows)} reports" + (" (replacing earlier reports)" if replace else ""))
+        except Exception:
+            db.rollback()
+            raise
         finally:
             db.close()
+        return [Report(**row) for row in rows]
 
     def generate_and_save_reports(self, metadata=None, mentalhealth_classifier='logistic') -> List[Report]:
-        reports = self.generate_report(metadata=metadata, mentalhealth_classifier=mentalhealth_classifier)
-        return self.save_reports(reports)
+        report_frame = self.generate_report_frame(metadata=metadata, mentalhealth_classifier=mentalhealth_classifier)
+        return self.save_reports(report_frame)
 
 class IdatReportGenerator(ReportGenerator):
     def __init__(self):
         super().__init__()
         self.idat_processor = IDATProcessor()
+        self.beta_cache = get_beta_table_cache()
+
+    def _beta_cache_key(self, pd_file_path: str, idat_file_path: str):
+        try:
+            idat_files = self.idat_processor.idat_files_for_sheet(pd_file_path, idat_file_path)
+        except (FileNotFoundError, KeyError) as e:
+            self.logger.warning(f"Beta table cache skipped, cannot resolve IDAT files: {e}")
+            return None
+        return self.beta_cache.make_key(idat_files, self.idat_processor.cache_params())
 
     def process_data(self, pd_file_path: str, idat_file_path: str, batch_name: str = "report_test01"):
-        raw_data = self.idat_processor.process_idat(pd_file_path, idat_file_path)
-        self.processed_data = self.idat_processor.champ_df_postprocess(raw_data)
+        if str(pd_file_path).startswith('gs://') or str(idat_file_path).startswith('gs://'):
+            # 先把 Sample Sheet 和 IDAT 暫存到本地, ChAMP 只能讀本地目錄
+            stager = get_idat_stager()
+            staged = stager.stage(str(pd_file_path), str(idat_file_path))
+            try:
+                return self.process_staged(staged, batch_name)
+            finally:
+                stager.release(staged)
+        return self._process_local(pd_file_path, idat_file_path, batch_name)
+
+    def process_staged(self, staged, batch_name: str = "report_test01"):
+        """Process a batch already staged by IdatStager (e.g. from IdatStager.staged_batches)."""
+        return self._process_local(staged.pd_file_path, staged.idat_dir, batch_name)
+
+    def _process_local(self, pd_file_path, idat_file_path, batch_name: str):
+        self.batch_name = batch_name
+        cache_key = self._beta_cache_key(pd_file_path, idat_file_path) if self.beta_cache.enabled else None
+        self.processed_data = self.beta_cache.get(cache_key) if cache_key else None
+        if self.processed_data is None:
+            raw_data = self.idat_processor.process_idat_sharded(pd_file_path, idat_file_path)
+            self.processed_data = self.idat_processor.champ_df_postprocess(raw_data, inplace=True)
+            if cache_key:
+                self.beta_cache.put(cache_key, self.processed_data, params=self.idat_processor.cache_params())
         self.processed_data_path = self.idat_processor.save_processed_data(self.processed_data, batch_name=batch_name)
 
 class ProcessedDataReportGenerator(ReportGenerator):
     def process_data(self, processed_data_path: str):
         self.processed_data_path = processed_data_path
-        self.processed_data = pd.read_csv(self.processed_data_path, index_col='probeID')
+        self.processed_data = read_beta_store(self.processed_data_path)
+        self.batch_name = Path(processed_data_path).stem.removesuffix('_processed')
 
     def _perform_sa2bl(self):
         self.sa2bl_data = self.sa2bl_processor.sa2bl(self.processed_data_path, self.epidish_data)
 
-    def _run_biolearn(self, metadata=None):
-        self.biolearn_result_Horvathv2 = self.biolearn_processor.run_biolearn(
-            self.processed_data_path, ["Horvathv2"], "temp_biolearn_results.csv", metadata=metadata)
-        self.biolearn_result_DunedinPACE = self.biolearn_processor.run_biolearn(
-            self.sa2bl_data, ["DunedinPACE"], "temp_biolearn_results.csv", metadata=metadata)
-
 if __name__ == "__main__":
     # 在主程序開始時調用
     setup_logging()
@@ -319,7 +381,7 @@ if __name__ == "__main__":
     print("Report from IDAT generated and saved:")
 
     # Example usage for processed data
-    # processed_data_path = BACKEND_ROOT / 'data' / 'processed_beta_table' / 'our_all_samples_processed.csv'
+    # processed_data_path = BACKEND_ROOT / 'data' / 'processed_beta_table' / 'our_all_samples_processed.parquet'
     # processed_generator = ProcessedDataReportGenerator()
     # processed_generator.process_data(str(processed_data_path))
     # saved_reports = processed_generator.generate_and_save_reports(metadata)
@@ -6,6 +6,44 @@ from pathlib import Path
 import logging
 from typing import Dict, Union
 
+from app.core.config import settings
+from app.services.beta_store import read_beta_store
+from app.services.model_registry import get_model_registry
+from app.services.probe_registry import get_probe_registry
+from app.services.stacked_linear_model import StackedLinearModel
+
+# hepidish(centEpiFibIC.m, centBloodSub.m[, 1:6]) 輸出的細胞類型
+EPIDISH_CELL_TYPES = ['Epi', 'Fib', 'B', 'NK', 'CD4T', 'CD8T', 'Mono', 'Neutro']
+# 依免疫細胞總和重新標準化的欄位
+IMMUNE_CELL_TYPES = ['B', 'NK', 'CD4T', 'CD8T', 'Mono', 'Neutro']
+# LASSO 模型的 7 個 feature (B 只參與總和)
+SA2BL_FEATURES = ['Epi', 'Fib', 'NK', 'CD4T', 'CD8T', 'Mono', 'Neutro']
+_IMMUNE_POSITIONS = [EPIDISH_CELL_TYPES.index(c) for c in IMMUNE_CELL_TYPES]
+_FEATURE_POSITIONS = [EPIDISH_CELL_TYPES.index(c) for c in SA2BL_FEATURES]
+_ADJUSTED_FEATURES = [i for i, c in enumerate(SA2BL_FEATURES) if c in IMMUNE_CELL_TYPES]
+
+
+def sa2bl_design_matrix(cell_proportions: np.ndarray) -> np.ndarray:
+    """
+    SA2BL features from EpiDISH cell proportions in one pass.
+
+    Immune fractions become x - x / sum(immune) (unchanged when the sum is 0); Epi and Fib pass through.
+    Rows are independent, so any number of batches (or single samples) can be stacked.
+
+    :param cell_proportions: Array (n_samples, 8) in EPIDISH_CELL_TYPES order, or one sample (8,)
+    :return: float64 array (n_samples, 7) in SA2BL_FEATURES order
+    """
+    values = np.atleast_2d(np.asarray(cell_proportions, dtype=np.float64))
+    if values.shape[1] != len(EPIDISH_CELL_TYPES):
+        raise ValueError(f"Expected {len(EPIDISH_CELL_TYPES)} cell types, got {values.shape[1]}")
+    # pandas sum 的語意: 忽略 NaN
+    sums = np.nansum(values[:, _IMMUNE_POSITIONS], axis=1, keepdims=True)
+    features = values[:, _FEATURE_POSITIONS]
+    adjusted = features[:, _ADJUSTED_FEATURES]
+    features[:, _ADJUSTED_FEATURES] = adjusted - adjusted / np.where(sums == 0, np.inf, sums)
+    return features
+
+
 class SA2BLProcessor:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
@@ -15,36 +53,59 @@ class SA2BLProcessor:
         self.resource_dir = self.backend_root / 'app' / 'resources'
         self.probes_file = self.resource_dir / 'model_probes' / 'DunedinPACE_probes.csv'
         self.lasso_model_file = self.resource_dir / 'adjust_models' / 'PACE20000_lasso_v1_EAA_7var.pkl'
+        self.probe_registry = get_probe_registry()
+        self.model_registry = get_model_registry()
+        # (matrix index, model) -> 對齊後的 matrix 行位置與模型行位置
+        self._alignment = None
 
     def read_model_probes(self, file_path: Union[str, Path] = None) -> pd.Series:
         """
-        Read the model probes from a CSV file.
+        Read the model probes from a CSV file (cached per process, reloaded when the file changes).
         
         :param file_path: Path to the CSV file containing model probes
         :return: Series of model probes
         """
         file_path = file_path or self.probes_file
-        model_probes = pd.read_csv(file_path, header=None, names=['probeID'])
-        return model_probes['probeID']
+        return self.model_registry.load(
+            file_path, lambda path: pd.read_csv(path, header=None, names=['probeID'])['probeID'], name='model_probes')
 
     def load_lasso_models(self, file_path: Union[str, Path] = None) -> Dict:
         """
         Load the LASSO models from a pickle file.
+        The pickle is unpickled once per process (see ModelRegistry); MODEL_MMAP_MODE memory-maps its arrays.
         
         :param file_path: Path to the pickle file containing LASSO models
         :return: Dictionary of LASSO models
         """
         file_path = file_path or self.lasso_model_file
-        results_lasso = joblib.load(file_path)
-        return {result['index']: result['model'] for result in results_lasso}
+        mmap_mode = settings.MODEL_MMAP_MODE or None
+        return self.model_registry.load(
+            file_path,
+            lambda path: {result['index']: result['model'] for result in joblib.load(path, mmap_mode=mmap_mode)},
+            name=f'lasso_models:{mmap_mode}')
+
+    def load_stacked_model(self, file_path: Union[str, Path] = None) -> StackedLinearModel:
+        """
+        The LASSO models compiled into one coefficient matrix (built once per process from the pickle).
+        
+        :param file_path: Path to the pickle file containing LASSO models
+        :return: StackedLinearModel with one row per probe
+        """
+        file_path = file_path or self.lasso_model_file
+        return self.model_registry.load(
+            file_path, lambda path: StackedLinearModel.from_models(self.load_lasso_models(path)), name='stacked_lasso')
 
     def process_epidish_data(self, epidish_data: pd.DataFrame) -> pd.DataFrame:
         """
         Process EpiDISH data to calculate adjusted values.
         
-        :param epidish_data: DataFrame containing EpiDISH data
-        :return: Processed DataFrame
+        :param epidish_data: DataFrame containing EpiDISH data (columns EPIDISH_CELL_TYPES, one row per sample;
+                             several batches can be concatenated)
+        :return: Processed DataFrame with columns SA2BL_FEATURES
         """
+        missing = [c for c in EPIDISH_CELL_TYPES if c not in epidish_data.columns]
+        if missing:
+            raise ValueError(f"epidish_data is missing cell type columns: {missing}")
 
         # Check for NaN values in input
         if epidish_data.isnull().values.any():
@@ -52,20 +113,20 @@ class SA2BLProcessor:
             nan_counts = epidish_data.isnull().sum()
             self.logger.warning(f"NaN counts per column: {nan_counts}")
 
-        sums = epidish_data.iloc[:, 2:8].sum(axis=1)
-        new_df = pd.DataFrame(float(0), index=epidish_data.index, columns=epidish_data.columns)
-        new_df.iloc[:, 2:8] = epidish_data.iloc[:, 2:8].div(sums.replace(0, np.inf), axis=0).fillna(0)
-        samnsbl = epidish_data - new_df
-        return samnsbl.iloc[:, [0, 1, 3, 4, 5, 6, 7]]
+        features = sa2bl_design_matrix(epidish_data[EPIDISH_CELL_TYPES].to_numpy())
+        return pd.DataFrame(features, index=epidish_data.index, columns=SA2BL_FEATURES)
 
-    def apply_lasso_correction(self, processed_data: pd.DataFrame, models: Dict) -> Dict:
+    def apply_lasso_correction(self, processed_data: pd.DataFrame,
+                               models: Union[Dict, StackedLinearModel]) -> Dict:
         """
         Apply LASSO correction to processed data.
         
         :param processed_data: Processed EpiDISH data
-        :param models: Dictionary of LASSO models
+        :param models: StackedLinearModel, or a dictionary of LASSO models (one predict call per probe)
         :return: Dictionary of corrections
         """
+        if isinstance(models, StackedLinearModel):
+            return dict(zip(models.index, models.predict(processed_data)))
         return {k: v.predict(processed_data) for k, v in models.items()}
 
     def adjust_methylation_data(self, methylation_data: pd.DataFrame, corrections: Dict) -> pd.DataFrame:
@@ -79,25 +140,80 @@ class SA2BLProcessor:
         y_pred_samnbl = pd.DataFrame.from_dict(corrections, orient='index', columns=methylation_data.columns)
         adjusted_data = methylation_data - y_pred_samnbl
         return adjusted_data.dropna()
+
+    def _align_rows(self, probe_index: pd.Index, model: StackedLinearModel):
+        """
+        Matrix row positions of the DunedinPACE probes that have a model, and the matching model rows.
+        Computed once per (matrix index, model) and reused by later calls.
+        """
+        alignment = self._alignment
+        if alignment is not None and alignment[0] is probe_index and alignment[1] is model:
+            return alignment[2], alignment[3]
+        subset = self.probe_registry.subset('DunedinPACE', probe_index)
+        model_rows = model.index.get_indexer(subset.probe_ids)
+        has_model = model_rows >= 0
+        if not has_model.all():
+            self.logger.info(f"{(~has_model).sum()} DunedinPACE probes have no SA2BL model and are dropped")
+        positions, model_rows = subset.positions[has_model], model_rows[has_model]
+        self._alignment = (probe_index, model, positions, model_rows)
+        return positions, model_rows
+
+    def correct_methylation_data(self, methylation_data: pd.DataFrame, processed_data: pd.DataFrame,
+                                 model: StackedLinearModel, chunk_rows: int = 4096) -> pd.DataFrame:
+        """
+        SA2BL-corrected DunedinPACE rows of a beta matrix (same result as apply_lasso_correction +
+        adjust_methylation_data).
+
+        The rows are copied once into a float32 buffer and the corrections are subtracted in place,
+        chunk by chunk, so peak memory is about one filtered matrix. Probes without a model and rows
+        with any NaN are dropped.
+
+        :param methylation_data: Beta table indexed by probeID (the full table or only the model probes)
+        :param processed_data: Processed EpiDISH data indexed by sample name (matched to the columns of methylation_data)
+        :param model: Stacked LASSO models (load_stacked_model)
+        :param chunk_rows: Rows per chunk of the temporary predictions
+        :return: Adjusted methylation data
+        :raises ValueError: A sample of methylation_data has no EpiDISH row
+        """
+        # 依樣本名稱對齊, 不依行的順序
+        missing = methylation_data.columns[~methylation_data.columns.isin(processed_data.index)]
+        if len(missing):
+            raise ValueError(f"EpiDISH data is missing {len(missing)} of {methylation_data.shape[1]} samples, "
+                             f"e.g. {list(missing[:5])}")
+        processed_data = processed_data[~processed_data.index.duplicated(keep='last')].reindex(methylation_data.columns)
+        positions, model_rows = self._align_rows(methylation_data.index, model)
+        values = methylation_data.to_numpy(copy=False)
+        features_t = np.ascontiguousarray(model.feature_matrix(processed_data).T)
+        adjusted = np.empty((len(positions), values.shape[1]), dtype=np.float32)
+        for start in range(0, len(positions), chunk_rows):
+            stop = start + chunk_rows
+            rows = model_rows[start:stop]
+            block = adjusted[start:stop]
+            block[:] = values[positions[start:stop]]
+            block -= model.coefficients[rows] @ features_t
+            block -= model.intercepts[rows, None]
+
+        probe_ids = methylation_data.index[positions]
+        keep = ~np.isnan(adjusted).any(axis=1)
+        if not keep.all():
+            adjusted, probe_ids = adjusted[keep], probe_ids[keep]
+        return pd.DataFrame(adjusted, index=probe_ids, columns=methylation_data.columns, copy=False)
     
     def sa2bl(self, methylation_data: Union[str, Path, pd.DataFrame], 
               epidish_data: Union[str, Path, pd.DataFrame]) -> pd.DataFrame:
         """
         Process saliva-to-blood conversion from either CSV files or pandas DataFrames.
         
-        :param methylation_data: Either a path to the CSV file, a Path object, or a DataFrame containing methylation data
+        :param methylation_data: Either a path to the beta store (Parquet, or legacy CSV), a Path object, or a DataFrame containing methylation data
         :param epidish_data: Either a path to the CSV file, a Path object, or a DataFrame containing EpiDISH data
         :return: Adjusted methylation data
         """
         self.logger.info("Processing sa2bl")
         
-        # 處理 methylation_data
+        # 處理 methylation_data (從 probe store 只讀 DunedinPACE 的 probe)
         if isinstance(methylation_data, (str, Path)):
-            methylation_data = Path(methylation_data)
             self.logger.info(f"Reading methylation data from file: {methylation_data}")
-            methylation_data_path = self.processed_beta_table_dir / methylation_data
-            self.logger.info(f"methylation_data_path: {methylation_data_path}")
-            methylation_data = pd.read_csv(methylation_data_path, index_col='probeID')
+            methylation_data = read_beta_store(methylation_data, probes=self.probe_registry.probes('DunedinPACE'))
         elif not isinstance(methylation_data, pd.DataFrame):
             raise ValueError("methylation_data must be either a file path, a Path object, or a pandas DataFrame")
 
@@ -111,10 +227,8 @@ class SA2BLProcessor:
             raise ValueError("epidish_data must be either a file path, a Path object, or a pandas DataFrame")
         
         # 共同的處理邏輯
-        model_probes = self.read_model_probes()
-        lasso_models = self.load_lasso_models()
+        lasso_models = self.load_stacked_model()
         
-        methylation_data_filtered = methylation_data[methylation_data.index.isin(model_probes)]
         processed_epidish = self.process_epidish_data(epidish_data)
 
         self.logger.info(f"processed_epidish: {processed_epidish}")
@@ -130,8 +244,7 @@ class SA2BLProcessor:
             self.logger.error(rows_with_nan)
             raise ValueError("processed_epidish contains NaN values. Please handle these before proceeding.")
         
-        corrections = self.apply_lasso_correction(processed_epidish, lasso_models)
-        adjusted_data = self.adjust_methylation_data(methylation_data_filtered, corrections)
+        adjusted_data = self.correct_methylation_data(methylation_data, processed_epidish, lasso_models)
         
         return adjusted_data
 
@@ -144,18 +257,15 @@ class SA2BLProcessor:
         """
         self.logger.info(f"Processing sa2bl from beta table CSV: {beta_table_file_name}")
         
-        beta_table_path = self.processed_beta_table_dir / beta_table_file_name
-        methylation_data = pd.read_csv(beta_table_path, index_col='probeID')
-        model_probes = self.read_model_probes()
-        lasso_models = self.load_lasso_models()
+        lasso_models = self.load_stacked_model()
         
-        methylation_data_filtered = methylation_data[methylation_data.index.isin(model_probes)]
+        methylation_data_filtered = read_beta_store(self.processed_beta_table_dir / beta_table_file_name,
+                                                    probes=self.probe_registry.probes('DunedinPACE'))
         
         epidish_data = pd.read_csv(self.epidish_data_dir / epidish_file_name, index_col='SampleID')
         processed_epidish = self.process_epidish_data(epidish_data)
         
-        corrections = self.apply_lasso_correction(processed_epidish, lasso_models)
-        adjusted_data = self.adjust_methylation_data(methylation_data_filtered, corrections)
+        adjusted_data = self.correct_methylation_data(methylation_data_filtered, processed_epidish, lasso_models)
         
         return adjusted_data
 
@@ -169,14 +279,11 @@ class SA2BLProcessor:
         """
         self.logger.info("Processing sa2bl from pandas DataFrames")
         
-        model_probes = self.read_model_probes()
-        lasso_models = self.load_lasso_models()
+        lasso_models = self.load_stacked_model()
         
-        methylation_data_filtered = methylation_data[methylation_data.index.isin(model_probes)]
         processed_epidish = self.process_epidish_data(epidish_data)
         
-        corrections = self.apply_lasso_correction(processed_epidish, lasso_models)
-        adjusted_data = self.adjust_methylation_data(methylation_data_filtered, corrections)
+        adjusted_data = self.correct_methylation_data(methylation_data, processed_epidish, lasso_models)
         
         return adjusted_data
 
@@ -184,7 +291,7 @@ if __name__ == "__main__":
     processor = SA2BLProcessor()
     
     # 示例用法 for sa2bl_from_csv
-    result_from_csv = processor.sa2bl_from_csv("our_all_samples_processed.csv", "our_all_samples_cell_proportions.csv")
+    result_from_csv = processor.sa2bl_from_csv("our_all_samples_processed.parquet", "our_all_samples_cell_proportions.csv")
     print("Result from CSV:")
     print(result_from_csv.head())
     
@@ -204,7 +311,7 @@ if __name__ == "__main__":
     # epidish_processor = EpiDISHProcessor()
     # 
     # methylation_data = idat_processor.champ_df_postprocess(idat_processor.process_idat("D:/SideProject/EpiAging/SVD_test/raw/Sample_Sheet.csv", "D:/SideProject/EpiAging/SVD_test/raw"))
-    # epidish_data = epidish_processor.run_epidish_with_csv("data/processed_beta_table/our_all_samples_processed.csv")
+    # epidish_data = epidish_processor.run_epidish_with_csv("data/processed_beta_table/our_all_samples_processed.parquet")
     # result_from_pd = processor.sa2bl_from_pd(methylation_data, epidish_data)
     # print("Result from full processing pipeline:")
     # print(result_from_pd.head())
\ No newline at end of file
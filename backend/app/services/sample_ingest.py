@@ -0,0 +1,113 @@
+# app/services/sample_ingest.py
+import logging
+from pathlib import Path
+from typing import IO, Callable, Dict, List, Optional, Union
+
+import pandas as pd
+from sqlalchemy import insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.core.config import settings
+from app.db.models import SampleData
+from app.db.session import SessionLocal
+
+SAMPLE_SHEET_COLUMNS = ['Sample_Name', 'Sentrix_ID', 'Sentrix_Position']
+
+
+def idat_file_paths(idat_prefix: str, sentrix_id: str, sentrix_position: str) -> str:
+    """SampleData.idat_file 的格式: Grn 和 Red 的路徑以逗號分隔"""
+    return (f"{idat_prefix}/{sentrix_id}_{sentrix_position}_Grn.idat,"
+            f"{idat_prefix}/{sentrix_id}_{sentrix_position}_Red.idat")
+
+
+def sample_sheet_metadata(sample_sheet: pd.DataFrame) -> Dict[str, List]:
+    """Report metadata from the Sample_Name / Age / Gender columns of a Sample_Sheet ('Male' -> True, 'Female' -> False)."""
+    missing = [column for column in ('Sample_Name', 'Age', 'Gender') if column not in sample_sheet.columns]
+    if missing:
+        raise ValueError(f"Sample Sheet is missing the {missing} columns needed for reports")
+    genders = {'Female': False, 'Male': True}
+    return {
+        'order_ecid': sample_sheet['Sample_Name'].tolist(),
+        'age': sample_sheet['Age'].tolist(),
+        'sex': [genders.get(gender) for gender in sample_sheet['Gender']],
+    }
+
+
+class SampleIngestor:
+    """
+    Bulk import of Sample_Sheet rows into sample_data.
+
+    The sheet is read in chunks; for each chunk the (Sentrix_ID, Sentrix_Position) pairs that
+    already exist are fetched with one query and the new rows are inserted with one statement
+    (INSERT ... ON CONFLICT DO NOTHING on PostgreSQL, executemany elsewhere). Each chunk is
+    committed on its own, so re-running an interrupted or finished sheet only adds what is missing.
+    """
+
+    def __init__(self, session_factory: sessionmaker = None, chunk_size: int = None):
+        self.logger = logging.getLogger(__name__)
+        self.session_factory = session_factory or SessionLocal
+        self.chunk_size = chunk_size or settings.SAMPLE_INGEST_CHUNK_SIZE
+
+    def read_sample_sheet(self, sample_sheet: Union[str, Path, IO]):
+        """Iterate over the sheet in chunks of Sample_Name / Sentrix_ID / Sentrix_Position (as strings)."""
+        return pd.read_csv(sample_sheet, usecols=SAMPLE_SHEET_COLUMNS, dtype=str, chunksize=self.chunk_size)
+
+    def _existing_pairs(self, session: Session, sentrix_ids: List[str]) -> set:
+        rows = session.query(SampleData.Sentrix_ID, SampleData.Sentrix_Position).filter(
+            SampleData.Sentrix_ID.in_(sentrix_ids)).all()
+        return {(sentrix_id, position) for sentrix_id, position in rows}
+
+    def _insert(self, session: Session, rows: List[Dict]) -> int:
+        if session.get_bind().dialect.name == 'postgresql':
+            statement = pg_insert(SampleData).values(rows).on_conflict_do_nothing(
+                index_elements=['Sentrix_ID', 'Sentrix_Position'])
+            return session.execute(statement).rowcount
+        session.execute(insert(SampleData), rows)
+        return len(rows)
+
+    def ingest(self, sample_sheet: Union[str, Path, IO], idat_prefix: str,
+               progress: Optional[Callable[[int, int, int], None]] = None) -> Dict[str, int]:
+        """
+        :param sample_sheet: Path or open text file of the Sample_Sheet CSV
+        :param idat_prefix: Directory (local or bucket-relative) written into SampleData.idat_file
+        :param progress: Optional callback(rows_read, inserted, skipped) called after each chunk
+        :return: {'rows': ..., 'inserted': ..., 'skipped': ...}
+        """
+        idat_prefix = str(idat_prefix).replace('\\', '/').rstrip('/')
+        counts = {'rows': 0, 'inserted': 0, 'skipped': 0}
+        seen = set()
+        session = self.session_factory()
+        try:
+            for chunk in self.read_sample_sheet(sample_sheet):
+                chunk = chunk.dropna(subset=['Sentrix_ID', 'Sentrix_Position'])
+                existing = self._existing_pairs(session, chunk['Sentrix_ID'].unique().tolist())
+                rows = []
+                for sample_name, sentrix_id, sentrix_position in chunk[SAMPLE_SHEET_COLUMNS].itertuples(index=False):
+                    pair = (sentrix_id, sentrix_position)
+                    if pair in existing or pair in seen:
+                        self.logger.debug(f"Sample already exists: {sample_name}")
+                        continue
+                    seen.add(pair)
+                    rows.append({
+                        'sample_name': sample_name,
+                        'Sentrix_ID': sentrix_id,
+                        'Sentrix_Position': sentrix_position,
+                        'idat_file': idat_file_paths(idat_prefix, sentrix_id, sentrix_position),
+                    })
+                inserted = self._insert(session, rows) if rows else 0
+                # 每個 chunk 各自提交, 中斷後重跑只會補上剩下的行
+                session.commit()
+                counts['rows'] += len(chunk)
+                counts['inserted'] += inserted
+                counts['skipped'] = counts['rows'] - counts['inserted']
+                self.logger.info(f"Sample sheet: {counts['rows']} rows read, {counts['inserted']} inserted, "
+                                 f"{counts['skipped']} already present")
+                if progress:
+                    progress(counts['rows'], counts['inserted'], counts['skipped'])
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        return counts
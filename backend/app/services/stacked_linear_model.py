@@ -0,0 +1,71 @@
+# app/services/stacked_linear_model.py
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+class StackedLinearModel:
+    """
+    Many linear models on the same features, stacked into one coefficient matrix.
+
+    Built once from the per-probe LASSO models of SA2BL; predict() is a single
+    X @ W.T + b in float32 instead of one scikit-learn predict() call per probe.
+
+    :ivar index: Model keys (probe IDs), one per row of coefficients
+    :ivar coefficients: float32 array (n_models, n_features)
+    :ivar intercepts: float32 array (n_models,)
+    :ivar feature_names: Feature column names in coefficient order (None = use X's column order)
+    """
+
+    def __init__(self, index: pd.Index, coefficients: np.ndarray, intercepts: np.ndarray,
+                 feature_names: Optional[List[str]] = None):
+        if coefficients.shape != (len(index), coefficients.shape[1]) or intercepts.shape != (len(index),):
+            raise ValueError("coefficients must be (n_models, n_features) and intercepts (n_models,)")
+        self.index = index
+        self.coefficients = np.ascontiguousarray(coefficients, dtype=np.float32)
+        self.intercepts = np.ascontiguousarray(intercepts, dtype=np.float32)
+        self.feature_names = list(feature_names) if feature_names is not None else None
+
+    @classmethod
+    def from_models(cls, models: Dict) -> 'StackedLinearModel':
+        """
+        :param models: Model key -> fitted linear estimator (coef_ / intercept_, e.g. sklearn Lasso)
+        :return: StackedLinearModel with rows in the dict's order
+        """
+        if not models:
+            raise ValueError("No models to stack")
+        keys = list(models.keys())
+        first = models[keys[0]]
+        feature_names = getattr(first, 'feature_names_in_', None)
+        n_features = np.ravel(first.coef_).shape[0]
+        coefficients = np.empty((len(keys), n_features), dtype=np.float32)
+        intercepts = np.empty(len(keys), dtype=np.float32)
+        for i, key in enumerate(keys):
+            model = models[key]
+            if not hasattr(model, 'coef_') or not hasattr(model, 'intercept_'):
+                raise ValueError(f"Model {key} is not a linear estimator")
+            names = getattr(model, 'feature_names_in_', None)
+            if (names is None) != (feature_names is None) or (names is not None and list(names) != list(feature_names)):
+                raise ValueError(f"Model {key} uses different features than {keys[0]}")
+            coefficients[i] = np.ravel(model.coef_)
+            intercepts[i] = np.ravel(model.intercept_)[0]
+        return cls(pd.Index(keys, name='probeID'), coefficients, intercepts, feature_names)
+
+    def feature_matrix(self, X: pd.DataFrame) -> np.ndarray:
+        """float32 (n_samples, n_features) array of X in coefficient order."""
+        if self.feature_names is not None and isinstance(X, pd.DataFrame):
+            X = X[self.feature_names]
+        features = np.asarray(X, dtype=np.float32)
+        if features.shape[1] != self.coefficients.shape[1]:
+            raise ValueError(f"X has {features.shape[1]} features, the models use {self.coefficients.shape[1]}")
+        return features
+
+    def predict(self, X: pd.DataFrame) -> np.ndarray:
+        """
+        :param X: Features (n_samples, n_features); a DataFrame is reordered by feature_names
+        :return: float32 predictions (n_models, n_samples), row i belongs to index[i]
+        """
+        predictions = self.coefficients @ self.feature_matrix(X).T
+        predictions += self.intercepts[:, None]
+        return predictions
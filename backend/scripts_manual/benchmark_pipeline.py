@@ -0,0 +1,243 @@
+# backend/scripts_manual/benchmark_pipeline.py
+# 以合成數據比較各處理步驟的舊/新實作, 不需要 R 或資料庫
+import argparse
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+project_root = Path(__file__).resolve().parents[1]
+sys.path.append(str(project_root))
+
+
+def timed(label, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40s} {elapsed:10.3f} s")
+    return result
+
+
+def make_beta_table(n_probes: int, n_samples: int, seed: int = 0) -> pd.DataFrame:
+    """產生和 ChAMP 輸出相同格式的 beta table (含 probeID 列, 依 probeID 排序)"""
+    rng = np.random.default_rng(seed)
+    probe_ids = [f"cg{i:08d}" for i in range(n_probes)]
+    data = rng.random((n_probes, n_samples), dtype=np.float32)
+    df = pd.DataFrame(data, columns=[f"S{j}" for j in range(n_samples)])
+    df.insert(0, 'probeID', probe_ids)
+    return df
+
+
+def bench_r_handoff(args):
+    """JSON stdout vs Feather 檔案 (模擬 process_idat.R 的兩種輸出)"""
+    from app.services.r_handoff import new_handoff_path, read_handoff_table, remove_handoff_file
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    beta_df = make_beta_table(args.probes, args.samples)
+    print(f"R hand-off: {args.probes} probes x {args.samples} samples")
+
+    # jsonlite::toJSON(data.frame) 的輸出是逐列的 object 陣列
+    envelope = {
+        'status': 'success',
+        'data': {
+            'beta_table': beta_df.to_dict(orient='records'),
+            'rownames': beta_df['probeID'].tolist(),
+            'colnames': beta_df.columns.tolist(),
+        }
+    }
+    json_text = json.dumps(envelope)
+    print(f"JSON payload size: {len(json_text) / 1e6:.1f} MB")
+
+    def parse_json():
+        output = json.loads(json_text)
+        return pd.DataFrame(output['data']['beta_table'], index=output['data']['rownames'],
+                            columns=output['data']['colnames'])
+
+    timed("json.loads + DataFrame", parse_json)
+
+    path = new_handoff_path('benchmark')
+    try:
+        table = pa.Table.from_pandas(beta_df, preserve_index=False)
+        feather.write_feather(table, str(path), compression='uncompressed')
+        print(f"Feather file size: {path.stat().st_size / 1e6:.1f} MB")
+        timed("Feather memory-map read", read_handoff_table, path)
+    finally:
+        remove_handoff_file(path)
+
+
+def bench_probe_dedup(args):
+    """champ_df_postprocess: 字串 groupby vs 預先計算的 probe 代碼"""
+    import tempfile
+    from app.services.probe_index import get_probe_index
+
+    rng = np.random.default_rng(0)
+    # EPICv2 風格的 probe 名稱, 約 5% 的 probe 有重複
+    base_ids = [f"cg{i:08d}" for i in range(args.probes)]
+    probe_ids = [f"{p}_TC21" for p in base_ids] + [f"{p}_TC22" for p in base_ids[::20]]
+    probe_ids.sort()
+    values = rng.random((len(probe_ids), args.samples), dtype=np.float32)
+    beta_table = pd.DataFrame(values, index=pd.Index(probe_ids, name='probeID'),
+                              columns=[f"S{j}" for j in range(args.samples)])
+    print(f"Probe dedup: {len(probe_ids)} probes x {args.samples} samples")
+
+    timed("groupby(index.str[:10]).mean()", lambda: beta_table.groupby(beta_table.index.str[:10]).mean())
+
+    with tempfile.TemporaryDirectory() as index_dir:
+        timed("build probe index (first run only)", get_probe_index, 'EPICv2', beta_table.index, Path(index_dir))
+        probe_index = get_probe_index('EPICv2', beta_table.index, Path(index_dir))
+        codes = timed("codes_for (hash lookup)", probe_index.codes_for, beta_table.index)
+        timed("collapse (copy)", probe_index.collapse, values, codes)
+        timed("collapse (in place)", probe_index.collapse, values.copy(), codes, True)
+
+
+def bench_beta_store(args):
+    """processed beta table: 整個 CSV 讀入 vs Parquet probe store 只讀模型用到的 probe"""
+    import tempfile
+    from app.services.beta_store import read_beta_store, write_beta_store
+
+    beta_df = make_beta_table(args.probes, args.samples).set_index('probeID')
+    rng = np.random.default_rng(1)
+    model_probes = rng.choice(beta_df.index.to_numpy(), size=min(6662, args.probes), replace=False)
+    print(f"Beta store: {args.probes} probes x {args.samples} samples, {len(model_probes)} model probes")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = Path(tmp_dir) / 'batch_processed.csv'
+        parquet_path = Path(tmp_dir) / 'batch_processed.parquet'
+        beta_df.to_csv(csv_path)
+        write_beta_store(beta_df, parquet_path)
+        print(f"CSV size: {csv_path.stat().st_size / 1e6:.1f} MB, Parquet size: {parquet_path.stat().st_size / 1e6:.1f} MB")
+
+        timed("read_csv + isin filter", lambda: pd.read_csv(csv_path, index_col='probeID').loc[lambda df: df.index.isin(model_probes)])
+        timed("parquet full read", read_beta_store, parquet_path)
+        timed("parquet probe subset", read_beta_store, parquet_path, model_probes)
+        timed("parquet probe subset, 1 sample", read_beta_store, parquet_path, model_probes, [beta_df.columns[0]])
+
+
+def bench_sa2bl_lasso(args):
+    """SA2BL LASSO 校正: 每個 probe 一次 sklearn predict vs StackedLinearModel 一次矩陣乘法"""
+    from sklearn.linear_model import Lasso
+    from app.services.stacked_linear_model import StackedLinearModel
+
+    rng = np.random.default_rng(0)
+    n_models = min(args.probes, 20000)
+    features = ['Epi', 'Fib', 'NK', 'CD4T', 'CD8T', 'Mono', 'Neutro']
+    template = Lasso(alpha=0.001).fit(pd.DataFrame(rng.random((20, 7)), columns=features), rng.random(20))
+    models = {}
+    for i in range(n_models):
+        model = Lasso(alpha=0.001)
+        model.coef_ = rng.normal(size=7)
+        model.intercept_ = rng.normal()
+        model.n_features_in_ = template.n_features_in_
+        model.feature_names_in_ = template.feature_names_in_
+        models[f"cg{i:08d}"] = model
+    samples = pd.DataFrame(rng.random((args.samples, 7)), columns=features)
+    print(f"SA2BL LASSO: {n_models} models x {args.samples} samples")
+
+    timed("per-model sklearn predict", lambda: {k: v.predict(samples) for k, v in models.items()})
+    stacked = timed("build StackedLinearModel (once)", StackedLinearModel.from_models, models)
+    timed("stacked X @ W.T + b", stacked.predict, samples)
+
+
+def bench_population_pr(args):
+    """母體 PR: 每個樣本篩選一次母體 vs PopulationReference 整批 searchsorted"""
+    from app.services.population_reference import POPULATION_METRICS, PopulationReference
+
+    rng = np.random.default_rng(0)
+    n_population = 5000
+    population = pd.DataFrame({metric: rng.normal(size=n_population) for metric in POPULATION_METRICS})
+    population['age'] = rng.integers(20, 80, n_population)
+    population['gender'] = rng.choice(['Female', 'Male'], n_population)
+    values = pd.DataFrame({metric: rng.normal(size=args.samples) for metric in POPULATION_METRICS})
+    ages = rng.integers(20, 80, args.samples)
+    sexes = rng.integers(0, 2, args.samples)
+    print(f"Population PR: {args.samples} samples against {n_population} population rows")
+
+    def per_sample():
+        for i in range(args.samples):
+            group = (population['age'] // 20).clip(1, 3) == min(max(ages[i] // 20, 1), 3)
+            subset = population[group & (population['gender'] == ('Male' if sexes[i] else 'Female'))]
+            for metric in POPULATION_METRICS:
+                (subset[metric] >= values[metric].iloc[i]).mean()
+
+    timed("per-sample filter + mean", per_sample)
+    reference = timed("build PopulationReference (once)", PopulationReference, population)
+    timed("batch searchsorted", reference.percentile_ranks, values, ages, sexes)
+
+
+def bench_save_reports(args):
+    """報告寫入: 每個樣本一次查詢 + ORM add vs ReportGenerator.save_reports (SQLite, 或 --database-url)"""
+    from datetime import datetime, timezone
+    from sqlalchemy import Column, MetaData, String, Table, create_engine
+    from sqlalchemy.orm import sessionmaker
+    from app.db.models import Report, SampleData
+    from app.services.report_generator import REPORT_VALUE_COLUMNS, ReportGenerator
+
+    engine = create_engine(args.database_url or "sqlite://")
+    if engine.dialect.name == 'sqlite':
+        # reports.id 是 PostgreSQL UUID, SQLite 用字串欄位代替
+        SampleData.__table__.create(engine)
+        metadata = MetaData()
+        Table('reports', metadata, *[Column(c.name, String(36) if c.name == 'id' else c.type, primary_key=c.primary_key)
+                                     for c in Report.__table__.columns])
+        metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    n_reports = args.samples
+    names = [f"BENCH{i:06d}" for i in range(n_reports)]
+    session = session_factory()
+    session.add_all([SampleData(sample_name=name) for name in names])
+    session.commit()
+    reports = [{name: dict({column: 1.0 for column in REPORT_VALUE_COLUMNS}, sample_name=name, gender=True,
+                           cdt=datetime.now(timezone.utc))} for name in names]
+    print(f"Save reports: {n_reports} reports ({engine.dialect.name})")
+
+    def per_sample():
+        for report_data in reports:
+            for sample_name, data in report_data.items():
+                if session.query(SampleData).filter(SampleData.sample_name == sample_name).first():
+                    session.add(Report(order_ecid=sample_name, **{c: data[c] for c in REPORT_VALUE_COLUMNS}))
+        session.commit()
+
+    generator = ReportGenerator.__new__(ReportGenerator)
+    generator.logger = logging.getLogger(__name__)
+    generator.session_factory = session_factory
+    timed("per-sample query + ORM add", per_sample)
+    timed("bulk save_reports", generator.save_reports, reports)
+    timed("bulk save_reports (replace)", generator.save_reports, reports, True)
+    session.query(Report).filter(Report.order_ecid.in_(names)).delete(synchronize_session=False)
+    session.query(SampleData).filter(SampleData.sample_name.in_(names)).delete(synchronize_session=False)
+    session.commit()
+    session.close()
+
+
+BENCHMARKS = {
+    'r_handoff': bench_r_handoff,
+    'probe_dedup': bench_probe_dedup,
+    'beta_store': bench_beta_store,
+    'sa2bl_lasso': bench_sa2bl_lasso,
+    'population_pr': bench_population_pr,
+    'save_reports': bench_save_reports,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pipeline steps on synthetic data")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS) + ['all'])
+    parser.add_argument("--probes", type=int, default=200000)
+    parser.add_argument("--samples", type=int, default=16)
+    parser.add_argument("--database-url", default=None, help="save_reports: database to write to (default in-memory SQLite)")
+    args = parser.parse_args()
+
+    # example: python scripts_manual/benchmark_pipeline.py r_handoff --probes 850000 --samples 96
+    names = sorted(BENCHMARKS) if args.benchmark == 'all' else [args.benchmark]
+    for name in names:
+        BENCHMARKS[name](args)
+        print()
+
+
+if __name__ == "__main__":
+    main()
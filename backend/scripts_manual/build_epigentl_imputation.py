@@ -0,0 +1,35 @@
+# backend/scripts_manual/build_epigentl_imputation.py
+# 由 ExSample_SalivaCpGs.csv 計算每個 EpigenTL CpG 的平均值, 存成 EpigenTL 預處理用的 npz
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+project_root = Path(__file__).resolve().parents[1]
+sys.path.append(str(project_root))
+
+from app.services.probe_registry import get_probe_registry
+from app.services.r_epigentl_processor import EpigenTLProcessor, imputation_means_from_samples, write_imputation_means
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    processor = EpigenTLProcessor()
+    parser = argparse.ArgumentParser(description="Build the EpigenTL imputation vector from the example saliva samples")
+    parser.add_argument("--source", default=str(processor.ex_sample_file), help="ExSample_SalivaCpGs.csv")
+    parser.add_argument("--output", default=str(processor.imputation_file), help="Output npz")
+    args = parser.parse_args()
+
+    # example: python scripts_manual/build_epigentl_imputation.py --source ~/EpigenTL/ExSample_SalivaCpGs.csv
+    probes = get_probe_registry().probes('EpigenTL')
+    means = imputation_means_from_samples(pd.read_csv(args.source), probes)
+    path = write_imputation_means(means, args.output)
+    logger.info(f"{len(means)} of {len(probes)} EpigenTL CpGs written to {path} ({path.stat().st_size / 1e3:.1f} kB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+# backend/scripts_manual/build_mentalhealth_saliva_reference.py
+# 由 EpigenTL 結果 (data/epigentl_results/*.csv) 計算唾液參考分位數, 供 MentalHealth 單一樣本/小批次使用
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+project_root = Path(__file__).resolve().parents[1]
+sys.path.append(str(project_root))
+
+from app.services.mentalhealth_processor import MentalHealthProcessor, quantile_table, write_quantile_reference
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    processor = MentalHealthProcessor()
+    parser = argparse.ArgumentParser(description="Build the saliva reference quantiles for the MentalHealth transform")
+    parser.add_argument("sources", nargs='*', help="EpigenTL result CSVs (default: data/epigentl_results/*.csv)")
+    parser.add_argument("--output", default=str(processor.saliva_reference_file), help="Output npz")
+    args = parser.parse_args()
+
+    # example: python scripts_manual/build_mentalhealth_saliva_reference.py data/epigentl_results/batch*_epigentl_results.csv
+    sources = args.sources or sorted(str(p) for p in (project_root / 'data' / 'epigentl_results').glob('*.csv'))
+    if not sources:
+        parser.error("No EpigenTL result files found")
+    features = list(processor.feature_mapping.values())
+    results = pd.concat([pd.read_csv(source, index_col=0) for source in sources])
+    # 重複處理的樣本只算一次
+    results = results[~results.index.duplicated(keep='last')].dropna(subset=features)
+    path = write_quantile_reference(quantile_table(results, features), features, args.output)
+    logger.info(f"Saliva reference from {len(results)} samples in {len(sources)} files written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# backend/scripts_manual/convert_beta_tables.py
+# 將舊的 data/processed_beta_table/*_processed.csv 轉成 Parquet probe store, 並更新 SampleData.processed_beta_table_path
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+project_root = Path(__file__).resolve().parents[1]
+sys.path.append(str(project_root))
+
+from app.db import models
+from app.db.session import SessionLocal
+from app.services.beta_store import write_beta_store
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def convert(csv_path: Path, remove_csv: bool = False) -> Path:
+    beta_table = pd.read_csv(csv_path, index_col='probeID')
+    parquet_path = write_beta_store(beta_table, csv_path.with_suffix('.parquet'))
+
+    old_relative = csv_path.resolve().relative_to(project_root).as_posix()
+    new_relative = parquet_path.resolve().relative_to(project_root).as_posix()
+    db = SessionLocal()
+    try:
+        updated = db.query(models.SampleData).filter(
+            models.SampleData.processed_beta_table_path == old_relative
+        ).update({models.SampleData.processed_beta_table_path: new_relative}, synchronize_session=False)
+        db.commit()
+        logger.info(f"{csv_path.name} -> {parquet_path.name}, updated {updated} samples")
+    finally:
+        db.close()
+
+    if remove_csv:
+        csv_path.unlink()
+    return parquet_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert processed beta table CSVs to Parquet probe stores")
+    parser.add_argument("csv_files", nargs="*", help="CSV files (default: every *_processed.csv in data/processed_beta_table)")
+    parser.add_argument("--remove_csv", action="store_true", help="Delete each CSV after converting it")
+    args = parser.parse_args()
+
+    # example: python scripts_manual/convert_beta_tables.py --remove_csv
+    csv_files = [Path(f) for f in args.csv_files] or sorted(
+        (project_root / 'data' / 'processed_beta_table').glob('*_processed.csv'))
+    for csv_path in csv_files:
+        convert(csv_path, remove_csv=args.remove_csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,8 @@ from app.services.report_generator import IdatReportGenerator, ProcessedDataRepo
 from app.db.models import SampleData
 from app.core.config import settings
 from app.services.gcs_storage import GCSStorage
+from app.services.sample_ingest import SampleIngestor
+from app.services.idat_stager import get_idat_stager
 from google.cloud import storage
 from google.oauth2 import service_account
 from dotenv import load_dotenv
@@ -49,85 +51,24 @@ def download_file_from_gcs(bucket_name, source_blob_name):
     return temp_file_path
 
 def upload_sample_data(pd_file_local_path):
+    """從本地的CSV檔案導入樣本數據"""
     # 獲取目錄路徑
     directory_path = os.path.dirname(pd_file_local_path).replace(os.sep, '/')
-    """從本地的CSV檔案導入樣本數據"""
-    session = SessionLocal()
     try:
-        df = pd.read_csv(pd_file_local_path)
-        
-        for _, row in df.iterrows():
-            logger.info(f'Processing row: {row.to_dict()}')
-            
-            sentrix_id = str(row['Sentrix_ID'])
-            sentrix_position = str(row['Sentrix_Position'])
-            idat_file = f"{directory_path}/{sentrix_id}_{sentrix_position}_Grn.idat,{directory_path}/{sentrix_id}_{sentrix_position}_Red.idat"
-
-            existing_sample = session.query(SampleData).filter_by(
-                Sentrix_ID=sentrix_id,
-                Sentrix_Position=sentrix_position
-            ).first()
-
-            if existing_sample:
-                logger.warning(f"Sample already exists: {row['Sample_Name']}")
-                continue
-
-            new_sample = SampleData(
-                sample_name=row['Sample_Name'],
-                Sentrix_ID=sentrix_id,
-                Sentrix_Position=sentrix_position,
-                idat_file=idat_file
-            )
-            session.add(new_sample)
-
-        session.commit()
-        logger.info("All samples have been imported successfully.")
+        counts = SampleIngestor().ingest(pd_file_local_path, directory_path)
+        logger.info(f"All samples have been imported successfully: {counts}")
     except Exception as e:
-        session.rollback()
         logger.error(f"An error occurred: {str(e)}")
-    finally:
-        session.close()
 
 def upload_sample_data_from_gcs(pd_file_gcs_path):
     """從GCS的CSV檔案導入樣本數據"""
     gcs_storage = GCSStorage()
-    session = SessionLocal()
     try:
-        pd_file_content = gcs_storage.download_as_text_utf8(pd_file_gcs_path)
-        df = pd.read_csv(io.StringIO(pd_file_content))
-        
-        for _, row in df.iterrows():
-            logger.info(f'Processing row: {row.to_dict()}')
-            
-            sentrix_id = str(row['Sentrix_ID'])
-            sentrix_position = str(row['Sentrix_Position'])
-            idat_file = f"data/raw/run1/{sentrix_id}_{sentrix_position}_Grn.idat,data/raw/run1/{sentrix_id}_{sentrix_position}_Red.idat"
-
-            existing_sample = session.query(SampleData).filter_by(
-                Sentrix_ID=sentrix_id,
-                Sentrix_Position=sentrix_position
-            ).first()
-
-            if existing_sample:
-                logger.warning(f"Sample already exists: {row['Sample_Name']}")
-                continue
-
-
-            new_sample = SampleData(
-                sample_name=row['Sample_Name'],
-                Sentrix_ID=sentrix_id,
-                Sentrix_Position=sentrix_position,
-                idat_file=idat_file
-            )
-            session.add(new_sample)
-
-        session.commit()
-        logger.info("All samples have been imported successfully.")
+        with gcs_storage.open_text(pd_file_gcs_path) as pd_file:
+            counts = SampleIngestor().ingest(pd_file, "data/raw/run1")
+        logger.info(f"All samples have been imported successfully: {counts}")
     except Exception as e:
-        session.rollback()
         logger.error(f"An error occurred: {str(e)}")
-    finally:
-        session.close()
 
 def convert_gender_to_boolean(gender):
     if gender == 'Female':
@@ -197,13 +138,33 @@ def generate_reports_from_gcs(pd_file_gcs_path, idat_folder_gcs_path):
     finally:
         db.close()
 
+def generate_reports_from_gcs_runs(runs):
+    """
+    依序處理多個 GCS 上的 run; 下一個 run 的 IDAT 在目前 run 做 ChAMP 時就開始下載
+
+    :param runs: [(pd_file_gcs_path, idat_folder_gcs_path, batch_name), ...]
+    """
+    stager = get_idat_stager()
+    batch_names = [batch_name for _, _, batch_name in runs]
+    for staged, batch_name in zip(stager.staged_batches((pd_path, idat_path) for pd_path, idat_path, _ in runs), batch_names):
+        df = pd.read_csv(staged.pd_file_path)
+        metadata = {
+            'order_ecid': df['Sample_Name'].tolist(),
+            'age': df['Age'].tolist(),
+            'sex': [convert_gender_to_boolean(gender) for gender in df['Gender']]
+        }
+        gcs_generator = IdatReportGenerator()
+        gcs_generator.process_staged(staged, batch_name)
+        reports = gcs_generator.generate_and_save_reports(metadata)
+        logger.info(f"{batch_name}: generated and saved {len(reports)} reports.")
+
 def main(pd_file_path, idat_folder_path, batch_name):
     """主函數，執行整個流程"""
     logger.info("Starting sample processing and report generation...")
     
     upload_sample_data(pd_file_path)
     # generate_reports(pd_file_path, idat_folder_path, batch_name)
-    local_betas_path = project_root / 'data' / 'processed_beta_table' / 'GSE232332_2_processed.csv'
+    local_betas_path = project_root / 'data' / 'processed_beta_table' / 'GSE232332_2_processed.parquet'
     generate_reports_from_local_betas(local_betas_path, pd_file_path)
     
     logger.info("Sample processing and report generation completed.")
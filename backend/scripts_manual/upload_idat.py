@@ -1,10 +1,17 @@
 # backend/scripts_manual/upload_idat.py
 import os
+import sys
+from pathlib import Path
 from google.cloud import storage
 from google.oauth2 import service_account
 from dotenv import load_dotenv
 import argparse
 
+project_root = Path(__file__).resolve().parents[1]
+sys.path.append(str(project_root))
+
+from app.services.gcs_storage import GCSStorage
+
 # 加載 .env.development 文件
 load_dotenv('.env.development')
 
@@ -15,29 +22,20 @@ def get_storage_client():
     )
     return storage.Client(credentials=credentials)
 
-def upload_file_to_gcs(bucket_name, source_file, destination_blob_name):
-    """上傳單個文件到 GCS"""
+def get_gcs_storage(bucket_name, workers=None):
     storage_client = get_storage_client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-
-    blob.upload_from_filename(source_file)
-    print(f"File {source_file} uploaded to {destination_blob_name}.")
+    return GCSStorage(client=storage_client, bucket=storage_client.bucket(bucket_name), max_workers=workers)
 
-def upload_directory_to_gcs(bucket_name, source_dir, destination_prefix):
-    """上傳整個目錄到 GCS"""
-    storage_client = get_storage_client()
-    bucket = storage_client.bucket(bucket_name)
-
-    for root, _, files in os.walk(source_dir):
-        for file in files:
-            local_path = os.path.join(root, file)
-            relative_path = os.path.relpath(local_path, source_dir)
-            gcs_path = os.path.join(destination_prefix, relative_path)
+def upload_file_to_gcs(bucket_name, source_file, destination_blob_name):
+    """上傳單個文件到 GCS (內容相同時略過)"""
+    uri = get_gcs_storage(bucket_name).upload_file(source_file, destination_blob_name)
+    print(f"File {source_file} uploaded to {uri}.")
 
-            blob = bucket.blob(gcs_path)
-            blob.upload_from_filename(local_path)
-            print(f"File {local_path} uploaded to {gcs_path}.")
+def upload_directory_to_gcs(bucket_name, source_dir, destination_prefix, workers=None):
+    """平行上傳整個目錄到 GCS, 已存在且 CRC32C/MD5 相同的文件會略過"""
+    results = get_gcs_storage(bucket_name, workers).upload_directory(source_dir, destination_prefix)
+    uploaded = sum(result['status'] == 'done' for result in results)
+    print(f"{uploaded} files uploaded, {len(results) - uploaded} unchanged, to gs://{bucket_name}/{destination_prefix}")
 
 def main():
     # example: python scripts_manual/upload_idat.py data/raw/run1 data/raw/run1/
@@ -45,6 +43,7 @@ def main():
     parser.add_argument("source", help="Source file or directory to upload")
     parser.add_argument("destination", help="Destination path in GCS")
     parser.add_argument("--bucket", help="GCS bucket name (overrides env variable)")
+    parser.add_argument("--workers", type=int, help="Number of parallel uploads (default GCS_TRANSFER_WORKERS)")
     args = parser.parse_args()
 
     bucket_name = args.bucket or os.getenv('GCS_BUCKET_NAME')
@@ -54,7 +53,7 @@ def main():
     if os.path.isfile(args.source):
         upload_file_to_gcs(bucket_name, args.source, args.destination)
     elif os.path.isdir(args.source):
-        upload_directory_to_gcs(bucket_name, args.source, args.destination)
+        upload_directory_to_gcs(bucket_name, args.source, args.destination, args.workers)
     else:
         print(f"Error: {args.source} is neither a file nor a directory")
 
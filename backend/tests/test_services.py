@@ -7,3 +7,1362 @@ def test_idat_processor():
 def test_report_generator():
     # Add test for report_generator
     pass
+
+def test_r_handoff_table_roundtrip_and_output_envelope(tmp_path):
+    import json
+    import numpy as np
+    import pandas as pd
+    import pytest
+    from app.services.r_handoff import parse_r_output, read_handoff_table, write_handoff_table
+
+    beta = pd.DataFrame({'S1': [0.1, np.nan, 0.9], 'S2': [0.5, 0.25, 0.75]},
+                        index=pd.Index(['cg00000001', 'cg00000002', 'cg00000003'], name='probeID'))
+    path = write_handoff_table(beta, tmp_path / 'beta.feather', index_label='probeID')
+    result = read_handoff_table(path, index_col='probeID')
+    assert result.index.name == 'probeID' and list(result.index) == list(beta.index)
+    assert (result.dtypes == np.float32).all()
+    np.testing.assert_array_equal(result.to_numpy(), beta.to_numpy(dtype=np.float32))
+    assert list(read_handoff_table(path, columns=['S2']).columns) == ['S2']
+
+    # R 的 print() 輸出在前, 最後一行才是 JSON
+    envelope = {"status": "success", "data": {"format": "feather", "path": str(path)}}
+    stdout = '[1] "Loading EPIC manifest"\nLoaded objects:\n[1] "ExampleFiles"\n' + json.dumps(envelope) + '\n'
+    assert parse_r_output(stdout) == envelope
+    with pytest.raises(json.JSONDecodeError):
+        parse_r_output('[1] "Error in library(ChAMP)"\n')
+
+FAKE_R_WORKER = '''
+import json, os, sys
+print(json.dumps({"id": "ready", "status": "success", "data": {"pid": os.getpid()}}), flush=True)
+for line in sys.stdin:
+    job = json.loads(line)
+    if job["job"] == "shutdown":
+        break
+    if job["job"] == "crash":
+        sys.exit(1)
+    print("noise that is not a reply", flush=True)
+    print(json.dumps({"id": job["id"], "status": "success", "data": {"job": job["job"], "pid": os.getpid()}}), flush=True)
+'''
+
+def test_r_worker_pool_restarts_crashed_worker(tmp_path):
+    import sys
+    import pytest
+    from app.services.r_worker_pool import RWorkerPool, RWorkerError
+
+    worker_script = tmp_path / 'fake_worker.py'
+    worker_script.write_text(FAKE_R_WORKER)
+    pool = RWorkerPool(1, r_executable=sys.executable, worker_script_path=str(worker_script),
+                       epigentl_source_functions_path='', startup_timeout=10, job_timeout=10, health_interval=0)
+    pool.start()
+    try:
+        first = pool.run('champ', {})
+        assert first['status'] == 'success'
+        assert first['data']['job'] == 'champ'
+
+        with pytest.raises(RWorkerError):
+            pool.run('crash', {})
+
+        # 崩潰的 worker 已重啟, 下一個工作正常執行
+        second = pool.run('epidish', {})
+        assert second['status'] == 'success'
+        assert second['data']['pid'] != first['data']['pid']
+        assert all(status['healthy'] for status in pool.check_health())
+    finally:
+        pool.shutdown()
+
+def test_process_idat_sharded_merges_probe_aligned(tmp_path, monkeypatch):
+    import pandas as pd
+    from app.services.idat_processor import IDATProcessor
+
+    sample_sheet = pd.DataFrame({
+        'Sample_Name': [f'S{i}' for i in range(6)],
+        'Sentrix_ID': ['100', '100', '100', '200', '200', '300'],
+        'Sentrix_Position': [f'R0{i}C01' for i in range(1, 7)],
+    })
+    sheet_path = tmp_path / 'Sample_Sheet.csv'
+    sample_sheet.to_csv(sheet_path, index=False)
+    for _, row in sample_sheet.iterrows():
+        for channel in ('Grn', 'Red'):
+            (tmp_path / f"{row['Sentrix_ID']}_{row['Sentrix_Position']}_{channel}.idat").write_bytes(b'')
+
+    processor = IDATProcessor()
+    shards = processor.plan_shards(sample_sheet, shard_size=3)
+    assert [shard['Sentrix_ID'].unique().tolist() for shard in shards] == [['100'], ['200', '300']]
+
+    def fake_process_idat(pd_file_path, idat_file_path):
+        shard_sheet = pd.read_csv(pd_file_path)
+        probes = ['cg00000001', 'cg00000002', 'cg00000003']
+        if '300' in shard_sheet['Sentrix_ID'].astype(str).tolist():
+            probes = probes[1:]  # 這個分片有一個 probe 被 ChAMP 過濾掉
+        df = pd.DataFrame({name: [0.5] * len(probes) for name in shard_sheet['Sample_Name']})
+        df.insert(0, 'probeID', probes)
+        return df
+
+    monkeypatch.setattr(processor, 'process_idat', fake_process_idat)
+    merged = processor.process_idat_sharded(str(sheet_path), str(tmp_path), shard_size=3, max_concurrency=2)
+    assert merged.columns.tolist() == ['probeID'] + sample_sheet['Sample_Name'].tolist()
+    assert merged['probeID'].tolist() == ['cg00000002', 'cg00000003']
+
+def test_champ_df_postprocess_matches_groupby(tmp_path, monkeypatch):
+    import numpy as np
+    import pandas as pd
+    from app.services import probe_index
+    from app.services.idat_processor import IDATProcessor
+
+    monkeypatch.setattr(probe_index, '_indexes', {})
+    monkeypatch.setattr(probe_index, 'BACKEND_ROOT', tmp_path)
+    rng = np.random.default_rng(0)
+    probes = sorted([f"cg{i:08d}_TC21" for i in range(50)] + [f"cg{i:08d}_TC22" for i in range(0, 50, 7)]
+                    + [f"cg{i:08d}_BC11" for i in range(0, 50, 13)])
+    values = rng.random((len(probes), 4)).astype(np.float32)
+    values[3, 1] = np.nan
+    values[10, :] = np.nan
+    raw = pd.DataFrame(values, columns=['A', 'B', 'C', 'D'])
+    raw.insert(0, 'probeID', probes)
+
+    indexed = raw.set_index('probeID')
+    expected = indexed.groupby(indexed.index.str[:10]).mean()
+
+    processor = IDATProcessor()
+    for inplace in (False, True):
+        result = processor.champ_df_postprocess(raw.copy(), inplace=inplace)
+        pd.testing.assert_frame_equal(result, expected.astype(np.float32), check_exact=False, rtol=1e-6)
+
+    # 未排序的輸入也要得到相同結果
+    shuffled = raw.sample(frac=1, random_state=1).reset_index(drop=True)
+    result = processor.champ_df_postprocess(shuffled)
+    pd.testing.assert_frame_equal(result, expected.astype(np.float32), check_exact=False, rtol=1e-6)
+
+def test_get_probe_codes_looks_up_probes_once(tmp_path, monkeypatch):
+    import numpy as np
+    import pandas as pd
+    from app.services import probe_index
+
+    monkeypatch.setattr(probe_index, '_indexes', {})
+    probes = pd.Index(['cg00000001_TC21', 'cg00000001_TC22', 'cg00000002_BC11'], name='probeID')
+    index, codes = probe_index.get_probe_codes('EPICv2', probes, tmp_path)
+    assert codes.tolist() == [0, 0, 1]
+
+    class CountingLookup:
+        def __init__(self, lookup):
+            self.lookup, self.calls = lookup, 0
+
+        def get_indexer(self, targets):
+            self.calls += 1
+            return self.lookup.get_indexer(targets)
+
+    index._lookup = CountingLookup(index._lookup)
+    cached, codes = probe_index.get_probe_codes('EPICv2', probes, tmp_path)
+    assert cached is index and index._lookup.calls == 1
+    np.testing.assert_array_equal(codes, index.codes_for(probes))
+
+    # 新的 probe: index 擴充並存檔, 代碼以擴充後的 index 為準
+    extended, codes = probe_index.get_probe_codes('EPICv2', probes.append(pd.Index(['cg00000003_TC21'])), tmp_path)
+    assert codes.tolist() == [0, 0, 1, 2] and len(probe_index.ProbeCollapseIndex.load('EPICv2', tmp_path).probe_ids) == 4
+
+def test_beta_cache_hit_and_lru_eviction(tmp_path):
+    import os
+    import numpy as np
+    import pandas as pd
+    from app.services.beta_cache import BetaTableCache
+
+    idat_a = tmp_path / '200_R01C01_Grn.idat'
+    idat_a.write_bytes(b'grn-a')
+    idat_b = tmp_path / '200_R02C01_Grn.idat'
+    idat_b.write_bytes(b'grn-b')
+    params = {'r_script_sha256': 'abc', 'array_type': 'EPICv1'}
+
+    def table(sample):
+        return pd.DataFrame({sample: np.arange(3, dtype=np.float32)},
+                            index=pd.Index(['cg1', 'cg2', 'cg3'], name='probeID'))
+
+    cache = BetaTableCache(tmp_path / 'cache', max_bytes=10 ** 9)
+    key_a = cache.make_key({'A': [idat_a]}, params)
+    key_b = cache.make_key({'B': [idat_b]}, params)
+    assert key_a != cache.make_key({'A': [idat_a]}, {**params, 'array_type': 'EPICv2'})
+    assert cache.get(key_a) is None
+
+    cache.put(key_a, table('A'))
+    pd.testing.assert_frame_equal(cache.get(key_a), table('A'))
+
+    # 限制只放得下一個 entry 時, 最久未使用的被移除
+    cache.max_bytes = cache.entries()[0]['size']
+    os.utime(cache._entry_path(key_a), (0, 0))
+    cache.put(key_b, table('B'))
+    assert cache.get(key_a) is None
+    assert cache.get(key_b) is not None
+
+    assert cache.invalidate_samples(['B']) == [key_b]
+    assert cache.entries() == []
+
+    # 同一 process 共用一個 cache, IDAT 雜湊依 (path, size, mtime) 記住, 文件改變時重新計算
+    from app.services.beta_cache import get_beta_table_cache
+    assert get_beta_table_cache() is get_beta_table_cache()
+    digest = cache.hash_file(idat_a)
+    stat = idat_a.stat()
+    idat_a.write_bytes(b'grn-x')
+    os.utime(idat_a, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.hash_file(idat_a) == digest
+    os.utime(idat_a, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert cache.hash_file(idat_a) != digest and len(cache._file_hashes) == 2
+
+def test_beta_store_probe_and_sample_projection(tmp_path):
+    import numpy as np
+    import pandas as pd
+    from app.services.beta_store import read_beta_store, write_beta_store
+
+    rng = np.random.default_rng(0)
+    probes = [f"cg{i:08d}" for i in range(1000)]
+    beta_table = pd.DataFrame(rng.random((1000, 3), dtype=np.float32), columns=['A', 'B', 'C'],
+                              index=pd.Index(probes, name='probeID'))
+    beta_table.iloc[5, 1] = np.nan
+    path = write_beta_store(beta_table, tmp_path / 'batch_processed.parquet', row_group_size=100)
+
+    pd.testing.assert_frame_equal(read_beta_store(path), beta_table)
+
+    wanted = ['cg00000999', 'cg00000005', 'cg00000150', 'not_a_probe']
+    subset = read_beta_store(path, probes=wanted, samples=['C', 'B'])
+    expected = beta_table.loc[['cg00000005', 'cg00000150', 'cg00000999'], ['C', 'B']]
+    pd.testing.assert_frame_equal(subset, expected)
+
+def test_probe_registry_submatrix_and_missing(tmp_path):
+    import numpy as np
+    import pandas as pd
+    from app.services.probe_registry import ProbeRegistry
+
+    probe_file = tmp_path / 'model_probes.csv'
+    probe_file.write_text('cg3\ncg1\ncg9\n')
+    registry = ProbeRegistry({'Model': probe_file})
+    beta_table = pd.DataFrame(np.arange(8, dtype=np.float64).reshape(4, 2), columns=['A', 'B'],
+                              index=pd.Index(['cg1', 'cg2', 'cg3', 'cg4'], name='probeID'))
+
+    sub = registry.submatrix('Model', beta_table)
+    expected = beta_table[beta_table.index.isin(['cg3', 'cg1', 'cg9'])].astype(np.float32)
+    pd.testing.assert_frame_equal(sub, expected)
+    assert list(registry.missing_report(beta_table.index, ['Model'])['Model']) == ['cg9']
+
+def test_probe_registry_caches_subsets_per_index(tmp_path, monkeypatch):
+    import gc
+    import pandas as pd
+    from app.services import probe_registry
+    from app.services.probe_registry import ProbeRegistry
+
+    probe_file = tmp_path / 'model_probes.csv'
+    probe_file.write_text('cg3\ncg1\n')
+    registry = ProbeRegistry({'Model': probe_file})
+    index_a = pd.Index(['cg1', 'cg2', 'cg3'], name='probeID')
+    index_b = pd.Index(['cg3', 'cg4'], name='probeID')
+
+    # 兩個批次交替使用, 各自的位置都保留
+    subset_a, subset_b = registry.subset('Model', index_a), registry.subset('Model', index_b)
+    assert registry.subset('Model', index_a) is subset_a and registry.subset('Model', index_b) is subset_b
+    assert subset_a.positions.tolist() == [0, 2] and subset_b.positions.tolist() == [0]
+    assert list(subset_b.missing) == ['cg1']
+
+    # 超過容量時淘汰最久未使用的 index; 已釋放的 index 不會被保留
+    monkeypatch.setattr(probe_registry, 'SUBSET_CACHE_SIZE', 2)
+    index_c = pd.Index(['cg1'], name='probeID')
+    registry.subset('Model', index_c)
+    assert registry.subset('Model', index_b) is subset_b
+    assert registry.subset('Model', index_a) is not subset_a
+    del index_c, index_b, subset_b
+    gc.collect()
+    registry.subset('Model', pd.Index(['cg2'], name='probeID'))
+    assert [ref() is index_a for ref, _ in registry._subsets.values()] == [True, False]
+
+def test_sample_ingestor_bulk_insert_is_idempotent(tmp_path):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+    from app.db.models import SampleData
+    from app.services.sample_ingest import SampleIngestor
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SampleData.__table__.create(engine)
+    session_factory = sessionmaker(bind=engine)
+
+    sheet = tmp_path / 'Sample_Sheet.csv'
+    lines = ['Sample_Name,Sample_Well,Sentrix_ID,Sentrix_Position']
+    lines += [f"S{i},A{i},2064670100{i // 8:02d},R0{i % 8 + 1}C01" for i in range(50)]
+    lines.append("S0_dup,A0,206467010000,R01C01")
+    sheet.write_text('\n'.join(lines) + '\n')
+
+    progress = []
+    ingestor = SampleIngestor(session_factory, chunk_size=16)
+    counts = ingestor.ingest(sheet, 'data/raw/run1', progress=lambda *args: progress.append(args))
+    assert counts == {'rows': 51, 'inserted': 50, 'skipped': 1}
+    assert len(progress) == 4
+
+    assert ingestor.ingest(sheet, 'data/raw/run1')['inserted'] == 0
+    session = session_factory()
+    sample = session.query(SampleData).filter_by(sample_name='S9').one()
+    assert sample.Sentrix_ID == '206467010001'
+    assert sample.idat_file == ("data/raw/run1/206467010001_R02C01_Grn.idat,"
+                                "data/raw/run1/206467010001_R02C01_Red.idat")
+    assert session.query(SampleData).count() == 50
+    session.close()
+
+class FakeBlob:
+    """In-memory stand-in for google.cloud.storage.Blob (only what GCSStorage uses)."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = None
+
+    @property
+    def _data(self):
+        return self.bucket.objects[self.name]
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    @property
+    def md5_hash(self):
+        import base64, hashlib
+        return None if self.name in self.bucket.composed else base64.b64encode(hashlib.md5(self._data).digest()).decode()
+
+    @property
+    def crc32c(self):
+        import base64, google_crc32c
+        return base64.b64encode(google_crc32c.Checksum(self._data).digest()).decode()
+
+    def _store(self, data):
+        self.bucket.uploads.append(self.name)
+        self.bucket.objects[self.name] = data
+        self.bucket.composed.discard(self.name)
+
+    def upload_from_filename(self, filename):
+        with open(filename, 'rb') as f:
+            self._store(f.read())
+
+    def upload_from_file(self, file_obj, size=None):
+        self._store(file_obj.read(size))
+
+    def download_to_file(self, file_obj, start=None):
+        self.bucket.downloads.append((self.name, start))
+        file_obj.write(self._data[start or 0:])
+
+    def compose(self, sources):
+        self._store(b''.join(source._data for source in sources))
+        self.bucket.composed.add(self.name)
+
+    def delete(self):
+        del self.bucket.objects[self.name]
+
+
+class FakeBucket:
+    def __init__(self, name='fake-bucket'):
+        self.name = name
+        self.objects = {}
+        self.composed = set()
+        self.uploads = []
+        self.downloads = []
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        return FakeBlob(self, name) if name in self.objects else None
+
+    def list_blobs(self, prefix=''):
+        return [FakeBlob(self, name) for name in sorted(self.objects) if name.startswith(prefix)]
+
+
+def _write_run_dir(run_dir, n_samples=4, size=1000):
+    import os
+    run_dir.mkdir()
+    for i in range(n_samples):
+        for channel in ('Grn', 'Red'):
+            (run_dir / f"2064_R0{i + 1}C01_{channel}.idat").write_bytes(os.urandom(size))
+    (run_dir / 'Sample_Sheet.csv').write_text('Sample_Name,Sentrix_ID,Sentrix_Position\n')
+
+
+def test_gcs_transfer_manager_roundtrip_with_fake_bucket(tmp_path):
+    import pytest
+    pytest.importorskip('google_crc32c')
+    from app.services.gcs_storage import GCSStorage
+
+    run_dir = tmp_path / 'run1'
+    _write_run_dir(run_dir)
+    (run_dir / 'big.idat').write_bytes(bytes(range(256)) * 40)
+    bucket = FakeBucket()
+    gcs = GCSStorage(bucket=bucket, max_workers=4)
+    gcs.composite_threshold = 5000
+    gcs.composite_parts = 3
+
+    results = gcs.upload_directory(str(run_dir), 'data/raw/run1')
+    assert sorted(r['status'] for r in results) == ['done'] * 10
+    assert bucket.objects['data/raw/run1/big.idat'] == (run_dir / 'big.idat').read_bytes()
+    assert 'data/raw/run1/big.idat' in bucket.composed
+    assert not [name for name in bucket.objects if '.parts-' in name]
+
+    # 內容相同的文件不會重傳
+    bucket.uploads.clear()
+    results = gcs.upload_directory(str(run_dir), 'data/raw/run1/')
+    assert {r['status'] for r in results} == {'skipped'} and bucket.uploads == []
+
+    # 下載整個 prefix; 中斷留下的 .part 檔從已下載的位置續傳
+    local_dir = tmp_path / 'local'
+    grn = 'data/raw/run1/2064_R01C01_Grn.idat'
+    local_dir.mkdir()
+    (local_dir / '2064_R01C01_Grn.idat.part').write_bytes(bucket.objects[grn][:300])
+    results = gcs.download_prefix('gs://fake-bucket/data/raw/run1', str(local_dir))
+    assert {r['status'] for r in results} == {'done'}
+    assert (grn, 300) in bucket.downloads
+    for name, data in bucket.objects.items():
+        assert (local_dir / name[len('data/raw/run1/'):]).read_bytes() == data
+    assert gcs.download_prefix('data/raw/run1', str(local_dir))[0]['status'] == 'skipped'
+
+def test_idat_stager_prefetches_and_evicts_lru(tmp_path):
+    import pytest
+    pytest.importorskip('google_crc32c')
+    from app.services.gcs_storage import GCSStorage
+    from app.services.idat_stager import IdatStager
+
+    bucket = FakeBucket()
+    for run in ('run1', 'run2'):
+        sheet = 'Sample_Name,Sentrix_ID,Sentrix_Position\n' + ''.join(
+            f"{run}_S{i},2064,R0{i + 1}C01\n" for i in range(2))
+        bucket.objects[f"data/raw/{run}/Sample_Sheet.csv"] = sheet.encode()
+        for i in range(2):
+            for channel in ('Grn', 'Red'):
+                bucket.objects[f"data/raw/{run}/2064_R0{i + 1}C01_{channel}.idat"] = bytes([i]) * 1000
+        bucket.objects[f"data/raw/{run}/unrelated.idat"] = b'x' * 1000
+
+    # 容量只夠放一個 run
+    stager = IdatStager(GCSStorage(bucket=bucket, max_workers=2), cache_dir=tmp_path / 'staging', max_bytes=4500)
+    runs = [(f"gs://fake-bucket/data/raw/{run}/Sample_Sheet.csv", f"gs://fake-bucket/data/raw/{run}") for run in ('run1', 'run2')]
+    seen = []
+    for staged in stager.staged_batches(runs):
+        assert all(path.exists() for path in staged.files)
+        assert {f"2064_R0{i + 1}C01_{c}.idat" for i in range(2) for c in ('Grn', 'Red')} <= {
+            p.name for p in staged.idat_dir.glob('*.idat')}
+        seen.append(staged.idat_dir.name)
+    stager.shutdown()
+
+    assert seen == ['run1', 'run2']
+    assert not any(name.endswith('unrelated.idat') for name, _ in bucket.downloads)
+    # run1 被 LRU 淘汰, run2 (最近使用) 保留
+    assert not (tmp_path / 'staging' / 'data/raw/run1/2064_R01C01_Grn.idat').exists()
+    assert (tmp_path / 'staging' / 'data/raw/run2/2064_R01C01_Grn.idat').exists()
+
+
+
+def test_idat_stager_keeps_sample_sheet_pinned_while_staging(tmp_path):
+    import pytest
+    pytest.importorskip('google_crc32c')
+    from app.services.gcs_storage import GCSStorage
+    from app.services.idat_stager import IdatStager
+
+    bucket = FakeBucket()
+    bucket.objects["data/raw/run1/Sample_Sheet.csv"] = b'Sample_Name,Sentrix_ID,Sentrix_Position\nS1,2064,R01C01\n'
+    for channel in ('Grn', 'Red'):
+        bucket.objects[f"data/raw/run1/2064_R01C01_{channel}.idat"] = b'x' * 1000
+    gcs = GCSStorage(bucket=bucket, max_workers=2)
+    stager = IdatStager(gcs, cache_dir=tmp_path / 'staging', max_bytes=0)
+
+    # 另一個執行緒 (prefetch) 在 Sample Sheet 下載後立刻 evict
+    download_file = gcs.download_file
+
+    def download_then_evict(blob_name, *args, **kwargs):
+        result = download_file(blob_name, *args, **kwargs)
+        if blob_name.endswith('Sample_Sheet.csv'):
+            stager.evict()
+        return result
+
+    gcs.download_file = download_then_evict
+    staged = stager.stage("gs://fake-bucket/data/raw/run1/Sample_Sheet.csv", "gs://fake-bucket/data/raw/run1")
+    assert all(path.exists() for path in staged.files)
+    stager.release(staged)
+    assert stager.evict() and not staged.pd_file_path.exists()
+    stager.shutdown()
+
+
+def test_idat_stager_evict_keeps_downloads_in_progress(tmp_path, monkeypatch):
+    import threading
+    import pytest
+    pytest.importorskip('google_crc32c')
+    from app.services.gcs_storage import GCSStorage
+    from app.services.idat_stager import IdatStager
+
+    bucket = FakeBucket()
+    bucket.objects["data/raw/run1/Sample_Sheet.csv"] = b'Sample_Name,Sentrix_ID,Sentrix_Position\nS1,2064,R01C01\n'
+    for channel in ('Grn', 'Red'):
+        bucket.objects[f"data/raw/run1/2064_R01C01_{channel}.idat"] = bytes(range(256)) * 4
+    stager = IdatStager(GCSStorage(bucket=bucket, max_workers=1), cache_dir=tmp_path / 'staging', max_bytes=0)
+
+    # 寫了一半時另一個執行緒 (例如 prefetch) 執行 evict
+    def download_with_concurrent_evict(self, file_obj, start=None):
+        bucket.downloads.append((self.name, start))
+        data = self._data[start or 0:]
+        file_obj.write(data[:len(data) // 2])
+        file_obj.flush()
+        evictor = threading.Thread(target=stager.evict)
+        evictor.start()
+        evictor.join()
+        file_obj.write(data[len(data) // 2:])
+
+    monkeypatch.setattr(FakeBlob, 'download_to_file', download_with_concurrent_evict)
+    staged = stager.stage("gs://fake-bucket/data/raw/run1/Sample_Sheet.csv", "gs://fake-bucket/data/raw/run1")
+    for channel in ('Grn', 'Red'):
+        assert (staged.idat_dir / f"2064_R01C01_{channel}.idat").read_bytes() == bytes(range(256)) * 4
+    # 每個文件只下載一次, 沒有因為 .part 被刪除而重新開始
+    assert [start for _, start in bucket.downloads] == [None, None, None]
+    stager.release(staged)
+    stager.shutdown()
+
+def test_model_registry_loads_once_and_reloads_on_change(tmp_path):
+    import os
+    import joblib
+    import numpy as np
+    from app.services.model_registry import ModelRegistry
+
+    path = tmp_path / 'models.pkl'
+    joblib.dump([{'index': 'cg1', 'coef': np.arange(7, dtype=np.float64)}], path)
+    registry = ModelRegistry()
+    calls = []
+
+    def loader(p):
+        calls.append(p)
+        return joblib.load(p, mmap_mode='r')
+
+    first = registry.load(path, loader)
+    assert registry.load(path, loader) is first
+    assert isinstance(first[0]['coef'], np.memmap)
+
+    # 只更新 mtime 不重新載入, 內容改變才重新載入
+    os.utime(path, ns=(0, 0))
+    assert registry.load(path, loader) is first
+    joblib.dump([{'index': 'cg2', 'coef': np.ones(7)}], path)
+    assert registry.load(path, loader)[0]['index'] == 'cg2'
+    assert len(calls) == 2
+
+
+
+def test_model_registry_cold_load_does_not_block_other_resources(tmp_path):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from app.services.model_registry import ModelRegistry
+
+    slow_path, fast_path = tmp_path / 'lasso.pkl', tmp_path / 'probes.csv'
+    slow_path.write_bytes(b'lasso')
+    fast_path.write_bytes(b'probes')
+    registry = ModelRegistry()
+    started, release = threading.Event(), threading.Event()
+    slow_calls = []
+
+    def slow_loader(path):
+        slow_calls.append(path)
+        started.set()
+        assert release.wait(5)
+        return 'lasso'
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        slow = [executor.submit(registry.load, slow_path, slow_loader, 'lasso') for _ in range(2)]
+        assert started.wait(5)
+        # 其他資源在冷載入期間照常載入
+        fast = executor.submit(registry.load, fast_path, lambda path: 'probes', 'probes')
+        assert fast.result(timeout=5) == 'probes'
+        release.set()
+        assert [future.result(timeout=5) for future in slow] == ['lasso', 'lasso']
+    # 同一資源同時載入只執行一次 loader
+    assert len(slow_calls) == 1
+
+def test_stacked_linear_model_matches_per_probe_lasso():
+    import numpy as np
+    import pandas as pd
+    from sklearn.linear_model import Lasso
+    from app.services.sa2bl_processor import SA2BLProcessor
+    from app.services.stacked_linear_model import StackedLinearModel
+
+    rng = np.random.default_rng(0)
+    features = ['Epi', 'Fib', 'NK', 'CD4T', 'CD8T', 'Mono', 'Neutro']
+    train = pd.DataFrame(rng.random((40, 7)), columns=features)
+    models = {f"cg{i:08d}": Lasso(alpha=0.001).fit(train, rng.random(40)) for i in range(50)}
+    samples = pd.DataFrame(rng.random((6, 7)), columns=features, index=[f"S{j}" for j in range(6)])
+
+    processor = SA2BLProcessor()
+    expected = processor.apply_lasso_correction(samples, models)
+    stacked = StackedLinearModel.from_models(models)
+    # 欄位順序不同也按 feature_names_in_ 對齊
+    actual = processor.apply_lasso_correction(samples[features[::-1]], stacked)
+
+    assert list(actual) == list(expected)
+    for key in expected:
+        np.testing.assert_allclose(actual[key], expected[key], rtol=1e-5, atol=1e-6)
+
+
+def test_sa2bl_in_place_correction_matches_label_aligned_path():
+    import numpy as np
+    import pandas as pd
+    import pytest
+    from sklearn.linear_model import Lasso
+    from app.services.probe_registry import ProbeRegistry
+    from app.services.sa2bl_processor import SA2BLProcessor
+    from app.services.stacked_linear_model import StackedLinearModel
+
+    rng = np.random.default_rng(1)
+    features = ['Epi', 'Fib', 'NK', 'CD4T', 'CD8T', 'Mono', 'Neutro']
+    train = pd.DataFrame(rng.random((30, 7)), columns=features)
+    samples = [f"S{j}" for j in range(5)]
+    beta = pd.DataFrame(rng.random((200, 5)), index=pd.Index([f"cg{i:08d}" for i in range(200)], name='probeID'),
+                        columns=samples)
+    beta.iloc[21, 2] = np.nan
+    # cg00000030 沒有模型, cg99999999 不在 matrix 中
+    pace_probes = [f"cg{i:08d}" for i in range(0, 200, 3)]
+    models = {p: Lasso(alpha=0.001).fit(train, rng.random(30)) for p in pace_probes + ['cg99999999'] if p != 'cg00000030'}
+    epidish = pd.DataFrame(rng.random((5, 7)), columns=features, index=samples)
+
+    processor = SA2BLProcessor()
+    processor.probe_registry = ProbeRegistry({})
+    processor.probe_registry.register('DunedinPACE', pace_probes)
+    expected = processor.adjust_methylation_data(processor.probe_registry.submatrix('DunedinPACE', beta),
+                                                 processor.apply_lasso_correction(epidish, models))
+    actual = processor.correct_methylation_data(beta, epidish, StackedLinearModel.from_models(models), chunk_rows=8)
+
+    assert actual.dtypes.eq(np.float32).all()
+    assert 'cg00000030' not in actual.index and 'cg00000021' not in actual.index
+    pd.testing.assert_frame_equal(actual.sort_index(), expected.sort_index().astype(np.float32),
+                                  check_names=False, rtol=1e-5, atol=1e-6)
+
+    # EpiDISH 的行依樣本名稱對齊, 順序不同結果相同; 缺少樣本時報錯
+    shuffled = processor.correct_methylation_data(beta, epidish.loc[['S3', 'S0', 'S4', 'S1', 'S2']],
+                                                  StackedLinearModel.from_models(models), chunk_rows=8)
+    pd.testing.assert_frame_equal(shuffled, actual)
+    with pytest.raises(ValueError, match='S2'):
+        processor.correct_methylation_data(beta, epidish.drop(index='S2'), StackedLinearModel.from_models(models))
+
+
+def test_sa2bl_design_matrix_matches_positional_formula():
+    import numpy as np
+    import pandas as pd
+    from app.services.sa2bl_processor import EPIDISH_CELL_TYPES, SA2BLProcessor, sa2bl_design_matrix
+
+    rng = np.random.default_rng(2)
+    epidish = pd.DataFrame(rng.random((6, 8)), columns=EPIDISH_CELL_TYPES, index=[f"S{j}" for j in range(6)])
+    epidish.iloc[1, 2:8] = 0.0
+    epidish.iloc[2, 4] = np.nan
+
+    # 舊的位置索引寫法
+    sums = epidish.iloc[:, 2:8].sum(axis=1)
+    new_df = pd.DataFrame(float(0), index=epidish.index, columns=epidish.columns)
+    new_df.iloc[:, 2:8] = epidish.iloc[:, 2:8].div(sums.replace(0, np.inf), axis=0).fillna(0)
+    expected = (epidish - new_df).iloc[:, [0, 1, 3, 4, 5, 6, 7]]
+
+    # 欄位順序與多餘欄位不影響結果
+    shuffled = epidish[EPIDISH_CELL_TYPES[::-1]].assign(extra=1.0)
+    actual = SA2BLProcessor().process_epidish_data(shuffled)
+    pd.testing.assert_frame_equal(actual, expected)
+    np.testing.assert_allclose(sa2bl_design_matrix(epidish.iloc[0].to_numpy())[0], expected.iloc[0].to_numpy())
+
+
+def test_biolearn_jobs_share_geo_data_and_write_one_artifact(tmp_path):
+    import numpy as np
+    import pandas as pd
+    from app.services.biolearn_processor import BioLearnProcessor, BiolearnJob, biolearn_output_name
+
+    class FakeModel:
+        def __init__(self, name):
+            self.name = name
+
+        def predict(self, data):
+            return pd.DataFrame({'Predicted': data.dnam.mean(axis=0) + len(self.name)})
+
+    class FakeGallery:
+        def get(self, name):
+            return FakeModel(name)
+
+    samples = ['S1', 'S2', 'S3']
+    rng = np.random.default_rng(3)
+    matrix = pd.DataFrame(rng.random((10, 3)), index=[f"cg{i:08d}" for i in range(10)], columns=samples)
+    processor = BioLearnProcessor()
+    processor.gallery = FakeGallery()
+    processor.clock_cache = None
+    processor.backend_root = tmp_path
+    processor.output_dir = tmp_path
+
+    output_file = biolearn_output_name('batch1')
+    assert output_file != biolearn_output_name('batch1')
+    results = processor.run_biolearn_jobs(
+        [BiolearnJob('raw', matrix, ['Horvathv2', 'PhenoAge']), BiolearnJob('sa2bl', matrix[samples[::-1]], ['DunedinPACE'])],
+        output_file)
+
+    assert list(results.index) == samples
+    assert list(results.columns) == ['Horvathv2_Predicted', 'PhenoAge_Predicted', 'DunedinPACE_Predicted']
+    np.testing.assert_allclose(results['DunedinPACE_Predicted'], matrix.mean(axis=0) + len('DunedinPACE'))
+    assert [p.name for p in tmp_path.glob('*.csv')] == [output_file]
+
+
+def test_linear_clock_cache_matches_model_gallery():
+    import numpy as np
+    import pandas as pd
+    from biolearn.data_library import GeoData
+    from biolearn.model_gallery import ModelGallery
+    from biolearn.util import get_data_file
+    from app.services.linear_clock_cache import LinearClock, LinearClockCache
+
+    gallery = ModelGallery()
+    cache = LinearClockCache(['Horvathv2', 'DunedinPACE'], gallery=gallery)
+    load_seconds = cache.warm()
+    assert set(load_seconds) == {'Horvathv2', 'DunedinPACE'} and cache.startup_seconds >= 0
+
+    horvath_probes = list(gallery.get('Horvathv2').methylation_sites())
+    gold_probes = list(pd.read_csv(get_data_file('DunedinPACE_Gold_Means.csv'), index_col=0).index)
+    probes = sorted(set(horvath_probes[10:]) | set(gold_probes))
+    rng = np.random.default_rng(4)
+    samples = [f"S{j}" for j in range(10)]
+    matrix = pd.DataFrame(rng.random((len(probes), 10)), index=probes, columns=samples)
+    # 少量 NaN 用平均值補, 超過 20% NaN 的 probe 用參考值
+    matrix.loc[horvath_probes[20], 'S3'] = np.nan
+    matrix.loc[horvath_probes[21], samples[:4]] = np.nan
+
+    for name in ('Horvathv2', 'DunedinPACE'):
+        assert isinstance(cache.get(name), LinearClock)
+        expected = gallery.get(name).predict(GeoData.from_methylation_matrix(matrix.copy()))
+        actual = cache.predict(name, GeoData.from_methylation_matrix(matrix.copy()))
+        pd.testing.assert_frame_equal(actual, expected.loc[actual.index], check_names=False, rtol=1e-9)
+
+
+FAKE_EPIGENTL_SCRIPT = '''
+import json, sys
+import pyarrow as pa
+import pyarrow.feather as feather
+input_path, _, output_path = sys.argv[1:4]
+table = feather.read_table(input_path).to_pandas().set_index('probeID')
+result = pa.table({'SampleID': list(table.columns), 'DNAmFitAge_C_Pred': table.mean().astype(float).tolist()})
+feather.write_feather(result, output_path)
+print("R noise")
+print(json.dumps({"status": "success", "data": {"format": "feather", "path": output_path}}))
+'''
+
+
+def test_epigentl_binary_handoff_uses_unique_scratch_files(tmp_path, monkeypatch):
+    import sys
+    import numpy as np
+    import pandas as pd
+    from concurrent.futures import ThreadPoolExecutor
+    from app.core.config import settings
+    from app.services.probe_registry import ProbeRegistry
+    from app.services.r_epigentl_processor import EpigenTLProcessor
+
+    script = tmp_path / 'fake_epigentl.py'
+    script.write_text(FAKE_EPIGENTL_SCRIPT)
+    monkeypatch.setattr(settings, 'R_HANDOFF_FORMAT', 'feather')
+    monkeypatch.setattr(settings, 'R_SCRATCH_DIR', str(tmp_path / 'scratch'))
+    monkeypatch.setattr(settings, 'R_WORKER_POOL_SIZE', 0)
+
+    processor = EpigenTLProcessor()
+    processor.r_executable = sys.executable
+    processor.r_script_path = str(script)
+    processor.probe_registry = ProbeRegistry({})
+    processor.probe_registry.register('EpigenTL', [f"cg{i:08d}" for i in range(5)])
+    monkeypatch.setattr(processor, 'preprocess_beta_table', lambda beta: beta)
+
+    def batch(offset):
+        return pd.DataFrame(np.full((5, 2), offset, dtype=np.float32), index=[f"cg{i:08d}" for i in range(5)],
+                            columns=[f"B{offset}_S1", f"B{offset}_S2"])
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(processor.run_epigentl_with_df, [batch(1), batch(2)]))
+
+    for offset, result in zip((1, 2), results):
+        assert list(result.index) == [f"B{offset}_S1", f"B{offset}_S2"]
+        assert result['DNAmFitAge_C_Pred'].tolist() == [offset, offset]
+    assert list((tmp_path / 'scratch').iterdir()) == []
+
+
+FAKE_EPIGENTL_CSV_SCRIPT = '''
+import csv, json, re, sys
+with open(sys.argv[1]) as f:
+    header = next(csv.reader(f))
+# 和 R read.csv 的 check.names=TRUE 一樣改名
+names = [("X" + name if name[0].isdigit() else name) for name in header[1:]]
+names = [re.sub(r"[^0-9A-Za-z_.]", ".", name) for name in names]
+print("R noise")
+print(json.dumps({"status": "success", "data": {"epigentl_results": [
+    {"SampleID": name, "DNAmFitAge_C_Pred": float(i)} for i, name in enumerate(names)]}}))
+'''
+
+
+def test_epigentl_csv_handoff_restores_sample_names_r_renamed(tmp_path, monkeypatch):
+    import logging
+    import sys
+    import numpy as np
+    import pandas as pd
+    from app.core.config import settings
+    from app.services.r_epigentl_processor import EpigenTLProcessor
+    from app.services.report_generator import MENTALHEALTH_FEATURES, ReportGenerator
+
+    script = tmp_path / 'fake_epigentl.py'
+    script.write_text(FAKE_EPIGENTL_CSV_SCRIPT)
+    monkeypatch.setattr(settings, 'R_HANDOFF_FORMAT', 'json')
+    monkeypatch.setattr(settings, 'R_SCRATCH_DIR', str(tmp_path / 'scratch'))
+    monkeypatch.setattr(settings, 'R_WORKER_POOL_SIZE', 0)
+
+    processor = EpigenTLProcessor()
+    processor.r_executable = sys.executable
+    processor.r_script_path = str(script)
+    samples = ['204875570001_R01C01', 'S-01', 'S2']
+    beta = pd.DataFrame(np.zeros((3, 3), dtype=np.float32), index=[f"cg{i:08d}" for i in range(3)], columns=samples)
+    result = processor.run_r_epigentl(beta)
+    assert list(result.index) == samples
+    assert result['DNAmFitAge_C_Pred'].tolist() == [0.0, 1.0, 2.0]
+
+    # 名稱對不上的結果不預測 MentalHealth, 而不是讓整個批次失敗
+    generator = ReportGenerator.__new__(ReportGenerator)
+    generator.logger = logging.getLogger(__name__)
+    generator.processed_data = beta
+    generator.epigentl_result = pd.DataFrame(np.ones((3, len(MENTALHEALTH_FEATURES))), columns=MENTALHEALTH_FEATURES,
+                                             index=['X204875570001_R01C01', 'S.01', 'S.2'])
+    generator._run_mentalhealth()
+    assert len(generator.mentalhealth_result['probabilities']) == 0
+    assert len(generator.mentalhealth_result['sample_names']) == 0
+
+
+def test_epigentl_preprocess_imputes_from_precomputed_means(tmp_path):
+    import numpy as np
+    import pandas as pd
+    from app.services.probe_registry import ProbeRegistry
+    from app.services.r_epigentl_processor import (EpigenTLProcessor, imputation_means_from_samples,
+                                                   read_imputation_means, write_imputation_means)
+
+    probes = pd.Index([f"cg{i:08d}" for i in range(6)], name='probeID')
+    ex_samples = pd.DataFrame(np.arange(12, dtype=float).reshape(2, 6)[:, :5], columns=probes[:5])
+    means = imputation_means_from_samples(ex_samples, probes)
+    path = write_imputation_means(means, tmp_path / 'means.npz')
+    pd.testing.assert_series_equal(read_imputation_means(path), means)
+
+    processor = EpigenTLProcessor()
+    processor.imputation_file = path
+    processor.probe_registry = ProbeRegistry({})
+    processor.probe_registry.register('EpigenTL', probes)
+    beta = pd.DataFrame({'S1': [0.1, np.nan, 0.3], 'S2': [0.4, 0.5, 0.6]}, index=['cg00000000', 'cg00000002', 'cg99999999'])
+
+    result = processor.preprocess_beta_table(beta)
+    # cg00000005 不在參考值中, 不補
+    assert list(result.index) == ['cg00000000', 'cg00000002', 'cg00000001', 'cg00000003', 'cg00000004']
+    assert result.loc['cg00000002', 'S1'] == means['cg00000002']
+    assert result.loc['cg00000003'].tolist() == [means['cg00000003']] * 2
+    assert result.loc['cg00000000', 'S2'] == np.float32(0.4)
+
+    processor.impute_nan = False
+    assert np.isnan(processor.preprocess_beta_table(beta).loc['cg00000002', 'S1'])
+
+
+def _write_epigentl_coefficients(path, cpgs, biomarkers, seed=0):
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    table = pd.DataFrame(rng.normal(size=(len(cpgs) + 1, len(biomarkers))), columns=biomarkers)
+    table.insert(0, 'Variable', ['Intercept'] + list(cpgs))
+    table.to_csv(path, index=False)
+    return table
+
+
+def test_epigentl_python_engine_matches_c_algorithm(tmp_path):
+    import numpy as np
+    import pandas as pd
+    import pytest
+    from app.services.epigentl_engine import EpigenTLEngine
+
+    cpgs = [f"cg{i:08d}" for i in range(4)]
+    table = _write_epigentl_coefficients(tmp_path / 'coefficients.csv', cpgs, ['DNAmFitAge', 'DNAmGrip'])
+    beta = pd.DataFrame(np.random.default_rng(1).random((5, 3)), columns=['S1', 'S2', 'S3'],
+                        index=['cg99999999'] + cpgs[::-1])
+
+    result = EpigenTLEngine(tmp_path / 'coefficients.csv').predict(beta)
+
+    design = np.hstack([np.ones((3, 1)), beta.loc[cpgs].T.to_numpy()])
+    expected = design @ table[['DNAmFitAge', 'DNAmGrip']].to_numpy()
+    assert list(result.columns) == ['DNAmFitAge_C_Pred', 'DNAmGrip_C_Pred']
+    assert list(result.index) == ['S1', 'S2', 'S3']
+    np.testing.assert_allclose(result.to_numpy(), expected)
+
+    with pytest.raises(ValueError, match="missing 1"):
+        EpigenTLEngine(tmp_path / 'coefficients.csv').predict(beta.drop(index=cpgs[0]))
+
+
+def test_epigentl_processor_uses_python_engine_without_r(tmp_path, monkeypatch):
+    import numpy as np
+    import pandas as pd
+    from app.services.epigentl_engine import EpigenTLEngine
+    from app.services.r_epigentl_processor import EpigenTLProcessor
+
+    cpgs = [f"cg{i:08d}" for i in range(3)]
+    _write_epigentl_coefficients(tmp_path / 'coefficients.csv', cpgs, ['DNAmFitAge'])
+    beta = pd.DataFrame(np.full((3, 2), 0.5), index=cpgs, columns=['S1', 'S2'])
+
+    processor = EpigenTLProcessor()
+    processor.python_engine = EpigenTLEngine(tmp_path / 'coefficients.csv')
+    monkeypatch.setattr(processor, 'preprocess_beta_table', lambda table: table)
+
+    def no_r(table):
+        raise AssertionError("R should not run")
+
+    monkeypatch.setattr(processor, 'run_r_epigentl', no_r)
+    for engine in ('auto', 'python'):
+        processor.engine = engine
+        assert list(processor.run_epigentl_with_df(beta).index) == ['S1', 'S2']
+
+    processor.engine = 'r'
+    monkeypatch.setattr(processor, 'run_r_epigentl', lambda table: 'r result')
+    assert processor.run_epigentl_with_df(beta) == 'r result'
+
+
+def test_epigentl_python_engine_matches_r():
+    import shutil
+    import numpy as np
+    import pandas as pd
+    import pytest
+    from app.core.config import settings
+    from app.services.epigentl_engine import EPIGENTL_COEFFICIENT_FILE
+    from app.services.r_epigentl_processor import EpigenTLProcessor
+
+    if not (shutil.which(settings.R_EXECUTABLE or 'Rscript') and settings.EPIGENTL_R_SCRIPT_PATH
+            and EPIGENTL_COEFFICIENT_FILE.exists()):
+        pytest.skip("Rscript, EpigenTL sources and the exported coefficients are required")
+
+    processor = EpigenTLProcessor()
+    cpgs = processor.python_engine.coefficients().cpgs
+    beta = pd.DataFrame(np.random.default_rng(0).uniform(0.05, 0.95, (len(cpgs), 3)), index=cpgs,
+                        columns=['S1', 'S2', 'S3'])
+    expected = processor.run_r_epigentl(beta)
+    result = processor.python_engine.predict(beta)
+    np.testing.assert_allclose(result[expected.columns].to_numpy(), expected.to_numpy(dtype=float), rtol=1e-6)
+
+
+def test_interp_columns_matches_np_interp():
+    import numpy as np
+    from app.services.mentalhealth_processor import QUANTILE_LEVELS, interp_columns
+
+    rng = np.random.default_rng(0)
+    for n_samples in (1, 2, 7, 50):
+        saliva = rng.normal(size=(n_samples, 4))
+        if n_samples > 1:
+            saliva[0, 1] = np.nan
+        blood = rng.normal(size=(200, 4))
+        blood[:20, 2] = 1.0
+        xp = np.nanpercentile(saliva, QUANTILE_LEVELS, axis=0)
+        fp = np.percentile(blood, QUANTILE_LEVELS, axis=0)
+        x = np.vstack([saliva, rng.normal(scale=3, size=(10, 4)), xp[[0, 50, -1]]])
+
+        expected = np.column_stack([np.interp(x[:, j], xp[:, j], fp[:, j]) for j in range(4)])
+        np.testing.assert_allclose(interp_columns(x, xp, fp), expected, rtol=1e-12, atol=1e-12)
+
+
+def test_mentalhealth_quantile_transform_modes(tmp_path):
+    import logging
+    import numpy as np
+    import pandas as pd
+    import pytest
+    from app.services.mentalhealth_processor import (MentalHealthProcessor, QUANTILE_LEVELS, quantile_table,
+                                                     write_quantile_reference)
+    from app.services.model_registry import ModelRegistry
+
+    rng = np.random.default_rng(0)
+    features = ['adm', 'cystatin', 'pai1', 'timp']
+    db_features = ['DNAmADM_C_Pred', 'DNAmCystatinC_C_Pred', 'DNAmPAI1_C_Pred', 'DNAmTIMP1_C_Pred']
+    blood = pd.DataFrame(rng.normal(size=(100, 4)), columns=features)
+    blood.to_csv(tmp_path / 'blood.csv', index=False)
+    reference = pd.DataFrame(rng.normal(size=(60, 4)), columns=db_features)
+
+    # 不載入分類模型 (pkl 不在測試環境中)
+    processor = MentalHealthProcessor.__new__(MentalHealthProcessor)
+    processor.logger = logging.getLogger(__name__)
+    processor.feature_mapping = dict(zip(features, db_features))
+    processor.blood_data_file = tmp_path / 'blood.csv'
+    processor.saliva_reference_file = tmp_path / 'saliva_reference.npz'
+    processor.model_registry = ModelRegistry()
+    processor.blood_quantiles = processor.load_blood_quantiles()
+    processor.min_batch_samples = 10
+
+    def expected_transform(saliva_column, reference_column, blood_feature):
+        return np.interp(saliva_column, np.percentile(reference_column, QUANTILE_LEVELS),
+                         np.percentile(blood[blood_feature], QUANTILE_LEVELS))
+
+    saliva = pd.DataFrame(rng.normal(size=(12, 4)), columns=db_features)
+    processor.quantile_mode = 'batch'
+    batch_result = processor.quantile_transform(saliva)
+    for feature, db_feature in processor.feature_mapping.items():
+        np.testing.assert_allclose(batch_result[feature], expected_transform(saliva[db_feature], saliva[db_feature], feature))
+
+    # 單一樣本: 沒有參考分布時 auto 退回批次分位數, reference 模式報錯
+    single = saliva.iloc[:1]
+    processor.quantile_mode = 'auto'
+    assert processor.quantile_transform(single).shape == (1, 4)
+    processor.quantile_mode = 'reference'
+    with pytest.raises(FileNotFoundError):
+        processor.quantile_transform(single)
+
+    write_quantile_reference(quantile_table(reference, db_features), db_features, processor.saliva_reference_file)
+    for mode in ('auto', 'reference'):
+        processor.quantile_mode = mode
+        np.testing.assert_allclose(processor.quantile_transform(single)['adm'],
+                                   expected_transform(single['DNAmADM_C_Pred'], reference['DNAmADM_C_Pred'], 'adm'))
+    # 批次夠大時 auto 仍使用批次本身的分位數
+    processor.quantile_mode = 'auto'
+    pd.testing.assert_frame_equal(processor.quantile_transform(saliva), batch_result)
+
+
+def test_stage_graph_runs_independent_branches_in_parallel():
+    import threading
+    import time
+    import pytest
+    from app.services.pipeline_dag import StageGraph
+
+    order = []
+    lock = threading.Lock()
+
+    def stage(name, seconds=0.2, error=None):
+        def run():
+            time.sleep(seconds)
+            with lock:
+                order.append(name)
+            if error:
+                raise error
+            return name
+        return run
+
+    finished = []
+    graph = StageGraph(max_workers=3, listener=lambda run: finished.append((run.name, run.status)))
+    graph.add('epidish', stage('epidish'), outputs=['epidish_data'])
+    graph.add('sa2bl', stage('sa2bl'), inputs=['epidish_data'], outputs=['sa2bl_data'])
+    graph.add('pace', stage('pace'), inputs=['sa2bl_data'], outputs=['pace'])
+    graph.add('epigentl', stage('epigentl'), outputs=['epigentl_result'])
+    graph.add('mentalhealth', stage('mentalhealth'), inputs=['epigentl_result'], outputs=['mh'])
+    runs = graph.run()
+
+    # 關鍵路徑 = 3 個 stage, 不是全部 5 個
+    assert graph.wall_seconds < 0.2 * 4.5
+    assert order.index('epidish') < order.index('sa2bl') < order.index('pace')
+    assert order.index('epigentl') < order.index('mentalhealth')
+    assert sorted(name for name, status in finished if status == 'running') == sorted(runs)
+    assert sorted(name for name, status in finished if status == 'done') == sorted(runs)
+    assert finished.index(('sa2bl', 'running')) > finished.index(('epidish', 'done'))
+    assert runs['pace'].result == 'pace'
+    assert all(seconds >= 0.2 for seconds in graph.timings().values())
+
+    graph = StageGraph(max_workers=2)
+    graph.add('epidish', stage('epidish', 0.01, RuntimeError("R failed")), outputs=['epidish_data'])
+    graph.add('sa2bl', stage('sa2bl'), inputs=['epidish_data'], outputs=['sa2bl_data'])
+    graph.add('epigentl', stage('epigentl', 0.1), outputs=['epigentl_result'])
+    with pytest.raises(RuntimeError, match="R failed"):
+        graph.run()
+    assert {name: run.status for name, run in graph.runs.items()} == {
+        'epidish': 'failed', 'sa2bl': 'skipped', 'epigentl': 'done'}
+
+    cyclic = StageGraph().add('a', stage('a'), inputs=['b'], outputs=['a']).add('b', stage('b'), inputs=['a'], outputs=['b'])
+    with pytest.raises(ValueError, match="cycle"):
+        cyclic.run()
+    with pytest.raises(ValueError, match="no stage produces"):
+        StageGraph().add('a', stage('a'), inputs=['missing']).run()
+
+
+def test_report_generator_stage_graph_branches():
+    from app.services.report_generator import ReportGenerator
+
+    generator = ReportGenerator.__new__(ReportGenerator)
+    generator.stage_listener = None
+    assert generator._stage_graph().dependencies() == {
+        'epidish': [],
+        'sa2bl': ['epidish'],
+        'pace': ['sa2bl'],
+        'horvath': [],
+        'biolearn_results': ['horvath', 'pace'],
+        'epigentl': [],
+        'mentalhealth': ['epigentl'],
+    }
+
+
+def test_population_reference_matches_per_sample_filtering():
+    import numpy as np
+    import pandas as pd
+    from app.services.population_reference import PopulationReference
+
+    rng = np.random.default_rng(0)
+    n = 400
+    population = pd.DataFrame({
+        'age': rng.integers(20, 80, n).astype(float),
+        'gender': rng.choice(['Female', 'Male'], n),
+        'fitage': rng.normal(50, 10, n),
+        'vo2max': rng.normal(38, 2, n),
+        'grip': rng.normal(33, 3, n),
+        'gait': rng.normal(1.7, 0.1, n),
+    })
+    population.loc[::17, 'grip'] = np.nan
+    ages = [25, 45, 70, np.nan, 55, np.nan, 33]
+    sexes = [0, 1, False, True, 2, None, 1]
+    values = pd.DataFrame({
+        'fitage': rng.normal(50, 10, 7), 'vo2max': rng.normal(38, 2, 7), 'grip': rng.normal(33, 3, 7),
+        'gait': population['gait'].iloc[:7].to_numpy(), 'mentalhealth': rng.normal(size=7),
+    }, index=[f"S{i}" for i in range(7)])
+    values.loc['S6', 'fitage'] = np.nan
+
+    ranks = PopulationReference(population).percentile_ranks(values, ages, sexes)
+
+    # 舊的逐樣本篩選 + (population[col] >= value).mean()
+    for i, sample in enumerate(values.index):
+        age, sex = ages[i], sexes[i]
+        if age < 40:
+            group = population['age'] < 40
+        elif 40 <= age < 60:
+            group = (population['age'] >= 40) & (population['age'] < 60)
+        else:
+            group = population['age'] >= 60
+        gender = "Female" if sex == False else "Male" if sex == True else None  # noqa: E712
+        if gender is not None:
+            subset = population[group & (population['gender'] == gender)]
+        elif not np.isnan(age):
+            subset = population[group]
+        else:
+            subset = population
+        expected = {
+            'fitage_pr': (subset['fitage'] >= values.loc[sample, 'fitage']).mean() * 100,
+            'vo2max_pr': (subset['vo2max'] < values.loc[sample, 'vo2max']).mean() * 100,
+            'grip_pr': (subset['grip'] < values.loc[sample, 'grip']).mean() * 100,
+            'gait_pr': (subset['gait'] < values.loc[sample, 'gait']).mean() * 100,
+        }
+        for column, value in expected.items():
+            assert np.isclose(ranks.loc[sample, column], value), (sample, column)
+        # GSEs.csv 沒有 mentalhealth 欄位
+        assert ranks.loc[sample, 'mentalhealth_pr'] is None
+
+
+def _sqlite_report_session_factory():
+    from sqlalchemy import Column, MetaData, String, Table, create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+    from app.db.models import Report, SampleData
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SampleData.__table__.create(engine)
+    # reports.id 是 PostgreSQL UUID (server_default gen_random_uuid()), SQLite 用字串欄位代替
+    metadata = MetaData()
+    Table('reports', metadata, *[Column(c.name, String(36) if c.name == 'id' else c.type, primary_key=c.primary_key)
+                                 for c in Report.__table__.columns])
+    metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def test_save_reports_bulk_insert_and_replace(monkeypatch):
+    import logging
+    from datetime import datetime, timezone
+    from app.core.config import settings
+    from app.db.models import Report, SampleData
+    from app.services.report_generator import REPORT_VALUE_COLUMNS, ReportGenerator
+
+    session_factory = _sqlite_report_session_factory()
+    session = session_factory()
+    session.add_all([SampleData(sample_name=f"S{i}") for i in range(25)])
+    session.commit()
+
+    def reports(bio_age):
+        return [{f"S{i}": dict({column: 1.0 for column in REPORT_VALUE_COLUMNS}, sample_name=f"S{i}", gender=True,
+                               cdt=datetime.now(timezone.utc), bio_age=bio_age + i)}
+                for i in range(30)]
+
+    monkeypatch.setattr(settings, 'REPORT_SAVE_CHUNK_SIZE', 7)
+    generator = ReportGenerator.__new__(ReportGenerator)
+    generator.logger = logging.getLogger(__name__)
+    generator.session_factory = session_factory
+
+    saved = generator.save_reports(reports(40))
+    # S25-S29 不在 sample_data 中
+    assert len(saved) == 25 and saved[0].order_ecid == 'S0' and saved[0].id is not None
+    generator.save_reports(reports(50), replace=False)
+    assert session.query(Report).count() == 50
+
+    generator.save_reports(reports(60), replace=True)
+    assert session.query(Report).count() == 25
+    assert session.query(Report).filter_by(order_ecid='S3').one().bio_age == 63
+    session.close()
+
+
+def test_report_frame_joins_stage_results_on_sample_name(monkeypatch):
+    import logging
+    import numpy as np
+    import pandas as pd
+    from scipy import stats
+    from app.db.models import Report, SampleData
+    from app.services import report_generator
+    from app.services.population_reference import PopulationReference
+    from app.services.report_generator import EPIGENTL_REPORT_COLUMNS, REPORT_VALUE_COLUMNS, ReportGenerator
+
+    samples = ['S1', 'S2', 'S3']
+    population = pd.DataFrame({'age': [30.0, 30.0, 50.0, 50.0], 'gender': ['Male'] * 4,
+                               'fitage': [10.0, 20.0, 30.0, 40.0]})
+    monkeypatch.setattr(report_generator, 'get_population_reference', lambda: PopulationReference(population))
+
+    generator = ReportGenerator.__new__(ReportGenerator)
+    generator.logger = logging.getLogger(__name__)
+    generator.processed_data = pd.DataFrame(np.zeros((2, 3)), columns=samples)
+    # 各 stage 的樣本順序不同, SA2BL/PACE 掉了 S2
+    generator.biolearn_result_Horvathv2 = pd.DataFrame({'Horvathv2_Predicted': [43.0, 41.0, 42.0]}, index=['S3', 'S1', 'S2'])
+    generator.biolearn_result_DunedinPACE = pd.DataFrame({'DunedinPACE_Predicted': [1.2, 0.9]}, index=['S3', 'S1'])
+    generator.epigentl_result = pd.DataFrame({source: [3.0, 2.0, 1.0] for source in EPIGENTL_REPORT_COLUMNS.values()},
+                                             index=['S3', 'S2', 'S1'])
+    generator.epigentl_result['DNAmFitAge_C_Pred'] = [35.0, 25.0, 15.0]
+    generator.mentalhealth_result = {'probabilities': np.array([0.9, 0.25]), 'sample_names': pd.Index(['S3', 'S1'])}
+
+    metadata = {'order_ecid': ['S2', 'S1', 'S3'], 'age': [55, 35, 31], 'sex': [True, True, True]}
+    frame = generator.build_report_frame(metadata)
+
+    assert list(frame.index) == samples and list(frame.columns) == REPORT_VALUE_COLUMNS
+    assert frame['bio_age'].tolist() == [41.0, 42.0, 43.0]
+    assert frame['age'].tolist() == [35.0, 55.0, 31.0]
+    assert frame.loc['S1', 'pace_value'] == 0.9 - report_generator.SA2BL_PACE_OFFSET
+    assert np.isnan(frame.loc['S2', 'pace_value']) and np.isnan(frame.loc['S2', 'pace_pr'])
+    assert np.isclose(frame.loc['S3', 'pace_pr'],
+                      stats.norm.sf(1.2 - report_generator.SA2BL_PACE_OFFSET, loc=1, scale=0.1381) * 100)
+    assert frame['fitage'].tolist() == [15.0, 25.0, 35.0]
+    assert np.allclose(frame['mentalhealth'].to_numpy(dtype=float), [-0.5, np.nan, 0.8], equal_nan=True)
+    # fitage_pr: 同年齡層 (<40 / 40-59) 男性中 >= fitage 的比例
+    assert frame['fitage_pr'].tolist() == [50.0, 100.0, 0.0]
+    assert frame['vo2max_pr'].tolist() == [None, None, None]
+
+    generator.session_factory = _sqlite_report_session_factory()
+    session = generator.session_factory()
+    session.add_all([SampleData(sample_name=name) for name in samples])
+    session.commit()
+    saved = generator.save_reports(frame)
+    assert [report.order_ecid for report in saved] == samples
+    stored = session.query(Report).filter_by(order_ecid='S2').one()
+    assert stored.bio_age == 42.0 and stored.pace_value is None and stored.fitage_pr == 100.0
+    session.close()
+
+
+def _sqlite_batch_queue(**kwargs):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+    from app.db.models import BatchJob
+    from app.services.batch_queue import BatchQueue
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    BatchJob.__table__.create(engine)
+    return BatchQueue(sessionmaker(bind=engine), **kwargs)
+
+
+def test_batch_queue_claims_in_order_within_running_limit():
+    from datetime import timedelta
+    import pytest
+    from app.db.models import BatchJob
+
+    queue = _sqlite_batch_queue(max_running=2, stale_seconds=60, max_attempts=2)
+    with pytest.raises(ValueError):
+        queue.enqueue('b0', 'data/raw/Sample_Sheet.csv')
+    # worker 會開啟並處理這些路徑: 只接受設定的 bucket 和資料目錄
+    for path in ('/etc/passwd', 'data/../app/main.py', 'gs://other-bucket/Sample_Sheet.csv'):
+        with pytest.raises(ValueError):
+            queue.enqueue('b0', path, idat_path='data/raw/b0')
+    ids = [queue.enqueue(f"b{i}", 'data/raw/Sample_Sheet.csv', idat_path=f"data/raw/b{i}").id for i in range(3)]
+    from app.services.batch_queue import BACKEND_ROOT
+    assert queue.get(ids[0]).pd_file_path == str((BACKEND_ROOT / 'data' / 'raw' / 'Sample_Sheet.csv').resolve())
+
+    first, second = queue.claim('w1'), queue.claim('w2')
+    assert [first.id, second.id] == ids[:2] and first.status == 'running' and first.attempts == 1
+    # 已有 2 個批次執行中
+    assert queue.claim('w1') is None
+
+    queue.record_stage(first.id, 'epidish', 'running')
+    queue.record_stage(first.id, 'epidish', 'done', 1.23456)
+    queue.record_stage(first.id, 'epigentl', 'running')
+    queue.succeed(first.id, 16)
+    job = queue.get(first.id)
+    assert job.status == 'succeeded' and job.report_count == 16 and job.finished_at is not None
+    assert job.stages == {'epidish': {'status': 'done', 'seconds': 1.235}, 'epigentl': {'status': 'running', 'seconds': None}}
+    assert queue.claim('w1').id == ids[2]
+
+    # worker 中斷: heartbeat 過期的工作重新排入佇列, 超過嘗試次數則失敗
+    session = queue.session_factory()
+    session.query(BatchJob).filter(BatchJob.id == second.id).update(
+        {BatchJob.heartbeat_at: queue._now() - timedelta(seconds=120)})
+    session.commit()
+    assert queue.requeue_stale() == {'requeued': 1, 'failed': 0}
+    queue.fail(ids[2], 'RuntimeError: R failed')
+    retried = queue.claim('w3')
+    assert retried.id == second.id and retried.attempts == 2 and retried.stages == {}
+    session.query(BatchJob).filter(BatchJob.id == second.id).update(
+        {BatchJob.heartbeat_at: queue._now() - timedelta(seconds=120)})
+    session.commit()
+    session.close()
+    assert queue.requeue_stale() == {'requeued': 0, 'failed': 1}
+    assert queue.get(second.id).status == 'failed'
+    assert queue.get(ids[2]).error == 'RuntimeError: R failed'
+
+
+def test_batch_worker_runs_jobs_and_records_failures():
+    from app.services.batch_worker import BatchWorker
+
+    queue = _sqlite_batch_queue(max_running=5)
+    ok = queue.enqueue('ok', 'data/raw/Sample_Sheet.csv', processed_data_path='ok_processed.parquet')
+    bad = queue.enqueue('bad', 'data/raw/Sample_Sheet.csv', idat_path='data/raw/bad')
+
+    def runner(job, progress):
+        progress('preprocess', 'running')
+        if job.batch_name == 'bad':
+            raise RuntimeError("ChAMP failed")
+        progress('preprocess', 'done', 0.5)
+        return 3
+
+    worker = BatchWorker(queue, concurrency=2, poll_interval=0, worker_id='test', runner=runner)
+    assert sorted(worker.poll()) == [ok.id, bad.id]
+    worker.wait()
+    assert worker.poll() == []
+
+    done, failed = queue.get(ok.id), queue.get(bad.id)
+    assert done.status == 'succeeded' and done.report_count == 3 and done.worker_id == 'test'
+    assert done.stages == {'preprocess': {'status': 'done', 'seconds': 0.5}}
+    assert failed.status == 'failed' and failed.error == 'RuntimeError: ChAMP failed'
+    assert failed.stages == {'preprocess': {'status': 'running', 'seconds': None}}
+
+
+def test_batch_api_enqueues_without_running_the_pipeline(monkeypatch):
+    from fastapi.testclient import TestClient
+    from app.core.config import settings
+    from app.main import app
+    from app.services.batch_queue import get_batch_queue
+
+    monkeypatch.setattr(settings, 'GCS_BUCKET_NAME', 'bucket')
+    queue = _sqlite_batch_queue()
+    app.dependency_overrides[get_batch_queue] = lambda: queue
+    try:
+        client = TestClient(app)
+        response = client.post("/batches", json={"pd_file_path": "gs://bucket/data/raw/run1/Sample_Sheet.csv",
+                                                 "idat_path": "gs://bucket/data/raw/run1/"})
+        assert response.status_code == 202
+        job = response.json()
+        assert job['status'] == 'queued' and job['batch_name'] == 'run1' and job['stages'] == {}
+
+        queue.claim('w1')
+        queue.record_stage(job['id'], 'preprocess', 'done', 12.5)
+        progress = client.get(f"/batches/{job['id']}").json()
+        assert progress['status'] == 'running'
+        assert progress['stages'] == {'preprocess': {'status': 'done', 'seconds': 12.5}}
+
+        assert client.get("/batches/999").status_code == 404
+        assert client.post("/batches", json={"pd_file_path": "Sample_Sheet.csv"}).status_code == 422
+        assert client.post("/batches", json={"pd_file_path": "/etc/passwd", "idat_path": "/tmp"}).status_code == 422
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_batch_job_checks_report_columns_before_ingest(tmp_path, monkeypatch):
+    import pytest
+    from app.core.config import settings
+    from app.services import batch_worker
+
+    monkeypatch.setattr(settings, 'BATCH_DATA_ROOTS', str(tmp_path))
+    sheet = tmp_path / 'Sample_Sheet.csv'
+    sheet.write_text("Sample_Name,Sentrix_ID,Sentrix_Position\nA1S1,207592440054,R07C01\n")
+    job = _sqlite_batch_queue().enqueue('run1', str(sheet), idat_path=str(tmp_path))
+
+    ingested = []
+    monkeypatch.setattr(batch_worker.SampleIngestor, 'ingest', lambda self, *args: ingested.append(args))
+    stages = []
+    with pytest.raises(ValueError, match='Age'):
+        batch_worker.run_batch_job(job, lambda *args: stages.append(args))
+    assert ingested == [] and stages == []